@@ -1,49 +1,201 @@
-from flask import Flask, redirect, url_for, flash, abort, jsonify, render_template, request
+from flask import Flask, redirect, url_for, flash, abort, jsonify, render_template, request, Response, send_from_directory, stream_with_context
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
-from models import db, User, Entry
-from config import Config, TestConfig
-from nutritionix import get_calories
-from datetime import datetime, date, time
+from models import db, User, Entry, DailyTotal, ArchivedEntry
+from config import Config, TestConfig, ProductionConfig
+from nutritionix import get_calories, normalize_query, cache_stats, NutritionixUnavailable
+from recompute import recompute_day, recompute_days, recompute_user, rebuild_all_flags
+from migrations import upgrade
+import resolver
+import search
+import reports
+import importer
+import identity
+import hashing
+import routing
+from serializers import RECORD_COLUMNS, RecordFormatter
+import versions
+import metrics
+import profiling
+import archive
+import user_deletion
+from pragmas import configure_sqlite
+from datetime import datetime, date, time, timedelta
 
+import base64
+import click
+import csv
+import hmac
+import io
+import json
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-def get_paginated_filtered_records(user_id, date=None, text=None, calories_min=None, calories_max=None, page=None, limit=None):
-	base_query = Entry.query.filter_by(user_id=user_id)
+def filter_records_query(base_query, date=None, text=None, calories_min=None, calories_max=None, model=Entry):
 	if date:
-		base_query = base_query.filter(Entry.date == date)
+		base_query = base_query.filter(model.date == date)
 	if text:
-		base_query = base_query.filter(Entry.text.ilike(f"%{text}%"))
+		# Only entry has a full-text index, archived records are matched with ILIKE
+		base_query = search.filter_text(base_query, text) if model is Entry else base_query.filter(model.text.ilike(f"%{text}%"))
 	if calories_min:
-		base_query = base_query.filter(Entry.calories >= calories_min)
+		base_query = base_query.filter(model.calories >= calories_min)
 	if calories_max:
-		base_query = base_query.filter(Entry.calories <= calories_max)
+		base_query = base_query.filter(model.calories <= calories_max)
+	return base_query
 
-	# Calculate the offset and limit for pagination
+RECORD_FIELDS = ('id', 'text', 'date', 'time', 'calories', 'is_below_expected')
+
+def tiered_records(user_id, date=None, text=None, calories_min=None, calories_max=None, fields=RECORD_FIELDS, ranked=False):
+	# Filtered records of entry and entry_archive as one subquery, with a rank column when ranked
+	selects = []
+	for model in (Entry, ArchivedEntry):
+		columns = [getattr(model, field) for field in fields]
+		if ranked:
+			# Archived matches, which have no bm25 rank, come after the ranked ones
+			columns.append((search.entry_fts.c.rank if model is Entry else db.literal(0.0)).label('rank'))
+		query = db.select(*columns)
+		if user_id is not None:
+			query = query.where(model.user_id == user_id)
+		selects.append(filter_records_query(query, date, text, calories_min, calories_max, model))
+	return db.union_all(*selects).subquery('records')
+
+def is_calories(value):
+	# JSON numbers only: bool is an int subclass, and strings or null would break the running totals
+	return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def encode_cursor(*values):
+	# Opaque, URL-safe token holding the sort key of the last row on a page
+	return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+	return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+def count_filtered_records(user_id, base_query, date=None, text=None, calories_min=None, calories_max=None):
+	if text or calories_min or calories_max:
+		return base_query.order_by(None).count()
+	# Without row-level filters the count is served from the daily_total rollup
+	count_query = db.session.query(db.func.coalesce(db.func.sum(DailyTotal.entry_count), 0)) \
+		.filter(DailyTotal.user_id == user_id)
+	if date:
+		count_query = count_query.filter(DailyTotal.date == date)
+	return count_query.scalar()
+
+def get_paginated_filtered_records(user_id, date=None, text=None, calories_min=None, calories_max=None, page=None, limit=None, with_total=True):
 	offset = ((page - 1) * limit) if (page != None and limit != None) else None
-	# Apply pagination to the query
-	records_query = base_query.offset(offset).limit(limit)
+	if date:
+		# A date filter can reach into archived records, read both tiers
+		ranked = bool(search.rank_order(text))
+		records = tiered_records(user_id, date, text, calories_min, calories_max, ranked=ranked)
+		order = ((records.c.rank,) if ranked else ()) + (records.c.date, records.c.time, records.c.id)
+		rows = db.session.execute(
+			db.select(*(records.c[field] for field in RECORD_FIELDS)).order_by(*order).offset(offset).limit(limit)
+		).all()
+		total_count = db.session.execute(db.select(db.func.count()).select_from(records)).scalar() if with_total else None
+		return rows, total_count
+
+	base_query = filter_records_query(Entry.query.filter_by(user_id=user_id), date, text, calories_min, calories_max) \
+		.order_by(*search.rank_order(text), Entry.date, Entry.time, Entry.id)
+
+	# Apply pagination to the query, selecting plain rows rather than Entry objects
+	records_query = base_query.with_entities(*RECORD_COLUMNS).offset(offset).limit(limit)
 	# Retrieve the records from the database
 	records = records_query.all()
 	# Get the total count of records for pagination
-	total_count = base_query.count()
+	total_count = count_filtered_records(user_id, base_query, date, text, calories_min, calories_max) if with_total else None
  
 	return records, total_count
 
+def cursor_condition(columns, cursor):
+	# Rows sorting after the (date, time, id) held by a cursor
+	last_date, last_time, last_id = decode_cursor(cursor)
+	return db.tuple_(*columns) > db.tuple_(
+		db.literal(datetime.strptime(last_date, '%Y-%m-%d').date(), db.Date),
+		db.literal(time.fromisoformat(last_time), db.Time),
+		db.literal(int(last_id), db.Integer)
+	)
+
+def get_keyset_filtered_records(user_id, date=None, text=None, calories_min=None, calories_max=None, cursor=None, limit=None, with_total=False):
+	if date:
+		# A date filter can reach into archived records, read both tiers
+		records = tiered_records(user_id, date, text, calories_min, calories_max)
+		order = (records.c.date, records.c.time, records.c.id)
+		records_query = db.select(*(records.c[field] for field in RECORD_FIELDS)).order_by(*order)
+		if cursor:
+			records_query = records_query.where(cursor_condition(order, cursor))
+		rows = db.session.execute(records_query.limit(limit + 1 if limit != None else None)).all()
+		total_count = db.session.execute(db.select(db.func.count()).select_from(records)).scalar() if with_total else None
+	else:
+		base_query = filter_records_query(Entry.query.filter_by(user_id=user_id), date, text, calories_min, calories_max)
+
+		# Continue after the (date, time, id) of the last record returned, using the entry index
+		records_query = base_query
+		if cursor:
+			records_query = records_query.filter(cursor_condition((Entry.date, Entry.time, Entry.id), cursor))
+		records_query = records_query.with_entities(*RECORD_COLUMNS).order_by(Entry.date, Entry.time, Entry.id)
+
+		# Fetch one extra row to know whether there is a next page
+		rows = records_query.limit(limit + 1 if limit != None else None).all()
+		total_count = count_filtered_records(user_id, base_query, date, text, calories_min, calories_max) if with_total else None
+
+	next_cursor = None
+	if limit != None and len(rows) > limit:
+		rows = rows[:limit]
+		last = rows[-1]
+		next_cursor = encode_cursor(str(last.date), str(last.time), last.id)
+
+	return rows, total_count, next_cursor
+
+def iter_paginated_filtered_records_by_user(date=None, text=None, calories_min=None, calories_max=None, page=None, limit=None):
+	# Page through every non-manager user's records with a single windowed query.
+	# Yields (username, entry row or None, total_count), streamed from the database.
+	offset = ((page - 1) * limit) if (page != None and limit != None) else 0
+	if date:
+		# A date filter can reach into archived records, read both tiers
+		records = tiered_records(None, date, text, calories_min, calories_max, fields=('id', 'user_id') + RECORD_FIELDS[1:])
+		source, query = records.c, db.session.query(*records.c)
+	else:
+		source, query = Entry, filter_records_query(db.session.query(
+			Entry.id, Entry.user_id, Entry.text, Entry.date, Entry.time, Entry.calories, Entry.is_below_expected
+		), date, text, calories_min, calories_max)
+	ranked = query.add_columns(
+		db.func.row_number().over(partition_by=source.user_id, order_by=(source.date, source.time, source.id)).label('row_number'),
+		db.func.count().over(partition_by=source.user_id).label('total_count')
+	).subquery()
+
+	page_condition = ranked.c.row_number > offset
+	if limit != None:
+		page_condition = db.and_(page_condition, ranked.c.row_number <= offset + limit)
+	# Users without records on this page still appear, with no entries
+	query = db.select(User.username, ranked) \
+		.select_from(User) \
+		.outerjoin(ranked, db.and_(ranked.c.user_id == User.id, page_condition)) \
+		.where(User.role != 'manager') \
+		.order_by(User.id, ranked.c.row_number) \
+		.execution_options(yield_per=1000)
+
+	for row in db.session.execute(query):
+		yield row.username, (row if row.id is not None else None), row.total_count
+
 app = Flask(__name__)
 if os.getenv('FLASK_ENV') == 'test':
 	app.config.from_object(TestConfig)
+elif os.getenv('FLASK_ENV') == 'production':
+	app.config.from_object(ProductionConfig)
 else:
 	app.config.from_object(Config)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 db.init_app(app)
+with app.app_context():
+	configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
 
 login_manager = LoginManager(app)
+app.after_request(versions.tag_response)
+metrics.init_app(app)
+profiling.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-	return User.query.get(int(user_id))
+	return identity.load(int(user_id))
 
 # Routes and other application logic go here
 @app.route('/')
@@ -61,8 +213,19 @@ def login():
 
 	# Retrieve the user from the database based on the username
 	user = User.query.filter_by(username=username).first()
+	try:
+		valid = user is not None and hashing.verify_password(user.password_hash, password)
+	except hashing.HashingBusy:
+		abort(503)
  
-	if user and user.check_password(password):
+	if valid:
+		if hashing.needs_rehash(user.password_hash):
+			# The hash parameters changed since this password was stored, re-hash it while it is known
+			try:
+				user.password_hash = hashing.hash_password(password)
+				db.session.commit()
+			except hashing.HashingBusy:
+				pass
 		# If the user exists and the password is correct, log in the user
 		login_user(user)
 		# Rest of the login logic
@@ -100,11 +263,15 @@ def signup():
 			})
   
 		# Create a new user object
-		new_user = User(username=username, expected_calories=expected_calories, role='user')
-		new_user.set_password(password)
+		try:
+			password_hash = hashing.hash_password(password)
+		except hashing.HashingBusy:
+			abort(503)
+		new_user = User(username=username, expected_calories=expected_calories, role='user', password_hash=password_hash)
 
 		# Add the new user to the database
 		db.session.add(new_user)
+		versions.users_changed()
 		db.session.commit()
 
 		return jsonify({
@@ -115,6 +282,7 @@ def signup():
 
 @app.route('/users', methods=['GET'])
 @login_required
+@routing.read_only
 def get_users():
 	try:
 		data = request.get_json()
@@ -139,32 +307,53 @@ def get_users():
 		limit = int(data['limit']) if 'limit' in data else None
 	except:
 		abort(400)
+	# Passing 'cursor' (null for the first page) selects keyset pagination on the user id
+	cursor_mode = 'cursor' in data
+	with_total = bool(data['with_total']) if 'with_total' in data else not cursor_mode
 
-	# Calculate the offset and limit for pagination
-	offset = ((page - 1) * limit) if (page != None and limit != None) else None
-	# Apply pagination to the query
-	records_query = base_query.offset(offset).limit(limit)
-	# Retrieve the records from the database
-	records = records_query.all()
+	# Only allow access if user's role is manager or admin
+	if (current_user.role not in { 'manager', 'admin' }):
+		abort(403)
+	not_modified = versions.conditional(versions.USERS)
+	if not_modified:
+		return not_modified
+
+	base_query = base_query.order_by(User.id)
+	next_cursor = None
+	if cursor_mode:
+		records_query = base_query
+		if data['cursor']:
+			try:
+				last_id, = decode_cursor(data['cursor'])
+				records_query = records_query.filter(User.id > int(last_id))
+			except (ValueError, TypeError, AttributeError):
+				abort(400)
+		# Fetch one extra row to know whether there is a next page
+		records = records_query.limit(limit + 1 if limit != None else None).all()
+		if limit != None and len(records) > limit:
+			records = records[:limit]
+			next_cursor = encode_cursor(records[-1].id)
+	else:
+		# Calculate the offset and limit for pagination
+		offset = ((page - 1) * limit) if (page != None and limit != None) else None
+		# Apply pagination to the query
+		records_query = base_query.offset(offset).limit(limit)
+		# Retrieve the records from the database
+		records = records_query.all()
 	# Get the total count of records for pagination
-	total_count = base_query.count()
+	total_count = base_query.order_by(None).count() if with_total else None
  
-	if role:
-		if (current_user.role not in { 'manager', 'admin' }):
-			abort(403)
-		res = { 'users' : [], 'managers' : [], 'admins' : [] }
-		for user in records:
-			res[user.role + 's'].append({ 'user_id': user.id, 'username': user.username, 'expected_calories': user.expected_calories})
-		return jsonify({ 'success': True, 'users': res, 'total_count': total_count, 'page': page, 'limit': limit })
-
-	# Only allow access if user's role is manager or admin
-	if (current_user.role == 'manager' or current_user.role == 'admin'):
-		res = { 'users' : [], 'managers' : [], 'admins' : [] }
-		for user in records:
-			res[user.role + 's'].append({ 'user_id': user.id, 'username': user.username, 'expected_calories': user.expected_calories})
-		return jsonify({ 'success': True, 'users': res, 'total_count': total_count, 'page': page, 'limit': limit })
+	res = { 'users' : [], 'managers' : [], 'admins' : [] }
+	for user in records:
+		res[user.role + 's'].append({ 'user_id': user.id, 'username': user.username, 'expected_calories': user.expected_calories})
+	response = { 'success': True, 'users': res, 'limit': limit }
+	if cursor_mode:
+		response['next_cursor'] = next_cursor
 	else:
-		abort(403)
+		response['page'] = page
+	if with_total:
+		response['total_count'] = total_count
+	return jsonify(response)
   
 @app.route('/users', methods=['PUT'])
 @login_required
@@ -177,7 +366,12 @@ def post_users():
 			user_id = data['user_id']
 		user = User.query.filter_by(id=user_id).first()
 		user.expected_calories = expected_calories
+		# Every flag of this user depends on the target
+		recompute_user(user.id)
+		versions.users_changed()
+		versions.entries_changed(user.id)
 		db.session.commit()
+		identity.invalidate(user.id)
 		return jsonify({
 			'success': True,
 			'message': 'Expected calories updated'
@@ -202,7 +396,9 @@ def post_users():
 			# Update the user's role with the new value
 			previous_role = user.role
 			user.role = role
+			versions.users_changed()
 			db.session.commit()
+			identity.invalidate(user.id)
 			return jsonify({
 				'success': True,
 				'username': username,
@@ -218,6 +414,15 @@ def post_users():
 			})
 	abort(400)
 
+def deletion_job_response(job):
+	return {
+		'success': True,
+		'job_id': job['id'],
+		'username': job['username'],
+		'status': job['status'],
+		'deleted_entries': job['deleted_entries']
+	}
+
 @app.route('/users', methods=['DELETE'])
 @login_required
 def delete_users():
@@ -226,13 +431,17 @@ def delete_users():
 		username = data['username']
 	except:
 		abort(400)
+	# Passing 'background': true deletes the user on a worker thread and returns 202 with a job ID
+	background = bool(data.get('background'))
 	if current_user.username == username:
 		if (current_user.username == 'admin'):
 			abort(400)
 		user = User.query.filter_by(username=username).first()
 		logout_user()
-		db.session.delete(user)
-		db.session.commit()
+		if background:
+			job = user_deletion.submit(app, user)
+			return jsonify({ **deletion_job_response(job), 'message': 'Deletion started' }), 202
+		user_deletion.delete_user(user.id, app.config['USER_DELETE_CHUNK_SIZE'])
 		return jsonify({
 			'success': True,
 			'message': 'Successfully deleted'
@@ -243,12 +452,15 @@ def delete_users():
 		if user:
 			if (current_user.role == 'manager' and user.role in {'manager', 'admin'}):
 				abort(403)
-			db.session.delete(user)
-			db.session.commit()
+			if background:
+				job = user_deletion.submit(app, user)
+				return jsonify({ **deletion_job_response(job), 'message': f'Deletion of user {user.username} started' }), 202
+			username = user.username
+			user_deletion.delete_user(user.id, app.config['USER_DELETE_CHUNK_SIZE'])
 			return jsonify({
 				'success': True,
-				'username': user.username,
-				'message': f'User {user.username} successfully deleted'
+				'username': username,
+				'message': f'User {username} successfully deleted'
 			})
 		else: return jsonify({
 			'success': False,
@@ -258,6 +470,16 @@ def delete_users():
 	else:
 		abort(403)
 
+@app.route('/users/deletions/<job_id>', methods=['GET'])
+@login_required
+def get_user_deletion(job_id):
+	if current_user.role not in {'manager', 'admin'}:
+		abort(403)
+	job = user_deletion.get_job(app, job_id)
+	if job is None:
+		abort(404)
+	return jsonify(deletion_job_response(job))
+
 @app.route('/logout', methods=['POST'])
 @login_required
 def logout():
@@ -279,8 +501,32 @@ def session():
 		'role': user.role
 	})
 	
+def list_user_records(user_id, date, text, calories_min, calories_max, page, limit, cursor_mode, cursor, with_total):
+	if cursor_mode:
+		try:
+			records, total_count, next_cursor = get_keyset_filtered_records(user_id, date, text, calories_min, calories_max, cursor, limit, with_total)
+		except (ValueError, TypeError):
+			abort(400)
+	else:
+		records, total_count = get_paginated_filtered_records(user_id, date, text, calories_min, calories_max, page, limit, with_total)
+
+	formatter = RecordFormatter()
+	response = {
+		'success': True,
+		'records': formatter.records(records),
+		'limit': limit
+	}
+	if cursor_mode:
+		response['next_cursor'] = next_cursor
+	else:
+		response['page'] = page
+	if with_total:
+		response['total_count'] = total_count
+	return formatter.response(response)
+
 @app.route('/records', methods=['GET'])
 @login_required
+@routing.read_only
 def get_records():
 	data = request.get_json()
 	# Get the query parameters for filtering
@@ -298,100 +544,189 @@ def get_records():
 	try:
 		page = int(data['page']) if 'page' in data else None
 		limit = int(data['limit']) if 'limit' in data else None
+		# Admins may list the records of one user, parsed once so the listing and its ETag agree
+		user_id = int(data['user_id']) if current_user.role == 'admin' and data.get('user_id') else None
 	except:
 		abort(400)
+	# Passing 'cursor' (null for the first page) selects keyset pagination
+	cursor_mode = 'cursor' in data
+	cursor = data['cursor'] if cursor_mode else None
+	# total_count is computed by default for page/limit requests only
+	with_total = bool(data['with_total']) if 'with_total' in data else not cursor_mode
+
+	# Answer from the data version alone when the client's copy is current
+	if current_user.role == 'user':
+		scopes = (versions.user_scope(current_user.id),)
+	elif current_user.role == 'admin' and user_id and not data.get('id'):
+		scopes = (versions.user_scope(user_id),)
+	else:
+		scopes = (versions.ENTRIES, versions.USERS)
+	if current_user.role in { 'user', 'admin' }:
+		not_modified = versions.conditional(*scopes)
+		if not_modified:
+			return not_modified
 
 	if current_user.role == 'user':
 		# For users with the 'user' role, retrieve their own records
 		user_id = current_user.id
   
-		records, total_count = get_paginated_filtered_records(user_id, date, text, calories_min, calories_max, page, limit)
-
-		records_formatted = [{
-			'id': entry.id,
-			'text': entry.text,
-			'date': str(entry.date),
-			'time': str(entry.time),
-			'calories': entry.calories,
-			'is_below_expected': entry.is_below_expected
-		} for entry in records]
-
-		return jsonify({
-			'success': True, 
-			'records': records_formatted,
-			'total_count': total_count,
-			'page': page,
-			'limit': limit
-		})
+		return list_user_records(user_id, python_date, text, calories_min, calories_max, page, limit, cursor_mode, cursor, with_total)
 
 	elif current_user.role == 'admin':
-		user_id = data['user_id'] if 'user_id' in data else None
 		id = data['id'] if 'id' in data else None
 
 		if id:
-			entry = Entry.query.filter_by(id=id).first()
-			return jsonify({
+			entry = db.session.query(*RECORD_COLUMNS).filter(Entry.id == id).first()
+			formatter = RecordFormatter()
+			return formatter.response({
 				'success': True, 
-				'records': ({
-					'id': entry.id,
-					'text': entry.text,
-					'date': str(entry.date),
-					'time': str(entry.time),
-					'calories': entry.calories,
-					'is_below_expected': entry.is_below_expected
-				} if entry else {})
+				'records': formatter.record(entry) if entry else {}
 			})
 
 		if user_id:
-			records, total_count = get_paginated_filtered_records(user_id, date, text, calories_min, calories_max, page, limit)
-
-			records_formatted = [{
-				'id': entry.id,
-				'text': entry.text,
-				'date': str(entry.date),
-				'time': str(entry.time),
-				'calories': entry.calories,
-				'is_below_expected': entry.is_below_expected
-			} for entry in records]
+			return list_user_records(user_id, python_date, text, calories_min, calories_max, page, limit, cursor_mode, cursor, with_total)
 
-			return jsonify({
-				'success': True,
-				'records': records_formatted,
-				'total_count': total_count,
-				'page': page,
-				'limit': limit
-			})
+		# Keyset pagination is per user, so it needs a user_id
+		if cursor_mode:
+			abort(400)
    
 		# For users with the 'admin' role, retrieve records of all users
-		users = User.query.all()
 		user_records = {}
+		formatter = RecordFormatter()
   
-		for user in users:
-			if (user.role == 'manager'):
+		for username, entry, total_count in iter_paginated_filtered_records_by_user(python_date, text, calories_min, calories_max, page, limit):
+			records_formatted = user_records.setdefault(username, [])
+			if entry is None:
 				continue
    
-			records, total_count = get_paginated_filtered_records(user.id, date, text, calories_min, calories_max, page, limit)
-   
-			records_formatted = [{
-				'id': entry.id,
-				'text': entry.text,
-				'date': str(entry.date),
-				'time': str(entry.time),
-				'calories': entry.calories,
-				'is_below_expected': entry.is_below_expected,
-				'page': page,
-				'total_count': total_count,
-				'limit': limit
-			} for entry in records]
-			user_records[user.username] = records_formatted
+			record = formatter.record(entry)
+			record['page'] = page
+			record['total_count'] = total_count
+			record['limit'] = limit
+			records_formatted.append(record)
    
-		return jsonify({
+		return formatter.response({
 			'success': True, 
 			'records': user_records
 		})
 	else:
 		# For unauthorized users, return a 403 Forbidden error
 		return abort(403)
+
+EXPORT_COLUMNS = ['id', 'user_id', 'username', 'date', 'time', 'text', 'calories', 'is_below_expected']
+
+@app.route('/records/export', methods=['GET'])
+@login_required
+def export_records():
+	try:
+		data = request.get_json()
+	except:
+		data = {}
+	# Get the query parameters for filtering
+	date = data['date'] if 'date' in data else None
+	text = data['text'] if 'text' in data else None
+	calories_min = data['calories_min'] if 'calories_min' in data else None
+	calories_max = data['calories_max'] if 'calories_max' in data else None
+	export_format = data['format'] if 'format' in data else 'ndjson'
+	if export_format not in { 'ndjson', 'csv' }:
+		abort(400)
+	try:
+		python_date = datetime.strptime(date, '%Y-%m-%d').date() if date else None
+	except:
+		abort(400)
+
+	if current_user.role == 'user':
+		user_id = current_user.id
+	elif current_user.role == 'admin':
+		user_id = data['user_id'] if 'user_id' in data else None
+	else:
+		abort(403)
+	# Archived records are part of the export
+	records = tiered_records(user_id, python_date, text, calories_min, calories_max, fields=('id', 'user_id', 'date', 'time', 'text', 'calories', 'is_below_expected'))
+	base_query = db.session.query(
+		records.c.id, records.c.user_id, User.username, records.c.date, records.c.time, records.c.text, records.c.calories, records.c.is_below_expected
+	).join(User, User.id == records.c.user_id)
+	if user_id is None:
+		base_query = base_query.filter(User.role != 'manager')
+	# Rows are streamed from a server-side cursor, memory use does not grow with history
+	export_query = base_query \
+		.order_by(records.c.user_id, records.c.date, records.c.time, records.c.id) \
+		.yield_per(1000)
+
+	def generate_ndjson():
+		for row in export_query:
+			record = dict(zip(EXPORT_COLUMNS, row))
+			record['date'] = str(record['date'])
+			record['time'] = str(record['time'])
+			yield json.dumps(record) + '\n'
+
+	def generate_csv():
+		buffer = io.StringIO()
+		writer = csv.writer(buffer)
+		writer.writerow(EXPORT_COLUMNS)
+		for count, row in enumerate(export_query, 1):
+			writer.writerow(row)
+			# Flush the buffer every 1000 rows
+			if count % 1000 == 0:
+				yield buffer.getvalue()
+				buffer.seek(0)
+				buffer.truncate()
+		yield buffer.getvalue()
+
+	if export_format == 'csv':
+		response = Response(stream_with_context(generate_csv()), mimetype='text/csv')
+	else:
+		response = Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+	response.headers['Content-Disposition'] = f'attachment; filename=records.{export_format}'
+	return response
+
+@app.route('/records/daily', methods=['GET'])
+@login_required
+@routing.read_only
+def get_daily_records():
+	try:
+		data = request.get_json()
+	except:
+		data = {}
+
+	# Get the query parameters for filtering
+	date_from = data['date_from'] if 'date_from' in data else None
+	date_to = data['date_to'] if 'date_to' in data else None
+	try:
+		python_date_from = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None
+		python_date_to = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+	except:
+		abort(400)
+
+	if current_user.role == 'user':
+		user_id = current_user.id
+	elif current_user.role == 'admin':
+		user_id = data['user_id'] if 'user_id' in data else current_user.id
+	else:
+		abort(403)
+
+	user = User.query.filter_by(id=user_id).first()
+	if not user:
+		return jsonify({
+			'success': False,
+			'error': 400,
+			'message': 'User does not exist'
+		})
+
+	# Days of archived records are summed from entry_archive
+	days = [{
+		'date': str(day),
+		'total_calories': total_calories,
+		'entry_count': entry_count,
+		'is_below_expected': total_calories < user.expected_calories
+	} for day, total_calories, entry_count in reports.daily_totals(user, python_date_from, python_date_to)]
+
+	return jsonify({
+		'success': True,
+		'user_id': user.id,
+		'expected_calories': user.expected_calories,
+		'days': days
+	})
  
 @app.route('/records', methods=['POST'])
 @login_required
@@ -405,9 +740,35 @@ def post_records():
 				user_id = data['user_id']
 		if 'text' not in data:
 			abort(400)
+		if 'calories' in data and not is_calories(data['calories']):
+			abort(400)
+		if 'calories' not in data and data.get('async', app.config['CALORIE_RESOLUTION_ASYNC']):
+			# Store the record right away and let the background resolver fetch its calories
+			entry = Entry (
+				user_id = user_id,
+				date = datetime.now().date(),
+				time = datetime.now().time(),
+				text = data['text'],
+				calories = 0,
+				calorie_status = 'pending',
+			)
+			db.session.add(entry)
+			DailyTotal.apply(entry.user_id, entry.date, 0, 1)
+			versions.entries_changed(entry.user_id)
+			db.session.commit()
+			resolver.submit(app)
+			return jsonify({
+				'success': True,
+				'id': entry.id,
+				'calorie_status': entry.calorie_status,
+				'message': 'Added record, calories pending'
+			}), 202
 		if 'calories' not in data:
 			# If user does not provide calories, we fetch it from Nutrionix API
-			food_name, calories = get_calories(data['text'])
+			try:
+				food_name, calories = get_calories(data['text'])
+			except NutritionixUnavailable:
+				abort(503)
 			if food_name == None or calories == None:
 				return jsonify({
 					'success': False,
@@ -425,6 +786,8 @@ def post_records():
 			calories = data['calories'],
 		)
 		db.session.add(entry)
+		DailyTotal.apply(entry.user_id, entry.date, entry.calories, 1)
+		versions.entries_changed(entry.user_id)
 		db.session.commit()
 		return jsonify({
 			'success': True,
@@ -433,6 +796,146 @@ def post_records():
 	else:
 		abort(403)
 
+@app.route('/records/batch', methods=['POST'])
+@login_required
+def post_records_batch():
+	user = current_user
+	if user.role == 'user' or user.role == 'admin':
+		data = request.get_json()
+		try:
+			items = list(data['records'])
+		except:
+			abort(400)
+		if not items or len(items) > app.config['RECORDS_BATCH_LIMIT']:
+			abort(400)
+
+		now = datetime.now()
+		rows = []
+		for item in items:
+			try:
+				user_id = user.id
+				if user.role == 'admin':
+					user_id = int(item.get('user_id', data.get('user_id', user.id)))
+				if 'calories' in item and not is_calories(item['calories']):
+					raise ValueError('calories must be a number')
+				# Same rules as the importer: a non-empty string, cut to the column size
+				if not isinstance(item['text'], str) or not item['text'].strip():
+					raise ValueError('text must be a non-empty string')
+				rows.append({
+					'user_id': user_id,
+					'date': datetime.strptime(item['date'], '%Y-%m-%d').date() if 'date' in item else now.date(),
+					'time': time.fromisoformat(item['time']) if 'time' in item else now.time(),
+					'text': item['text'].strip()[:256],
+					'calories': item['calories'] if 'calories' in item else None,
+					'calorie_status': 'resolved'
+				})
+			except:
+				abort(400)
+
+		# Look up each distinct food without calories once, concurrently
+		missing = [row['text'] for row in rows if row['calories'] is None]
+		if missing:
+			results = resolver.lookup_calories(app, missing)
+			if any(isinstance(result, NutritionixUnavailable) for result in results.values()):
+				abort(503)
+			unknown = []
+			for index, row in enumerate(rows):
+				if row['calories'] is None:
+					food_name, calories = results[normalize_query(row['text'])]
+					if calories is None:
+						unknown.append(index)
+					else:
+						row['text'] = food_name
+						row['calories'] = calories
+			if unknown:
+				return jsonify({
+					'success': False,
+					'error': 422,
+					'message': 'Calorie data not provided and food item does not exist on Nutritionix database',
+					'records': unknown
+				})
+
+		# Insert everything with one executemany, then update each affected day once
+		db.session.execute(db.insert(Entry), rows)
+		totals = {}
+		for row in rows:
+			calories, count = totals.get((row['user_id'], row['date']), (0, 0))
+			totals[(row['user_id'], row['date'])] = (calories + row['calories'], count + 1)
+		for (user_id, day), (calories, count) in totals.items():
+			DailyTotal.apply(user_id, day, calories, count)
+		recompute_days(totals.keys())
+		versions.entries_changed(*{ user_id for user_id, day in totals })
+		db.session.commit()
+		return jsonify({
+			'success': True,
+			'count': len(rows),
+			'message': 'Added records'
+		})
+	else:
+		abort(403)
+
+@app.route('/records/import', methods=['POST'])
+@login_required
+def import_records():
+	user = current_user
+	if user.role == 'user' or user.role == 'admin':
+		user_id = user.id
+		if user.role == 'admin' and 'user_id' in request.args:
+			try:
+				user_id = int(request.args['user_id'])
+			except:
+				abort(400)
+			if not User.query.filter_by(id=user_id).first():
+				abort(400)
+
+		# Accept a multipart upload named 'file' or the raw request body
+		if 'file' in request.files:
+			upload = request.files['file']
+			stream = upload.stream
+			default_format = importer.format_from_filename(upload.filename or '')
+		else:
+			stream = request.stream
+			default_format = 'ndjson' if 'ndjson' in (request.mimetype or '') else 'csv'
+		import_format = request.args.get('format', default_format)
+		if import_format not in { 'csv', 'ndjson' }:
+			abort(400)
+
+		summary = importer.import_records(
+			importer.text_stream(stream), import_format, user_id, app.config['IMPORT_CHUNK_SIZE']
+		)
+		return jsonify(dict(summary,
+			success=True,
+			message=f'Imported {summary["imported"]} records'
+		))
+	else:
+		abort(403)
+
+@app.route('/records/status', methods=['GET'])
+@login_required
+def get_records_status():
+	user = current_user
+	if user.role == 'user' or user.role == 'admin':
+		data = request.get_json()
+		try:
+			ids = [int(id) for id in data['ids']]
+		except:
+			abort(400)
+		status_query = db.session.query(Entry.id, Entry.calorie_status, Entry.calories, Entry.text) \
+			.filter(Entry.id.in_(ids))
+		if user.role == 'user':
+			status_query = status_query.filter(Entry.user_id == user.id)
+		return jsonify({
+			'success': True,
+			'records': [{
+				'id': id,
+				'calorie_status': calorie_status,
+				'calories': calories,
+				'text': text
+			} for id, calorie_status, calories, text in status_query.all()]
+		})
+	else:
+		abort(403)
+
 @app.route('/records', methods=['DELETE'])
 @login_required
 def delete_records():
@@ -450,7 +953,11 @@ def delete_records():
 			})
 		if user.role == 'user' and user.id != record.user_id:
 			abort(403)
+		DailyTotal.apply(record.user_id, record.date, -record.calories, -1)
 		db.session.delete(record)
+		# Later entries of the same day no longer count this record
+		recompute_day(record.user_id, record.date)
+		versions.entries_changed(record.user_id)
 		db.session.commit()
 		return jsonify({
 			'success': True,
@@ -476,16 +983,113 @@ def put_records():
 			})
 		if user.role == 'user' and user.id != record.user_id:
 			abort(403)
+		if 'calories' in data and not is_calories(data['calories']):
+			abort(400)
 		if 'calories' in data:
+			DailyTotal.apply(record.user_id, record.date, data['calories'] - record.calories, 0)
 			record.calories = data['calories']
+			# Calories given by the user settle a pending record, the resolver's claim then skips it
+			record.calorie_status = 'resolved'
+			# This record and the later ones of the same day depend on its calories
+			recompute_day(record.user_id, record.date)
 		if 'text' in data:
 			record.text = data['text']
+		versions.entries_changed(record.user_id)
 		db.session.commit()
 		return jsonify({
 			'success': True,
 			'message': 'Successfully modified'
 		})
 
+@app.route('/reports', methods=['GET'])
+@login_required
+@routing.read_only
+def get_reports():
+	try:
+		data = request.get_json()
+	except:
+		data = {}
+
+	# Get the reporting range and grouping, the last 30 days by day by default
+	granularity = data['granularity'] if 'granularity' in data else 'day'
+	if granularity not in reports.GRANULARITIES:
+		abort(400)
+	try:
+		python_date_to = datetime.strptime(data['date_to'], '%Y-%m-%d').date() if 'date_to' in data else date.today()
+		python_date_from = datetime.strptime(data['date_from'], '%Y-%m-%d').date() if 'date_from' in data else python_date_to - timedelta(days=29)
+		top = int(data['top']) if 'top' in data else 5
+		page = int(data['page']) if 'page' in data else None
+		limit = int(data['limit']) if 'limit' in data else None
+	except:
+		abort(400)
+	if python_date_from > python_date_to:
+		abort(400)
+
+	if current_user.role == 'user':
+		user_id = current_user.id
+	elif current_user.role == 'admin':
+		user_id = data['user_id'] if 'user_id' in data else None
+		if not user_id:
+			# For users with the 'admin' role, report totals of all users
+			return jsonify({
+				'success': True,
+				'date_from': str(python_date_from),
+				'date_to': str(python_date_to),
+				'users': reports.summarize_users(python_date_from, python_date_to, page, limit),
+				'page': page,
+				'limit': limit
+			})
+	else:
+		abort(403)
+
+	user = User.query.filter_by(id=user_id).first()
+	if not user:
+		return jsonify({
+			'success': False,
+			'error': 400,
+			'message': 'User does not exist'
+		})
+	report = reports.summarize_user(user, python_date_from, python_date_to, granularity, top)
+	return jsonify(dict(report,
+		success=True,
+		user_id=user.id,
+		expected_calories=user.expected_calories,
+		granularity=granularity,
+		date_from=str(python_date_from),
+		date_to=str(python_date_to)
+	))
+
+@app.route('/nutritionix/stats', methods=['GET'])
+@login_required
+def get_nutritionix_stats():
+	# Hit/miss counters of the Nutritionix lookup cache in this process
+	if current_user.role != 'admin':
+		abort(403)
+	return jsonify({
+		'success': True,
+		'cache': cache_stats()
+	})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+	# Prometheus scrape target, guarded by a bearer token instead of a login
+	if not app.config.get('METRICS_ENABLED', True):
+		abort(404)
+	token = app.config.get('METRICS_TOKEN')
+	if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+		abort(401)
+	return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles/<name>', methods=['GET'])
+@login_required
+def get_profile(name):
+	# Report of a profiled request, linked from its X-Profile-Report header
+	if not app.config.get('PROFILING_ENABLED'):
+		abort(404)
+	if current_user.role != 'admin':
+		abort(403)
+	return send_from_directory(app.config['PROFILE_DIR'], name + '.txt', mimetype='text/plain')
+
 """
 # ERROR HANDLING #
 
@@ -554,10 +1158,101 @@ def server_error(error):
 		'error': 500,
 		'message': 'Internal server error'
 	}), 500
+
+@app.errorhandler(503)
+def service_unavailable(error):
+	return jsonify({
+		'success': False,
+		'error': 503,
+		'message': 'Service unavailable'
+	}), 503
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+	"""Apply pending schema migrations to the configured database."""
+	version = upgrade(db.engine, progress=lambda number, description: print(f'Applied migration {number}: {description}'))
+	print(f'Database is at schema version {version}')
+
+@app.cli.command('resolve-pending')
+@click.option('--batch-size', default=100, show_default=True, help='Number of pending entries resolved per transaction.')
+def resolve_pending_records(batch_size):
+	"""Resolve calories of records left pending by the background resolver."""
+	settled = resolver.resolve_all_pending(app, batch_size, progress=lambda count: print(f'{count} entries resolved'))
+	print(f'Resolved {settled} pending entries')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+	"""Rebuild the full-text index over record text."""
+	with db.engine.begin() as connection:
+		if search.rebuild_search_index(connection):
+			print('Search index rebuilt')
+		else:
+			print('Full-text search is not available on this database, the text filter uses ILIKE')
+
+@app.cli.command('import-records')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, required=True, help='User the records belong to.')
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Number of rows inserted per transaction.')
+def import_records_command(path, user_id, import_format, chunk_size):
+	"""Stream historical records from a CSV or NDJSON file into the database."""
+	if not User.query.filter_by(id=user_id).first():
+		raise click.BadParameter(f'User {user_id} does not exist', param_hint='--user-id')
+	started = datetime.now()
+	with open(path, 'rb') as file:
+		summary = importer.import_records(
+			importer.text_stream(file), import_format or importer.format_from_filename(path), user_id, chunk_size,
+			progress=lambda count: print(f'{count} records imported')
+		)
+	seconds = (datetime.now() - started).total_seconds()
+	print(f'Imported {summary["imported"]} records ({summary["imported"] / max(seconds, 0.001):.0f}/s), rejected {summary["rejected"]}')
+	for error in summary['errors']:
+		print(error)
+
+@app.cli.command('rebuild-daily-totals')
+def rebuild_daily_totals():
+	"""Recompute the daily_total rollup from the entry table."""
+	db.create_all()
+	DailyTotal.rebuild()
+	versions.bump(versions.EPOCH)
+	db.session.commit()
+	print('Daily totals rebuilt')
+
+@app.cli.command('rebuild-flags')
+@click.option('--chunk-size', default=10000, show_default=True, help='Number of entry ids updated per transaction.')
+def rebuild_flags(chunk_size):
+	"""Recompute is_below_expected for every entry in bounded chunks."""
+	updated = rebuild_all_flags(chunk_size, progress=lambda count: print(f'{count} entries updated'))
+	versions.bump(versions.EPOCH)
+	db.session.commit()
+	print(f'Flags rebuilt for {updated} entries')
+
+@app.cli.command('archive-entries')
+@click.option('--horizon-days', type=int, help='Archive entries from before the month this many days ago. Defaults to ARCHIVE_HORIZON_DAYS.')
+@click.option('--chunk-size', default=10000, show_default=True, help='Number of entry ids moved per transaction.')
+def archive_entries(horizon_days, chunk_size):
+	"""Move old entries to entry_archive and roll them up per month."""
+	if horizon_days is None:
+		horizon_days = app.config['ARCHIVE_HORIZON_DAYS']
+	print(f'Archiving entries before {archive.archive_cutoff(horizon_days)}')
+	archived = archive.archive_entries(horizon_days, chunk_size, progress=lambda count: print(f'{count} entries archived'))
+	print(f'Archived {archived} entries')
+
+@app.cli.command('delete-user')
+@click.argument('username')
+@click.option('--chunk-size', type=int, help='Number of entries deleted per transaction. Defaults to USER_DELETE_CHUNK_SIZE.')
+def delete_user(username, chunk_size):
+	"""Delete a user and all of their records in short transactions."""
+	user = User.query.filter_by(username=username).first()
+	if user is None:
+		raise click.ClickException(f'User {username} does not exist')
+	deleted = user_deletion.delete_user(user.id, chunk_size or app.config['USER_DELETE_CHUNK_SIZE'], progress=lambda count: print(f'{count} entries deleted'))
+	print(f'Deleted user {username} and {deleted} entries')
  
 if __name__ == '__main__':
 	with app.app_context():
 		db.create_all()
+		upgrade(db.engine)
 		if not User.query.filter_by(username='admin').first():
 			new_user = User(username='admin', expected_calories=2000, role='admin')
 			new_user.set_password('admin')
@@ -0,0 +1,125 @@
+from datetime import date, timedelta
+from models import db, User, Entry, DailyTotal, ArchivedEntry, MonthlyTotal
+from reports import period_start, period_end, period_start_expression
+import versions
+
+"""
+# ARCHIVE TIER #
+
+'flask archive-entries' moves resolved entries dated before the archive
+cutoff (the first day of the month ARCHIVE_HORIZON_DAYS ago, so that whole
+months are archived) from entry to entry_archive, in id ranges of chunk_size
+rows with one transaction each. Every chunk takes its entries out of the
+daily_total rollup and rebuilds the monthly_total rows of the months it
+touched, so at every commit daily_total covers entry and monthly_total covers
+entry_archive.
+
+Reports and daily totals always read both tiers. Record listings and the
+admin listing read entry_archive as well when they filter on a date, the
+export always does; unfiltered listings only page through entry. Archived
+entries are read-only, and records added later for an archived day stay in
+entry until the next run moves them.
+
+"""
+
+ARCHIVE_COLUMNS = ('id', 'user_id', 'date', 'time', 'text', 'calories', 'is_below_expected', 'calorie_status')
+
+def archive_cutoff(horizon_days, today=None):
+	# First day of the month holding the horizon, entries before it are archived
+	return ((today or date.today()) - timedelta(days=horizon_days)).replace(day=1)
+
+def rebuild_monthly_totals(user_ids=None, date_from=None, date_to=None):
+	# Recompute monthly_total from entry_archive for the whole months holding date_from to date_to
+	criteria = []
+	month_criteria = []
+	if user_ids is not None:
+		criteria.append(ArchivedEntry.user_id.in_(user_ids))
+		month_criteria.append(MonthlyTotal.user_id.in_(user_ids))
+	if date_from is not None:
+		criteria.append(ArchivedEntry.date >= period_start(date_from, 'month'))
+		month_criteria.append(MonthlyTotal.month >= period_start(date_from, 'month'))
+	if date_to is not None:
+		criteria.append(ArchivedEntry.date <= period_end(period_start(date_to, 'month'), 'month'))
+		month_criteria.append(MonthlyTotal.month <= period_start(date_to, 'month'))
+
+	days = db.select(
+		ArchivedEntry.user_id,
+		ArchivedEntry.date,
+		db.func.sum(ArchivedEntry.calories).label('total_calories'),
+		db.func.count(ArchivedEntry.id).label('entry_count')
+	).where(*criteria).group_by(ArchivedEntry.user_id, ArchivedEntry.date).subquery()
+	month = period_start_expression(days.c.date, 'month')
+	months = db.select(
+		days.c.user_id,
+		month,
+		db.func.count(),
+		db.func.sum(days.c.entry_count),
+		db.func.sum(days.c.total_calories),
+		db.func.sum(db.case((days.c.total_calories >= User.expected_calories, 1), else_=0))
+	).join(User, User.id == days.c.user_id).group_by(days.c.user_id, month)
+
+	db.session.execute(db.delete(MonthlyTotal).where(*month_criteria))
+	db.session.execute(db.insert(MonthlyTotal).from_select(
+		['user_id', 'month', 'days_logged', 'entry_count', 'total_calories', 'days_over_budget'], months
+	))
+
+def _archive_chunk(criteria):
+	# Move the entries matching criteria, returns how many were moved
+	touched = db.session.execute(
+		db.select(Entry.user_id, db.func.min(Entry.date), db.func.max(Entry.date))
+		.where(*criteria)
+		.group_by(Entry.user_id)
+	).all()
+	if not touched:
+		return 0
+	user_ids = [user_id for user_id, first, last in touched]
+
+	# Take the moved entries out of the hot rollup while they are still in entry
+	moved = db.select(
+		Entry.user_id,
+		Entry.date,
+		db.func.sum(Entry.calories).label('calories'),
+		db.func.count(Entry.id).label('entries')
+	).where(*criteria).group_by(Entry.user_id, Entry.date).subquery()
+	db.session.execute(
+		db.update(DailyTotal)
+		.where(DailyTotal.user_id == moved.c.user_id, DailyTotal.date == moved.c.date)
+		.values(
+			total_calories=DailyTotal.total_calories - moved.c.calories,
+			entry_count=DailyTotal.entry_count - moved.c.entries
+		)
+		.execution_options(synchronize_session=False)
+	)
+	db.session.execute(
+		db.insert(ArchivedEntry).from_select(
+			ARCHIVE_COLUMNS, db.select(*(getattr(Entry, name) for name in ARCHIVE_COLUMNS)).where(*criteria)
+		)
+	)
+	count = db.session.execute(db.delete(Entry).where(*criteria).execution_options(synchronize_session=False)).rowcount
+	first = min(first for user_id, first, last in touched)
+	last = max(last for user_id, first, last in touched)
+	db.session.execute(
+		db.delete(DailyTotal)
+		.where(DailyTotal.user_id.in_(user_ids), DailyTotal.date <= last, DailyTotal.entry_count <= 0)
+		.execution_options(synchronize_session=False)
+	)
+	rebuild_monthly_totals(user_ids, first, last)
+	versions.entries_changed(*user_ids)
+	return count
+
+def archive_entries(horizon_days, chunk_size=10000, today=None, progress=None):
+	# Archive entries before archive_cutoff(horizon_days) in id ranges, committing after each range
+	cutoff = archive_cutoff(horizon_days, today)
+	eligible = (Entry.date < cutoff, Entry.calorie_status == 'resolved')
+	low, high = db.session.execute(db.select(db.func.min(Entry.id), db.func.max(Entry.id)).where(*eligible)).one()
+	if low is None:
+		return 0
+
+	# Archived ids are not handed out again: entry ids are AUTOINCREMENT on SQLite (migration 10)
+	archived = 0
+	for start in range(low, high + 1, chunk_size):
+		archived += _archive_chunk(eligible + (Entry.id >= start, Entry.id < start + chunk_size))
+		db.session.commit()
+		if progress:
+			progress(archived)
+	return archived
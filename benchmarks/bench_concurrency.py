@@ -0,0 +1,159 @@
+"""
+Benchmark concurrent reads and writes on SQLite from several worker processes.
+
+Seeds a temporary database, then runs N worker processes for a fixed time,
+each mixing records listing reads with POST /records style writes (insert an
+entry and update its daily total in one transaction). Every profile is measured
+on a fresh copy of the database: 'default' uses SQLite's defaults, 'production'
+applies the SQLITE_PRAGMAS of ProductionConfig. Reports reads and writes per
+second and how many operations failed with "database is locked".
+
+	python benchmarks/bench_concurrency.py --workers 8 --seconds 10 --write-ratio 0.2
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time as timer
+from datetime import date, time, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from models import db, Entry, DailyTotal
+from config import ProductionConfig
+from pragmas import configure_sqlite
+
+PROFILES = {
+	'default': {},
+	'production': ProductionConfig.SQLITE_PRAGMAS,
+}
+
+FOODS = ['banana', 'coffee', 'oatmeal', 'chicken salad', 'pasta', 'apple', 'rice', 'yogurt']
+
+def seed(path, rows, users):
+	engine = create_engine('sqlite:///' + path)
+	db.metadata.create_all(engine)
+	connection = engine.raw_connection()
+	cursor = connection.cursor()
+	cursor.executemany(
+		'INSERT INTO user (id, username, password_hash, role, expected_calories) VALUES (?, ?, ?, ?, ?)',
+		((i, f'user{i}', '-', 'user', 2000) for i in range(1, users + 1))
+	)
+	start = date(2020, 1, 1)
+	generator = random.Random(42)
+	cursor.executemany(
+		'INSERT INTO entry (user_id, date, time, text, calories, is_below_expected, calorie_status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+		((
+			generator.randint(1, users),
+			str(start + timedelta(days=generator.randint(0, 1500))),
+			str(time(generator.randint(0, 23), generator.randint(0, 59))),
+			generator.choice(FOODS),
+			generator.randint(20, 1200),
+			True,
+			'resolved'
+		) for _ in range(rows))
+	)
+	connection.commit()
+	connection.close()
+	with engine.begin() as connection:
+		DailyTotal.rebuild(connection=connection)
+	engine.dispose()
+
+def read(connection, user_id):
+	# First page of GET /records
+	connection.execute(
+		db.select(Entry).where(Entry.user_id == user_id).order_by(Entry.date, Entry.time, Entry.id).limit(10)
+	).fetchall()
+	connection.rollback()
+
+def write(connection, user_id, generator):
+	# Same statements as POST /records with calories given
+	today = date.today()
+	calories = generator.randint(20, 1200)
+	connection.execute(db.insert(Entry).values(
+		user_id=user_id, date=today, time=time(12, 0), text=generator.choice(FOODS), calories=calories
+	))
+	updated = connection.execute(
+		db.update(DailyTotal)
+		.where(DailyTotal.user_id == user_id, DailyTotal.date == today)
+		.values(total_calories=DailyTotal.total_calories + calories, entry_count=DailyTotal.entry_count + 1)
+	).rowcount
+	if not updated:
+		connection.execute(db.insert(DailyTotal).values(user_id=user_id, date=today, total_calories=calories, entry_count=1))
+	connection.commit()
+
+def worker(path, pragmas, users, seconds, write_ratio, seed_value, start, results):
+	engine = create_engine('sqlite:///' + path)
+	configure_sqlite(engine, pragmas)
+	generator = random.Random(seed_value)
+	counts = { 'reads': 0, 'writes': 0, 'locked': 0 }
+	with engine.connect() as connection:
+		start.wait()
+		deadline = timer.perf_counter() + seconds
+		while timer.perf_counter() < deadline:
+			user_id = generator.randint(1, users)
+			try:
+				if generator.random() < write_ratio:
+					write(connection, user_id, generator)
+					counts['writes'] += 1
+				else:
+					read(connection, user_id)
+					counts['reads'] += 1
+			except OperationalError as error:
+				if 'locked' not in str(error):
+					raise
+				counts['locked'] += 1
+				connection.rollback()
+	engine.dispose()
+	results.put(counts)
+
+def measure(path, pragmas, args):
+	start = multiprocessing.Barrier(args.workers)
+	results = multiprocessing.Queue()
+	processes = [
+		multiprocessing.Process(target=worker, args=(path, pragmas, args.users, args.seconds, args.write_ratio, number, start, results))
+		for number in range(args.workers)
+	]
+	for process in processes:
+		process.start()
+	totals = { 'reads': 0, 'writes': 0, 'locked': 0 }
+	for _ in processes:
+		for key, value in results.get(timeout=args.seconds + 60).items():
+			totals[key] += value
+	for process in processes:
+		process.join()
+	return totals
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--rows', type=int, default=200000)
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--workers', type=int, default=4)
+	parser.add_argument('--seconds', type=float, default=10)
+	parser.add_argument('--write-ratio', type=float, default=0.2)
+	parser.add_argument('--profile', choices=['both'] + list(PROFILES), default='both')
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		seeded = os.path.join(directory, 'seed.db')
+		started = timer.perf_counter()
+		seed(seeded, args.rows, args.users)
+		print(f'Seeded {args.rows} entries for {args.users} users in {timer.perf_counter() - started:.1f} s')
+		print(f'{args.workers} workers, {args.seconds:g} s, {args.write_ratio:.0%} writes\n')
+		print(f'{"profile":<12} {"reads/s":>10} {"writes/s":>10} {"locked":>8}')
+
+		for name, pragmas in PROFILES.items():
+			if args.profile not in ('both', name):
+				continue
+			path = os.path.join(directory, f'{name}.db')
+			shutil.copyfile(seeded, path)
+			totals = measure(path, pragmas, args)
+			print(f'{name:<12} {totals["reads"] / args.seconds:>10.0f} {totals["writes"] / args.seconds:>10.0f} {totals["locked"]:>8}')
+
+if __name__ == '__main__':
+	main()
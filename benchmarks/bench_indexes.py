@@ -0,0 +1,120 @@
+"""
+Benchmark the records listing queries before and after the entry indexes.
+
+Seeds a temporary SQLite database with the pre-index schema, prints the query
+plan and median latency of each listing query, applies the schema migrations
+and measures again.
+
+	python benchmarks/bench_indexes.py --rows 1000000 --users 1000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time as timer
+from datetime import date, time, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine, event
+from models import db, Entry
+from migrations import upgrade
+
+def seed(engine, rows, users):
+	db.metadata.create_all(engine)
+	# Start from the schema as it was before the indexes existed
+	with engine.begin() as connection:
+		for index in Entry.__table__.indexes:
+			index.drop(connection)
+
+	connection = engine.raw_connection()
+	cursor = connection.cursor()
+	cursor.executemany(
+		'INSERT INTO user (id, username, password_hash, role, expected_calories) VALUES (?, ?, ?, ?, ?)',
+		((i, f'user{i}', '-', 'user', 2000) for i in range(1, users + 1))
+	)
+	foods = ['banana', 'coffee', 'oatmeal', 'chicken salad', 'pasta', 'apple', 'rice', 'yogurt']
+	start = date(2020, 1, 1)
+	generator = random.Random(42)
+	cursor.executemany(
+		'INSERT INTO entry (user_id, date, time, text, calories, is_below_expected) VALUES (?, ?, ?, ?, ?, ?)',
+		((
+			generator.randint(1, users),
+			str(start + timedelta(days=generator.randint(0, 1500))),
+			str(time(generator.randint(0, 23), generator.randint(0, 59))),
+			generator.choice(foods),
+			generator.randint(20, 1200),
+			True
+		) for _ in range(rows))
+	)
+	connection.commit()
+	connection.close()
+
+def queries(user_id):
+	# Same statement shapes as get_paginated_filtered_records
+	by_user = db.select(Entry).where(Entry.user_id == user_id)
+	by_date = by_user.where(Entry.date == date(2021, 6, 1))
+	by_calories = by_user.where(Entry.calories >= 900, Entry.calories <= 1000)
+	return {
+		'user page': by_user.limit(10).offset(0),
+		'user count': db.select(db.func.count()).select_from(by_user.subquery()),
+		'user+date page': by_date.limit(10).offset(0),
+		'user+calories page': by_calories.limit(10).offset(0),
+		'user+calories count': db.select(db.func.count()).select_from(by_calories.subquery()),
+	}
+
+def measure(engine, user_id, repeat):
+	captured = []
+	def capture(conn, cursor, statement, parameters, context, executemany):
+		captured.append((statement, parameters))
+	event.listen(engine, 'before_cursor_execute', capture)
+
+	results = {}
+	with engine.connect() as connection:
+		for name, statement in queries(user_id).items():
+			captured.clear()
+			connection.execute(statement).fetchall()
+			sql, parameters = captured[0]
+			plan = [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, parameters)]
+			timings = []
+			for _ in range(repeat):
+				started = timer.perf_counter()
+				connection.execute(statement).fetchall()
+				timings.append((timer.perf_counter() - started) * 1000)
+			results[name] = (statistics.median(timings), plan)
+
+	event.remove(engine, 'before_cursor_execute', capture)
+	return results
+
+def report(title, results):
+	print(f'\n== {title} ==')
+	for name, (latency, plan) in results.items():
+		print(f'{name:<22} {latency:>9.3f} ms   {" | ".join(plan)}')
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--rows', type=int, default=1000000)
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--repeat', type=int, default=20)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		engine = create_engine('sqlite:///' + os.path.join(directory, 'bench.db'))
+		started = timer.perf_counter()
+		seed(engine, args.rows, args.users)
+		print(f'Seeded {args.rows} entries for {args.users} users in {timer.perf_counter() - started:.1f} s')
+
+		user_id = args.users // 2
+		report('before migration', measure(engine, user_id, args.repeat))
+
+		started = timer.perf_counter()
+		version = upgrade(engine)
+		print(f'\nMigrated to schema version {version} in {timer.perf_counter() - started:.1f} s')
+
+		report('after migration', measure(engine, user_id, args.repeat))
+		engine.dispose()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,102 @@
+"""
+Benchmark serializing a page of records, ORM objects versus plain rows.
+
+Seeds a temporary SQLite database with one user's records, then times building
+the GET /records response for pages of increasing size both ways: loading
+Entry objects and encoding with jsonify (the previous path), and selecting
+RECORD_COLUMNS rows encoded by RecordFormatter (the current path). Checks that
+both produce the same bytes.
+
+	python benchmarks/bench_serialization.py --limits 10 100 1000 --repeat 50
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time as timer
+from datetime import date, time, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from flask import Flask, jsonify
+from models import db, User, Entry
+import serializers
+from serializers import RECORD_COLUMNS, RecordFormatter
+
+def seed(rows):
+	db.create_all()
+	db.session.execute(db.insert(User).values(id=1, username='user1', password_hash='-', role='user', expected_calories=2000))
+	foods = ['banana', 'coffee', 'oatmeal', 'chicken salad', 'pasta', 'apple', 'rice', 'yogurt']
+	generator = random.Random(42)
+	db.session.execute(db.insert(Entry.__table__), [{
+		'user_id': 1,
+		'date': date(2020, 1, 1) + timedelta(days=number // 5),
+		'time': time(generator.randint(0, 23), generator.randint(0, 59)),
+		'text': generator.choice(foods),
+		'calories': generator.randint(20, 1200),
+		'is_below_expected': True,
+		'calorie_status': 'resolved'
+	} for number in range(rows)])
+	db.session.commit()
+
+def page_query(limit):
+	return Entry.query.filter_by(user_id=1).order_by(Entry.date, Entry.time, Entry.id).limit(limit)
+
+def orm_response(limit):
+	records = page_query(limit).all()
+	return jsonify({
+		'success': True,
+		'records': [{
+			'id': entry.id,
+			'text': entry.text,
+			'date': str(entry.date),
+			'time': str(entry.time),
+			'calories': entry.calories,
+			'is_below_expected': entry.is_below_expected
+		} for entry in records],
+		'limit': limit,
+		'page': None
+	})
+
+def rows_response(limit):
+	records = page_query(limit).with_entities(*RECORD_COLUMNS).all()
+	formatter = RecordFormatter()
+	return formatter.response({ 'success': True, 'records': formatter.records(records), 'limit': limit, 'page': None })
+
+def measure(build, limit, repeat):
+	timings = []
+	for _ in range(repeat):
+		# Every request starts with an empty session
+		db.session.remove()
+		started = timer.perf_counter()
+		build(limit).get_data()
+		timings.append((timer.perf_counter() - started) * 1000)
+	return statistics.median(timings)
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--rows', type=int, default=5000)
+	parser.add_argument('--limits', type=int, nargs='+', default=[10, 100, 1000])
+	parser.add_argument('--repeat', type=int, default=50)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		app = Flask(__name__)
+		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+		db.init_app(app)
+		with app.app_context():
+			seed(args.rows)
+			print(f'orjson: {"installed" if serializers.orjson else "not installed, encoding with jsonify"}\n')
+			print(f'{"limit":>6} {"ORM (ms)":>10} {"rows (ms)":>10} {"speedup":>8}')
+			for limit in args.limits:
+				if orm_response(limit).get_data() != rows_response(limit).get_data():
+					sys.exit(f'Responses differ at limit {limit}')
+				orm = measure(orm_response, limit, args.repeat)
+				rows = measure(rows_response, limit, args.repeat)
+				print(f'{limit:>6} {orm:>10.3f} {rows:>10.3f} {orm / rows:>7.1f}x')
+			db.session.remove()
+
+if __name__ == '__main__':
+	main()
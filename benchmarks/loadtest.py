@@ -0,0 +1,427 @@
+"""
+Load-test the API with concurrent clients against a seeded synthetic dataset.
+
+Seeds a database with --users users and about --entries records spread over
+the last --days days (3 to 5 meals a day at meal times, a skewed number of
+records per user, flags and daily totals consistent with expected_calories),
+then serves the app from a threaded werkzeug server and runs --clients client
+processes for --seconds seconds. Each client logs in as a random user, or as
+the admin for the admin scenarios, and sends requests picked by the weights of
+--mix. Nutritionix is replaced by a stub that answers after
+--nutritionix-latency milliseconds; calorie lookups use foods with a random
+suffix one time in five so that some of them miss the lookup cache.
+
+Prints requests per second, errors and p50/p95/p99 latency per scenario, and
+writes them with the commit, the parameters and the date to --results-dir.
+--compare latest compares with the newest earlier result of the same
+parameters (or --compare FILE with a given one), and --max-regression makes
+the run fail when a p95 got worse by more than that many percent.
+
+Seeding large datasets takes a while, pass --database to keep the seeded
+SQLite file and reuse it on later runs. --url drives an already running
+server instead (e.g. gunicorn on a --database seeded by an earlier run), in
+which case Nutritionix is not stubbed.
+
+	python benchmarks/loadtest.py --users 1000 --entries 200000 --clients 8 --seconds 30 --compare latest
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time as timer
+from datetime import date, datetime, time, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import requests
+
+PASSWORD = 'loadtest'
+# Cheap hashes so that logging in again does not dominate the run
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+# Foods with typical calories per serving, and the hours they are eaten at
+FOODS = {
+	'oatmeal': 150, 'banana': 105, 'coffee': 5, 'yogurt': 120, 'toast': 80, 'eggs': 155,
+	'chicken salad': 350, 'pasta': 480, 'rice': 210, 'sandwich': 420, 'soup': 180, 'burger': 550,
+	'apple': 95, 'chocolate': 230, 'nuts': 170, 'pizza': 700, 'steak': 610, 'salmon': 410,
+}
+MEALS = [
+	((7, 9), ['oatmeal', 'banana', 'coffee', 'yogurt', 'toast', 'eggs']),
+	((12, 14), ['chicken salad', 'pasta', 'rice', 'sandwich', 'soup', 'burger']),
+	((15, 17), ['apple', 'chocolate', 'nuts', 'coffee', 'yogurt']),
+	((18, 21), ['pizza', 'steak', 'salmon', 'pasta', 'rice', 'soup']),
+]
+
+# Scenario name: (role of the client, default weight)
+SCENARIOS = {
+	'GET /records': ('user', 30),
+	'GET /records text': ('user', 5),
+	'GET /records/daily': ('user', 10),
+	'GET /reports': ('user', 10),
+	'POST /records': ('user', 15),
+	'POST /records lookup': ('user', 5),
+	'GET /records admin': ('admin', 2),
+	'GET /users admin': ('admin', 3),
+}
+
+def build_request(name, generator, today):
+	# Method, path and JSON body of one request of a scenario
+	if name == 'GET /records':
+		return 'GET', '/records', { 'limit': 10, 'page': generator.randint(1, 3) }
+	if name == 'GET /records text':
+		return 'GET', '/records', { 'text': generator.choice(list(FOODS)), 'limit': 10, 'page': 1 }
+	if name == 'GET /records/daily':
+		return 'GET', '/records/daily', { 'date_from': str(today - timedelta(days=29)), 'date_to': str(today) }
+	if name == 'GET /reports':
+		return 'GET', '/reports', { 'granularity': generator.choice(['day', 'week']) }
+	if name == 'POST /records':
+		food = generator.choice(list(FOODS))
+		return 'POST', '/records', { 'text': food, 'calories': FOODS[food] }
+	if name == 'POST /records lookup':
+		food = generator.choice(list(FOODS))
+		if generator.random() < 0.2:
+			food = f'{food} {generator.randint(1, 10 ** 6)}'
+		return 'POST', '/records', { 'text': food }
+	if name == 'GET /records admin':
+		return 'GET', '/records', { 'limit': 1, 'page': 1 }
+	if name == 'GET /users admin':
+		return 'GET', '/users', { 'limit': 20, 'page': generator.randint(1, 50) }
+	raise ValueError(name)
+
+def user_entries(generator, user_id, count, expected_calories, days, today):
+	# One user's records in date and time order, with is_below_expected set from the running daily total
+	if not count:
+		return []
+	active_days = max(1, min(days, count // 4))
+	day_offsets = sorted(generator.sample(range(days), active_days))
+	meals = []
+	for number in range(count):
+		(first_hour, last_hour), foods = generator.choice(MEALS)
+		food = generator.choice(foods)
+		meals.append((
+			today - timedelta(days=day_offsets[number % active_days]),
+			time(generator.randint(first_hour, last_hour), generator.randint(0, 59)),
+			food,
+			max(1, round(FOODS[food] * generator.uniform(0.7, 1.3)))
+		))
+	meals.sort()
+	rows = []
+	totals = {}
+	for entry_date, entry_time, food, calories in meals:
+		totals[entry_date] = totals.get(entry_date, 0) + calories
+		rows.append({
+			'user_id': user_id,
+			'date': entry_date,
+			'time': entry_time,
+			'text': food,
+			'calories': calories,
+			'is_below_expected': totals[entry_date] <= expected_calories,
+			'calorie_status': 'resolved'
+		})
+	return rows
+
+def seed(app, users, entries, days, chunk_size=10000):
+	from werkzeug.security import generate_password_hash
+	from models import db, User, Entry
+	from migrations import upgrade
+
+	generator = random.Random(42)
+	password_hash = generate_password_hash(PASSWORD, method=PASSWORD_HASH_METHOD)
+	today = date.today()
+	with app.app_context():
+		db.create_all()
+		with db.engine.begin() as connection:
+			connection.execute(db.insert(User), [
+				{ 'id': 1, 'username': 'admin', 'password_hash': password_hash, 'role': 'admin', 'expected_calories': 2000 }
+			] + [{
+				'id': user_id,
+				'username': f'user{user_id}',
+				'password_hash': password_hash,
+				'role': 'user',
+				'expected_calories': generator.randrange(1500, 3001, 100)
+			} for user_id in range(2, users + 2)])
+			expected = dict(connection.execute(db.select(User.id, User.expected_calories)).all())
+
+		# Records per user follow an exponential distribution around the average
+		average = entries / users
+		inserted = 0
+		started = timer.perf_counter()
+		with db.engine.begin() as connection:
+			rows = []
+			for user_id in range(2, users + 2):
+				count = int(generator.expovariate(1 / average)) if average else 0
+				rows.extend(user_entries(generator, user_id, count, expected[user_id], days, today))
+				if len(rows) >= chunk_size:
+					connection.execute(db.insert(Entry.__table__), rows)
+					inserted += len(rows)
+					rows = []
+					print(f'\r{inserted} records, {inserted / (timer.perf_counter() - started):.0f} rows/s', end='', flush=True)
+			if rows:
+				connection.execute(db.insert(Entry.__table__), rows)
+				inserted += len(rows)
+		print(f'\r{inserted} records, {inserted / (timer.perf_counter() - started):.0f} rows/s')
+		# Builds the daily totals and the search index over the inserted rows
+		upgrade(db.engine)
+	return inserted
+
+def stub_nutritionix(latency):
+	import nutritionix
+
+	def fetch_calories(food_name):
+		timer.sleep(latency)
+		food = nutritionix.normalize_query(food_name).rstrip('0123456789 ')
+		if food not in FOODS:
+			return None, None
+		return food_name, FOODS[food]
+	nutritionix.fetch_calories = fetch_calories
+
+def client(url, users, scenarios, weights, seconds, requests_per_login, seed_value, start, results):
+	generator = random.Random(seed_value)
+	today = date.today()
+	sessions = {}
+	counts = {}
+
+	def login(role):
+		session = requests.Session()
+		username = 'admin' if role == 'admin' else f'user{generator.randint(2, users + 1)}'
+		response = session.post(url + '/login', json={ 'username': username, 'password': PASSWORD }, timeout=60)
+		response.raise_for_status()
+		sessions[role] = session
+		counts[role] = 0
+		return session
+
+	for role in set(SCENARIOS[name][0] for name in scenarios):
+		login(role)
+	timings = { name: [] for name in scenarios }
+	errors = { name: 0 for name in scenarios }
+	start.wait()
+	deadline = timer.perf_counter() + seconds
+	while timer.perf_counter() < deadline:
+		name = generator.choices(scenarios, weights)[0]
+		role = SCENARIOS[name][0]
+		session = sessions[role]
+		if counts[role] >= requests_per_login:
+			# Spread the load over users instead of warming the caches of a few
+			session = login(role)
+		counts[role] += 1
+		method, path, body = build_request(name, generator, today)
+		started = timer.perf_counter()
+		try:
+			response = session.request(method, url + path, json=body, timeout=60)
+			ok = response.status_code < 400
+		except requests.RequestException:
+			ok = False
+		elapsed = timer.perf_counter() - started
+		if ok:
+			timings[name].append(elapsed)
+		else:
+			errors[name] += 1
+	results.put((timings, errors))
+
+def percentile(values, fraction):
+	# Nearest-rank percentile of sorted values
+	if not values:
+		return None
+	return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def summarize(timings, errors, seconds):
+	summary = {}
+	for name in timings:
+		values = [value * 1000 for value in sorted(timings[name])]
+		summary[name] = {
+			'requests': len(values),
+			'errors': errors[name],
+			'rps': len(values) / seconds,
+			'p50_ms': percentile(values, 0.50),
+			'p95_ms': percentile(values, 0.95),
+			'p99_ms': percentile(values, 0.99),
+			'max_ms': percentile(values, 1)
+		}
+	return summary
+
+def run_clients(url, args, scenarios, weights):
+	context = multiprocessing.get_context('spawn')
+	start = context.Barrier(args.clients)
+	results = context.Queue()
+	processes = [
+		context.Process(target=client, args=(url, args.users, scenarios, weights, args.seconds, args.requests_per_login, number, start, results))
+		for number in range(args.clients)
+	]
+	for process in processes:
+		process.start()
+	timings = { name: [] for name in scenarios }
+	errors = { name: 0 for name in scenarios }
+	for _ in processes:
+		client_timings, client_errors = results.get(timeout=args.seconds + 300)
+		for name in scenarios:
+			timings[name].extend(client_timings[name])
+			errors[name] += client_errors[name]
+	for process in processes:
+		process.join()
+	return timings, errors
+
+def git_commit():
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+		dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+	return commit + ('-dirty' if dirty else '')
+
+def parse_mix(mix):
+	# 'GET /records=30,POST /records=10' to scenario names and weights
+	if not mix:
+		return list(SCENARIOS), [weight for role, weight in SCENARIOS.values()]
+	scenarios, weights = [], []
+	for item in mix.split(','):
+		name, _, weight = item.rpartition('=')
+		name = name.strip()
+		if name not in SCENARIOS:
+			raise argparse.ArgumentTypeError(f'Unknown scenario {name!r}, expected one of: {", ".join(SCENARIOS)}')
+		scenarios.append(name)
+		weights.append(float(weight))
+	return scenarios, weights
+
+def find_baseline(directory, parameters):
+	# Newest stored result of a run with the same parameters
+	candidates = []
+	for filename in os.listdir(directory) if os.path.isdir(directory) else []:
+		if not filename.endswith('.json'):
+			continue
+		with open(os.path.join(directory, filename)) as file:
+			result = json.load(file)
+		if result.get('parameters') == parameters:
+			candidates.append((result['date'], os.path.join(directory, filename)))
+	return max(candidates)[1] if candidates else None
+
+def compare(baseline, summary, max_regression):
+	# Print the change of each percentile and return the scenarios whose p95 regressed too much
+	print(f'\nCompared with {baseline["commit"]} ({baseline["date"]}):\n')
+	print(f'{"scenario":<22} {"rps":>8} {"p50":>8} {"p95":>8} {"p99":>8}')
+	regressions = []
+	for name, stats in summary.items():
+		previous = baseline['endpoints'].get(name)
+		if not previous:
+			continue
+		changes = []
+		for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+			if stats[key] is None or not previous[key]:
+				changes.append(f'{"-":>8}')
+				continue
+			change = (stats[key] - previous[key]) / previous[key] * 100
+			changes.append(f'{change:>+7.1f}%')
+			if key == 'p95_ms' and max_regression is not None and change > max_regression:
+				regressions.append(name)
+		print(f'{name:<22} ' + ' '.join(changes))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--entries', type=int, default=200000)
+	parser.add_argument('--days', type=int, default=365)
+	parser.add_argument('--database', help='SQLite file to seed, or to reuse when it is already seeded')
+	parser.add_argument('--config', choices=['default', 'production'], default='production')
+	parser.add_argument('--url', help='Drive this running server instead of starting one')
+	parser.add_argument('--clients', type=int, default=8)
+	parser.add_argument('--seconds', type=float, default=30)
+	parser.add_argument('--mix', help='Scenario weights, e.g. "GET /records=30,POST /records=10"')
+	parser.add_argument('--requests-per-login', type=int, default=50)
+	parser.add_argument('--nutritionix-latency', type=float, default=150, help='milliseconds')
+	parser.add_argument('--results-dir', default=os.path.join(ROOT, 'benchmarks', 'results'))
+	parser.add_argument('--compare', help="'latest' or a results file")
+	parser.add_argument('--max-regression', type=float, help='Fail when a p95 got worse by more than this many percent')
+	args = parser.parse_args()
+	scenarios, weights = parse_mix(args.mix)
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.abspath(args.database or os.path.join(directory, 'loadtest.db'))
+		seeded = os.path.exists(path)
+		# The app reads its configuration when it is imported
+		os.environ['DATABASE_URL'] = 'sqlite:///' + path
+		os.environ['FLASK_ENV'] = args.config
+		os.environ.setdefault('SECRET_KEY', 'loadtest')
+		from app import app
+		import hashing
+		app.config.update(PASSWORD_HASH_METHOD=PASSWORD_HASH_METHOD, CALORIE_RESOLVER_ENABLED=False)
+
+		if seeded:
+			print(f'Using the records already seeded in {path}')
+		else:
+			started = timer.perf_counter()
+			seed(app, args.users, args.entries, args.days)
+			print(f'Seeded {args.users} users in {timer.perf_counter() - started:.1f} s')
+
+		server = None
+		url = args.url
+		if not url:
+			from werkzeug.serving import make_server
+			logging.getLogger('werkzeug').setLevel(logging.ERROR)
+			stub_nutritionix(args.nutritionix_latency / 1000)
+			server = make_server('127.0.0.1', 0, app, threaded=True)
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+			url = f'http://127.0.0.1:{server.server_port}'
+
+		print(f'{args.clients} clients, {args.seconds:g} s, {args.config} config\n')
+		try:
+			timings, errors = run_clients(url, args, scenarios, weights)
+		finally:
+			if server:
+				server.shutdown()
+			hashing.shutdown()
+
+	summary = summarize(timings, errors, args.seconds)
+	print(f'{"scenario":<22} {"requests":>9} {"errors":>7} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+	for name, stats in summary.items():
+		latencies = ' '.join(f'{stats[key]:>8.1f}' if stats[key] is not None else f'{"-":>8}' for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+		print(f'{name:<22} {stats["requests"]:>9} {stats["errors"]:>7} {stats["rps"]:>8.1f} {latencies}')
+	total = sum(stats['requests'] for stats in summary.values())
+	print(f'\n{total / args.seconds:.1f} requests/s in total')
+
+	parameters = {
+		'users': args.users,
+		'entries': args.entries,
+		'days': args.days,
+		'config': args.config,
+		'url': args.url,
+		'clients': args.clients,
+		'seconds': args.seconds,
+		'mix': dict(zip(scenarios, weights)),
+		'requests_per_login': args.requests_per_login,
+		'nutritionix_latency': args.nutritionix_latency
+	}
+	baseline = None
+	if args.compare == 'latest':
+		baseline = find_baseline(args.results_dir, parameters)
+		if baseline is None:
+			print('\nNo earlier result with the same parameters to compare with')
+	elif args.compare:
+		baseline = args.compare
+
+	result = {
+		'commit': git_commit(),
+		'date': datetime.now().isoformat(timespec='seconds'),
+		'parameters': parameters,
+		'endpoints': summary
+	}
+	os.makedirs(args.results_dir, exist_ok=True)
+	filename = os.path.join(args.results_dir, f'{datetime.now():%Y%m%d-%H%M%S}-{result["commit"]}.json')
+	with open(filename, 'w') as file:
+		json.dump(result, file, indent=2)
+	print(f'Results written to {filename}')
+
+	if baseline:
+		with open(baseline) as file:
+			regressions = compare(json.load(file), summary, args.max_regression)
+		if regressions:
+			sys.exit(f'\np95 regressed by more than {args.max_regression:g}% for: {", ".join(regressions)}')
+
+if __name__ == '__main__':
+	main()
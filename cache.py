@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+	"""Thread-safe, size-bounded LRU cache whose entries expire after a TTL."""
+
+	def __init__(self, maxsize=1024, ttl=300):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._items = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			item = self._items.get(key)
+			if item is not None:
+				value, expires_at = item
+				if expires_at > time.time():
+					self._items.move_to_end(key)
+					self.hits += 1
+					return value
+				del self._items[key]
+			self.misses += 1
+			return default
+
+	def set(self, key, value, ttl=None, expires_at=None):
+		# The entry expires after ttl seconds (the cache default) or at the given epoch time
+		if expires_at is None:
+			expires_at = time.time() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			self._items[key] = (value, expires_at)
+			self._items.move_to_end(key)
+			while len(self._items) > self.maxsize:
+				self._items.popitem(last=False)
+
+	def invalidate(self, key):
+		with self._lock:
+			self._items.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+	def __len__(self):
+		return len(self._items)
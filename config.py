@@ -3,9 +3,103 @@ from flask_sqlalchemy import SQLAlchemy
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+def database_url(url):
+    # Hosting providers still hand out the 'postgres://' scheme SQLAlchemy dropped
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
 class Config:
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'calories.db')
+    # DATABASE_URL selects the backend (any SQLAlchemy URL), calories.db by default
+    SQLALCHEMY_DATABASE_URI = database_url(os.getenv('DATABASE_URL')) or 'sqlite:///' + os.path.join(basedir, 'calories.db')
+    # Optional read replica for the read-only views, used while it lags less than REPLICA_MAX_LAG seconds
+    DATABASE_REPLICA_URL = database_url(os.getenv('DATABASE_REPLICA_URL'))
+    REPLICA_CHECK_INTERVAL = 5
+    REPLICA_MAX_LAG = 10
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Nutritionix lookup cache: in-process LRU size and TTLs (seconds) for found and unknown foods
+    NUTRITIONIX_CACHE_SIZE = 4096
+    NUTRITIONIX_CACHE_TTL = 7 * 24 * 60 * 60
+    NUTRITIONIX_NEGATIVE_CACHE_TTL = 60 * 60
+    # Nutritionix HTTP client: timeouts (seconds), retries with backoff and circuit breaker
+    NUTRITIONIX_API_URL = 'https://trackapi.nutritionix.com/v2/search/instant'
+    NUTRITIONIX_CONNECT_TIMEOUT = 3.05
+    NUTRITIONIX_READ_TIMEOUT = 5
+    NUTRITIONIX_RETRIES = 2
+    NUTRITIONIX_BACKOFF_FACTOR = 0.3
+    NUTRITIONIX_POOL_SIZE = 10
+    NUTRITIONIX_BREAKER_THRESHOLD = 5
+    NUTRITIONIX_BREAKER_RESET = 30
+    # Background calorie resolution: POST /records without calories returns 202 when async
+    CALORIE_RESOLUTION_ASYNC = False
+    CALORIE_RESOLVER_ENABLED = True
+    CALORIE_RESOLVER_WORKERS = 4
+    CALORIE_RESOLVER_BATCH_SIZE = 100
+    # Cache of reports for periods that are over: number of entries and TTL (seconds)
+    REPORT_CACHE_SIZE = 10000
+    REPORT_CACHE_TTL = 24 * 60 * 60
+    # Use the SQLite FTS5 index for the records text filter when it exists
+    SEARCH_FTS_ENABLED = True
+    # Maximum number of records accepted by POST /records/batch
+    RECORDS_BATCH_LIMIT = 1000
+    # Rows inserted per transaction by POST /records/import and 'flask import-records'
+    IMPORT_CHUNK_SIZE = 5000
+    # Per-process cache of the authenticated user loaded on every request: entries and TTL (seconds)
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 60
+    # Password hashing: werkzeug method with every parameter spelled out, worker processes (0 hashes
+    # inline) and hashes allowed in flight before login and signup answer 503
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_LIMIT = 32
+    # PRAGMAs run on every new SQLite connection
+    SQLITE_PRAGMAS = {}
+    # Prometheus metrics on GET /metrics, which requires 'Authorization: Bearer <METRICS_TOKEN>' when set
+    METRICS_ENABLED = True
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # Request profiling: admins profile a request with 'X-Profile: 1', and PROFILE_SAMPLE_RATE of the
+    # requests to PROFILE_ENDPOINTS (by PROFILE_USER_IDS, or anyone) are profiled; reports go to PROFILE_DIR
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true')
+    PROFILE_DIR = os.path.join(basedir, 'profiles')
+    PROFILE_ENDPOINTS = ()
+    PROFILE_USER_IDS = ()
+    PROFILE_SAMPLE_RATE = 1.0
+    PROFILE_TOP = 50
+    # 'flask archive-entries' moves entries from before the month this many days ago to entry_archive
+    ARCHIVE_HORIZON_DAYS = 730
+    # DELETE /users and 'flask delete-user' delete a user's entries in transactions of this many rows;
+    # background deletions are reported by GET /users/deletions/<job_id> for USER_DELETION_JOB_TTL seconds
+    USER_DELETE_CHUNK_SIZE = 5000
+    USER_DELETION_JOB_TTL = 24 * 60 * 60
+
+class ProductionConfig(Config):
+    # Several worker processes share calories.db: WAL lets readers run alongside the writer,
+    # and writers wait for the lock instead of failing with "database is locked"
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+    }
+    # Per process: pool_size connections kept open, up to max_overflow more under load.
+    # Server databases drop idle connections, so they are checked and recycled
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
     
 class TestConfig(Config):
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'test.db')
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'test.db')
+    DATABASE_REPLICA_URL = None
+    # Tests resolve pending records explicitly
+    CALORIE_RESOLVER_ENABLED = False
+    # Cheap hashes, computed inline
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    # Profiling hooks are registered at startup, requests opt in
+    PROFILING_ENABLED = True
\ No newline at end of file
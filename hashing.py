@@ -0,0 +1,88 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app, has_app_context
+from werkzeug.security import generate_password_hash, check_password_hash
+
+"""
+# PASSWORD HASHING #
+
+Password hashes are deliberately slow to compute. Running them on request
+threads lets a burst of logins hold the CPU (and the GIL) and stall every other
+endpoint, so login and signup hash on a small pool of worker processes instead.
+At most PASSWORD_HASH_QUEUE_LIMIT hashes may be running or waiting at once;
+beyond that HashingBusy is raised and the request gets a 503 instead of queuing
+without bound. With PASSWORD_HASH_WORKERS = 0 hashes run inline.
+
+PASSWORD_HASH_METHOD is a werkzeug method string with every parameter spelled
+out (e.g. 'pbkdf2:sha256:600000' or 'scrypt:32768:8:1'), since it is compared
+with the prefix of stored hashes. A successful login with a hash made with
+other parameters stores a new hash, so the cost can be changed at any time.
+
+"""
+
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_LIMIT = 32
+
+class HashingBusy(Exception):
+	pass
+
+_lock = threading.Lock()
+_pool = None
+_slots = None
+
+def _setting(name, default):
+	return current_app.config.get(name, default) if has_app_context() else default
+
+def _get_pool():
+	global _pool, _slots
+	with _lock:
+		if _pool is None:
+			# Spawned workers do not inherit the locks of the server's threads
+			_pool = ProcessPoolExecutor(
+				max_workers=_setting('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS),
+				mp_context=multiprocessing.get_context('spawn')
+			)
+			_slots = threading.BoundedSemaphore(_setting('PASSWORD_HASH_QUEUE_LIMIT', DEFAULT_QUEUE_LIMIT))
+		return _pool, _slots
+
+def _run(function, *args):
+	if not _setting('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS):
+		return function(*args)
+	pool, slots = _get_pool()
+	if not slots.acquire(blocking=False):
+		raise HashingBusy('Too many password hashes in progress')
+	try:
+		return pool.submit(function, *args).result()
+	except BrokenProcessPool as error:
+		# A worker died, start a new pool for the next request
+		shutdown()
+		raise HashingBusy(str(error)) from error
+	finally:
+		slots.release()
+
+def hash_password(password):
+	return _run(
+		generate_password_hash,
+		password,
+		_setting('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+		_setting('PASSWORD_HASH_SALT_LENGTH', 16)
+	)
+
+def verify_password(password_hash, password):
+	return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+	# True when the hash was made with other parameters than the configured ones
+	return password_hash.split('$', 1)[0] != _setting('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+
+def shutdown():
+	global _pool, _slots
+	with _lock:
+		pool = _pool
+		_pool = None
+		_slots = None
+	if pool is not None:
+		pool.shutdown(wait=False, cancel_futures=True)
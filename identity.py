@@ -0,0 +1,72 @@
+import threading
+from flask import current_app
+from flask_login import UserMixin
+from cache import TTLCache
+from models import db, User
+import versions
+
+"""
+# AUTHENTICATED USER CACHE #
+
+Flask-Login calls load_user on every authenticated request. Instead of loading
+the User row each time, the fields permission checks and handlers read (id,
+username, role and expected_calories) are kept in a per-process LRU with a
+short TTL (USER_CACHE_TTL). Each entry keeps the 'users' data version it was
+read at, and every request reads the current one (a primary key lookup): any
+change to the user table committed by any process bumps it, so a demoted or
+deleted user never keeps their old role in another worker. post_users and
+delete_users also drop the entry from their own process.
+
+"""
+
+class CachedUser(UserMixin):
+	"""Read-only snapshot of a User, returned as current_user."""
+
+	def __init__(self, id, username, role, expected_calories, version=0):
+		self.id = id
+		self.username = username
+		self.role = role
+		self.expected_calories = expected_calories
+		# 'users' data version the snapshot was read at
+		self.version = version
+
+	def __repr__(self):
+		return '<User {}>'.format(self.username)
+
+_cache = None
+_lock = threading.Lock()
+
+def _get_cache():
+	global _cache
+	with _lock:
+		if _cache is None:
+			_cache = TTLCache(
+				maxsize=current_app.config.get('USER_CACHE_SIZE', 10000),
+				ttl=current_app.config.get('USER_CACHE_TTL', 60)
+			)
+	return _cache
+
+def load(user_id):
+	# The cached identity of user_id, or None when the user does not exist
+	cache = _get_cache()
+	# Read before the row: a change committed in between only makes the next request a miss
+	version, = versions.current(versions.USERS)
+	user = cache.get(user_id)
+	if user is None or user.version != version:
+		row = db.session.execute(
+			db.select(User.id, User.username, User.role, User.expected_calories)
+			.where(User.id == user_id)
+		).first()
+		if row is None:
+			cache.invalidate(user_id)
+			return None
+		user = CachedUser(*row, version=version)
+		cache.set(user_id, user)
+	return user
+
+def invalidate(user_id):
+	_get_cache().invalidate(user_id)
+
+def clear():
+	if _cache is not None:
+		_cache.clear()
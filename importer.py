@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+from datetime import date, time
+from models import db, Entry, DailyTotal
+from recompute import recompute_user
+import versions
+
+"""
+# BULK IMPORT #
+
+Historical records are read from a CSV (with a header row) or NDJSON stream
+one row at a time and inserted in chunks with executemany, committing after
+each chunk, so memory use does not depend on the size of the file. Every row
+needs date (YYYY-MM-DD), time (HH:MM[:SS]), text and calories; rows that
+cannot be parsed are skipped and reported. Once all rows are in, the daily
+totals and is_below_expected flags of the user are rebuilt in one set-based
+pass.
+
+"""
+
+MAX_REPORTED_ERRORS = 10
+
+def parse_records(stream, format):
+	# Yield (line number, dict) for every row of a text stream
+	if format == 'csv':
+		for number, row in enumerate(csv.DictReader(stream), 2):
+			yield number, row
+	elif format == 'ndjson':
+		for number, line in enumerate(stream, 1):
+			if line.strip():
+				try:
+					yield number, json.loads(line)
+				except ValueError:
+					yield number, None
+	else:
+		raise ValueError(f'Unsupported import format {format}')
+
+def format_from_filename(filename, default='csv'):
+	extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+	return { 'csv': 'csv', 'ndjson': 'ndjson', 'jsonl': 'ndjson' }.get(extension, default)
+
+def text_stream(binary_stream):
+	return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+
+def _entry_row(user_id, record):
+	text = str(record['text']).strip()
+	if not text:
+		raise ValueError('text is empty')
+	calories = float(record['calories'])
+	return {
+		'user_id': user_id,
+		'date': date.fromisoformat(str(record['date']).strip()),
+		'time': time.fromisoformat(str(record['time']).strip()),
+		'text': text[:256],
+		'calories': int(calories) if calories.is_integer() else calories,
+		'calorie_status': 'resolved'
+	}
+
+def import_records(stream, format, user_id, chunk_size=5000, progress=None):
+	# Insert every valid row of the stream for user_id and return a summary
+	imported = 0
+	rejected = 0
+	errors = []
+	chunk = []
+
+	def flush():
+		nonlocal imported
+		db.session.execute(db.insert(Entry.__table__), chunk)
+		db.session.commit()
+		imported += len(chunk)
+		chunk.clear()
+		if progress:
+			progress(imported)
+
+	for number, record in parse_records(stream, format):
+		try:
+			chunk.append(_entry_row(user_id, record))
+		except (KeyError, ValueError, TypeError) as error:
+			rejected += 1
+			if len(errors) < MAX_REPORTED_ERRORS:
+				errors.append(f'line {number}: {error!r}' if record is not None else f'line {number}: invalid JSON')
+			continue
+		if len(chunk) >= chunk_size:
+			flush()
+	if chunk:
+		flush()
+
+	if imported:
+		# Rollups and flags are derived once for the whole import
+		DailyTotal.rebuild(user_id)
+		# Imported records land in entry, archived days keep their flags and rollups
+		recompute_user(user_id, archived=False)
+		versions.entries_changed(user_id)
+		db.session.commit()
+	return { 'imported': imported, 'rejected': rejected, 'errors': errors }
@@ -0,0 +1,164 @@
+import bisect
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+# METRICS #
+
+Counters and histograms kept in process memory and rendered in the Prometheus
+text format by GET /metrics. Every request is counted and timed per endpoint,
+together with the number of SQL statements it ran; every SQL statement is
+counted and timed by operation through SQLAlchemy cursor events on all
+engines; Nutritionix calls are timed by outcome. Updating a metric is a dict
+lookup under a lock, cheap enough to leave on in production. Each server
+process keeps its own numbers, so scrape every worker (or run one).
+
+"""
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+OPERATIONS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+_registry = []
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=''):
+	pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+	"""Monotonic count per combination of label values."""
+
+	type = 'counter'
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self._values = {}
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def inc(self, *label_values, amount=1):
+		with self._lock:
+			self._values[label_values] = self._values.get(label_values, 0) + amount
+
+	def value(self, *label_values):
+		with self._lock:
+			return self._values.get(label_values, 0)
+
+	def samples(self):
+		with self._lock:
+			values = sorted(self._values.items())
+		return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in values]
+
+class Histogram:
+	"""Observations counted into cumulative buckets per combination of label values."""
+
+	type = 'histogram'
+
+	def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = tuple(buckets)
+		self._values = {}
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def observe(self, value, *label_values):
+		index = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			state = self._values.get(label_values)
+			if state is None:
+				state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+			state[0][index] += 1
+			state[1] += value
+
+	def count(self, *label_values):
+		with self._lock:
+			state = self._values.get(label_values)
+			return sum(state[0]) if state else 0
+
+	def samples(self):
+		with self._lock:
+			values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+		lines = []
+		for key, (counts, total) in values:
+			cumulative = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				cumulative += count
+				le = 'le="+Inf"' if bound == '+Inf' else f'le="{_number(float(bound))}"'
+				lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+			lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(float(total))}')
+			lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+		return lines
+
+def render():
+	# Every metric in the Prometheus text exposition format
+	lines = []
+	for metric in _registry:
+		lines.append(f'# HELP {metric.name} {metric.help}')
+		lines.append(f'# TYPE {metric.name} {metric.type}')
+		lines.extend(metric.samples())
+	return '\n'.join(lines) + '\n'
+
+http_requests = Counter('http_requests_total', 'HTTP requests by endpoint, method and status.', ('endpoint', 'method', 'status'))
+http_duration = Histogram('http_request_duration_seconds', 'HTTP request latency by endpoint and method.', ('endpoint', 'method'))
+http_statements = Histogram('http_request_sql_statements', 'SQL statements run per HTTP request by endpoint.', ('endpoint',), STATEMENT_BUCKETS)
+sql_statements = Counter('sql_statements_total', 'SQL statements by operation.', ('operation',))
+sql_duration = Histogram('sql_statement_duration_seconds', 'SQL statement latency by operation.', ('operation',))
+nutritionix_requests = Counter('nutritionix_requests_total', 'Nutritionix lookups by outcome.', ('outcome',))
+nutritionix_duration = Histogram('nutritionix_request_duration_seconds', 'Nutritionix lookup latency, retries included, by outcome.', ('outcome',))
+
+def _start_request():
+	g.metrics_started = time.perf_counter()
+	g.metrics_statements = 0
+
+def _end_request(response):
+	started = g.pop('metrics_started', None)
+	if started is not None:
+		endpoint = request.endpoint or 'unmatched'
+		http_requests.inc(endpoint, request.method, response.status_code)
+		http_duration.observe(time.perf_counter() - started, endpoint, request.method)
+		http_statements.observe(g.pop('metrics_statements', 0), endpoint)
+	return response
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+	operation = statement.lstrip()[:6].upper()
+	if operation not in OPERATIONS:
+		operation = 'OTHER'
+	sql_statements.inc(operation)
+	sql_duration.observe(elapsed, operation)
+	if has_request_context() and 'metrics_statements' in g:
+		g.metrics_statements += 1
+
+def _handle_error(context):
+	# A failed statement never reaches after_cursor_execute
+	started = context.connection.info.get('metrics_started') if context.connection is not None else None
+	if started:
+		started.pop()
+
+def init_app(app):
+	if not app.config.get('METRICS_ENABLED', True):
+		return
+	app.before_request(_start_request)
+	app.after_request(_end_request)
+	if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+		event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+		event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+		event.listen(Engine, 'handle_error', _handle_error)
@@ -0,0 +1,129 @@
+from datetime import datetime
+from models import db, Entry, DailyTotal, FoodCache, ReplicaHeartbeat, DataVersion, ArchivedEntry, MonthlyTotal
+from search import rebuild_search_index
+
+"""
+# SCHEMA MIGRATIONS #
+
+Databases created by an older version of the app are brought up to date by
+running the migrations below in order. Each migration runs in its own
+transaction and is recorded in the schema_version table, so upgrading is safe
+to repeat and never drops existing data. Migrations must also be idempotent,
+since a fresh database created with db.create_all() already has the latest
+tables and indexes but no recorded version.
+
+"""
+
+class SchemaVersion(db.Model):
+	__tablename__ = 'schema_version'
+	version = db.Column(db.Integer, primary_key=True)
+	description = db.Column(db.String(256), nullable=False)
+	applied_at = db.Column(db.DateTime, nullable=False)
+
+MIGRATIONS = []
+
+def entry_index(name):
+	return next(index for index in Entry.__table__.indexes if index.name == name)
+
+def migration(version, description):
+	def register(function):
+		MIGRATIONS.append((version, description, function))
+		MIGRATIONS.sort(key=lambda item: item[0])
+		return function
+	return register
+
+@migration(1, 'Create and backfill the daily_total rollup')
+def create_daily_totals(connection):
+	DailyTotal.__table__.create(connection, checkfirst=True)
+	DailyTotal.rebuild(connection=connection)
+
+@migration(2, 'Add composite indexes on entry')
+def create_entry_indexes(connection):
+	for name in ('ix_entry_user_date_time', 'ix_entry_user_calories'):
+		entry_index(name).create(connection, checkfirst=True)
+
+@migration(3, 'Create the food_cache table')
+def create_food_cache(connection):
+	FoodCache.__table__.create(connection, checkfirst=True)
+
+@migration(4, 'Add entry.calorie_status for background calorie resolution')
+def add_calorie_status(connection):
+	columns = { column['name'] for column in db.inspect(connection).get_columns('entry') }
+	if 'calorie_status' not in columns:
+		connection.execute(db.text("ALTER TABLE entry ADD COLUMN calorie_status VARCHAR(16) NOT NULL DEFAULT 'resolved'"))
+	entry_index('ix_entry_calorie_status').create(connection, checkfirst=True)
+
+@migration(5, 'Create the entry_fts full-text index')
+def create_search_index(connection):
+	# No-op on databases without FTS5, where the text filter keeps using ILIKE
+	rebuild_search_index(connection)
+
+@migration(6, 'Widen user.password_hash for scrypt hashes')
+def widen_password_hash(connection):
+	# SQLite does not enforce VARCHAR lengths
+	if connection.dialect.name == 'postgresql':
+		connection.execute(db.text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(256)'))
+	elif connection.dialect.name == 'mysql':
+		connection.execute(db.text('ALTER TABLE user MODIFY password_hash VARCHAR(256) NOT NULL'))
+
+@migration(7, 'Create the replica_heartbeat table')
+def create_replica_heartbeat(connection):
+	ReplicaHeartbeat.__table__.create(connection, checkfirst=True)
+
+@migration(8, 'Create the data_version table for ETags')
+def create_data_version(connection):
+	DataVersion.__table__.create(connection, checkfirst=True)
+
+@migration(9, 'Create the entry_archive and monthly_total tables')
+def create_archive(connection):
+	ArchivedEntry.__table__.create(connection, checkfirst=True)
+	MonthlyTotal.__table__.create(connection, checkfirst=True)
+
+@migration(10, 'Rebuild entry with AUTOINCREMENT ids')
+def autoincrement_entry_ids(connection):
+	# Without AUTOINCREMENT SQLite reuses the ids of deleted, and archived, entries
+	if connection.dialect.name != 'sqlite':
+		return
+	sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'entry'").scalar()
+	if 'AUTOINCREMENT' not in sql.upper():
+		columns = ', '.join(column.name for column in Entry.__table__.columns)
+		for trigger in ('entry_fts_insert', 'entry_fts_delete', 'entry_fts_update'):
+			connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {trigger}')
+		for index in Entry.__table__.indexes:
+			connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+		connection.exec_driver_sql('ALTER TABLE entry RENAME TO entry_rebuild')
+		Entry.__table__.create(connection)
+		connection.exec_driver_sql(f'INSERT INTO entry ({columns}) SELECT {columns} FROM entry_rebuild')
+		connection.exec_driver_sql('DROP TABLE entry_rebuild')
+		# The copy went through the insert trigger, index every entry once
+		rebuild_search_index(connection)
+	# New ids start above every id in either tier
+	connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'entry'")
+	connection.exec_driver_sql(
+		"INSERT INTO sqlite_sequence (name, seq) SELECT 'entry', max("
+		"(SELECT coalesce(max(id), 0) FROM entry), (SELECT coalesce(max(id), 0) FROM entry_archive))"
+	)
+
+def current_version(engine):
+	SchemaVersion.__table__.create(engine, checkfirst=True)
+	with engine.connect() as connection:
+		version = connection.execute(db.select(db.func.max(SchemaVersion.version))).scalar()
+	return version or 0
+
+def upgrade(engine, progress=None):
+	# Apply every migration newer than the recorded version and return the new version
+	version = current_version(engine)
+	for number, description, function in MIGRATIONS:
+		if number <= version:
+			continue
+		with engine.begin() as connection:
+			function(connection)
+			connection.execute(db.insert(SchemaVersion).values(
+				version=number,
+				description=description,
+				applied_at=datetime.utcnow()
+			))
+		version = number
+		if progress:
+			progress(number, description)
+	return version
@@ -1,27 +1,50 @@
 from datetime import datetime
+from flask import g, has_app_context
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+import hashing
 
-db = SQLAlchemy()
+class RoutingSession(Session):
+	"""Session that sends queries to the read replica picked by routing.read_only()."""
+
+	def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+		engine = g.get('read_engine') if has_app_context() else None
+		if bind is None and engine is not None and not self._flushing:
+			return engine
+		return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={ 'class_': RoutingSession })
 
 class User(UserMixin, db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	username = db.Column(db.String(64), unique=True, nullable=False)
-	password_hash = db.Column(db.String(128), nullable=False)
+	password_hash = db.Column(db.String(256), nullable=False)
 	role = db.Column(db.String(64), nullable=False)
 	expected_calories = db.Column(db.Integer, nullable=False)
 
 	def set_password(self, password):
-		self.password_hash = generate_password_hash(password)
+		# Same configured method and worker pool as login and signup
+		self.password_hash = hashing.hash_password(password)
 
 	def check_password(self, password):
-		return check_password_hash(self.password_hash, password)
+		return hashing.verify_password(self.password_hash, password)
 	
 	def __repr__(self):
 		return '<User {}>'.format(self.username)
 
 class Entry(db.Model):
+	__table_args__ = (
+		# Serve the records listing filters without scanning the whole table
+		db.Index('ix_entry_user_date_time', 'user_id', 'date', 'time'),
+		db.Index('ix_entry_user_calories', 'user_id', 'calories'),
+		# Lets the background resolver find entries still waiting for Nutritionix
+		db.Index('ix_entry_calorie_status', 'calorie_status'),
+		# Ids are never handed out again, archived entries keep theirs in entry_archive
+		{ 'sqlite_autoincrement': True },
+	)
+
 	def __init__(self, *args, **kwargs):
 		super(Entry, self).__init__(*args, **kwargs)
 		self.calculate_is_below_expected()
@@ -33,21 +56,125 @@ class Entry(db.Model):
 	text = db.Column(db.String(256), nullable=False)
 	calories = db.Column(db.Integer, nullable=False)
 	is_below_expected = db.Column(db.Boolean)
+	# 'resolved', or 'pending'/'failed' while calories are looked up in the background
+	calorie_status = db.Column(db.String(16), nullable=False, default='resolved', server_default='resolved')
 
 	user = db.relationship('User', backref=db.backref('entries', lazy=True))
 	
 	def calculate_is_below_expected(self):
-		user = User.query.get(self.user_id) if self.user_id is not None else None
+		# Read the user's target and the day's running total, archived entries included, in one statement
+		archived_calories = db.select(db.func.coalesce(db.func.sum(ArchivedEntry.calories), 0)) \
+			.where(ArchivedEntry.user_id == self.user_id, ArchivedEntry.date == self.date) \
+			.scalar_subquery()
+		row = db.session.execute(
+			db.select(User.expected_calories, DailyTotal.total_calories, archived_calories)
+			.outerjoin(DailyTotal, db.and_(DailyTotal.user_id == User.id, DailyTotal.date == self.date))
+			.where(User.id == self.user_id)
+		).first() if self.user_id is not None else None
 		
-		if user is not None:
-			total_calories = Entry.query \
-				.filter(Entry.user_id == self.user_id, Entry.date == self.date) \
-				.with_entities(db.func.sum(Entry.calories)).scalar()
+		if row is not None:
+			expected_calories, total_calories, archived_calories = row
 			if total_calories is None:
 				total_calories = 0
+			total_calories += archived_calories
 			# Add the calories of the current entry
 			total_calories += self.calories
 			# Compute whether total_calories is below the expected value
-			self.is_below_expected = total_calories < user.expected_calories
+			self.is_below_expected = total_calories < expected_calories
+		else:
+			self.is_below_expected = False
+
+class DailyTotal(db.Model):
+	# Per-user, per-day rollup of entries, kept current by every write to Entry
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	date = db.Column(db.Date, primary_key=True)
+	total_calories = db.Column(db.Integer, nullable=False, default=0)
+	entry_count = db.Column(db.Integer, nullable=False, default=0)
+
+	@staticmethod
+	def apply(user_id, date, calories, count):
+		# Shift the rollup for (user_id, date) by the given deltas, creating the row if needed.
+		# One upsert, so concurrent first writes to the same day both succeed
+		values = { 'user_id': user_id, 'date': date, 'total_calories': calories, 'entry_count': count }
+		shifted = {
+			'total_calories': DailyTotal.total_calories + calories,
+			'entry_count': DailyTotal.entry_count + count
+		}
+		dialect = db.session.get_bind().dialect.name
+		if dialect == 'mysql':
+			statement = mysql.insert(DailyTotal).values(**values).on_duplicate_key_update(**shifted)
 		else:
-			self.is_below_expected = False
\ No newline at end of file
+			insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+			statement = insert(DailyTotal).values(**values) \
+				.on_conflict_do_update(index_elements=[DailyTotal.user_id, DailyTotal.date], set_=shifted)
+		db.session.execute(statement)
+
+	@staticmethod
+	def rebuild(user_id=None, connection=None):
+		# Recompute rollups from the entry table with one INSERT ... SELECT
+		executor = connection if connection is not None else db.session
+		delete_query = db.delete(DailyTotal)
+		select_query = db.select(
+			Entry.user_id, Entry.date, db.func.sum(Entry.calories), db.func.count(Entry.id)
+		).group_by(Entry.user_id, Entry.date)
+		if user_id is not None:
+			delete_query = delete_query.where(DailyTotal.user_id == user_id)
+			select_query = select_query.where(Entry.user_id == user_id)
+		executor.execute(delete_query)
+		executor.execute(
+			db.insert(DailyTotal).from_select(
+				['user_id', 'date', 'total_calories', 'entry_count'], select_query
+			)
+		)
+
+	def __repr__(self):
+		return '<DailyTotal {} {}>'.format(self.user_id, self.date)
+
+class FoodCache(db.Model):
+	# Persistent tier of the Nutritionix lookup cache, keyed by the normalized query text
+	__tablename__ = 'food_cache'
+	query_text = db.Column(db.String(256), primary_key=True)
+	food_name = db.Column(db.String(256))
+	calories = db.Column(db.Float)
+	expires_at = db.Column(db.DateTime, nullable=False)
+
+	def __repr__(self):
+		return '<FoodCache {}>'.format(self.query_text)
+
+class ReplicaHeartbeat(db.Model):
+	# Single row written on the primary, its replicated value tells how far the replica lags
+	__tablename__ = 'replica_heartbeat'
+	id = db.Column(db.Integer, primary_key=True)
+	beat = db.Column(db.DateTime, nullable=False)
+
+class DataVersion(db.Model):
+	# Counter per scope ('users', 'user:<id>', 'epoch'), bumped by every write to it
+	__tablename__ = 'data_version'
+	scope = db.Column(db.String(64), primary_key=True)
+	version = db.Column(db.Integer, nullable=False, default=0)
+
+class ArchivedEntry(db.Model):
+	# Entries older than the archive horizon, moved out of entry (ids kept) by 'flask archive-entries'
+	__tablename__ = 'entry_archive'
+	__table_args__ = (
+		db.Index('ix_entry_archive_user_date_time', 'user_id', 'date', 'time'),
+	)
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+	date = db.Column(db.Date, nullable=False)
+	time = db.Column(db.Time, nullable=False)
+	text = db.Column(db.String(256), nullable=False)
+	calories = db.Column(db.Integer, nullable=False)
+	is_below_expected = db.Column(db.Boolean)
+	calorie_status = db.Column(db.String(16), nullable=False, default='resolved', server_default='resolved')
+
+class MonthlyTotal(db.Model):
+	# Per-user, per-month rollup of archived entries, rebuilt from entry_archive
+	__tablename__ = 'monthly_total'
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	month = db.Column(db.Date, primary_key=True)
+	days_logged = db.Column(db.Integer, nullable=False, default=0)
+	entry_count = db.Column(db.Integer, nullable=False, default=0)
+	total_calories = db.Column(db.Integer, nullable=False, default=0)
+	# Days at or over the user's expected_calories, which rebuilds follow when it changes
+	days_over_budget = db.Column(db.Integer, nullable=False, default=0)
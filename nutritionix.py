@@ -1,11 +1,143 @@
 import requests
 import os
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
+from flask import current_app, has_app_context
+from cache import TTLCache
+from models import db, FoodCache
+import metrics
 from dotenv import load_dotenv
 load_dotenv()
 
-def get_calories(food_name):
+# Defaults used when the corresponding NUTRITIONIX_* setting is missing from the app config
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_NEGATIVE_CACHE_TTL = 60 * 60
+DEFAULT_API_URL = 'https://trackapi.nutritionix.com/v2/search/instant'
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 5
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF_FACTOR = 0.3
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30
+
+_memory_cache = None
+_stats = { 'persistent_hits': 0, 'persistent_misses': 0 }
+_lock = threading.Lock()
+
+def _setting(name, default):
+    return current_app.config.get(name, default) if has_app_context() else default
+
+def _get_memory_cache():
+    global _memory_cache
+    if _memory_cache is None:
+        with _lock:
+            if _memory_cache is None:
+                _memory_cache = TTLCache(maxsize=_setting('NUTRITIONIX_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return _memory_cache
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+def normalize_query(food_name):
+    # "  Banana " and "banana" share a cache entry
+    return ' '.join(str(food_name).lower().split())
+
+class NutritionixUnavailable(Exception):
+    """Raised when Nutritionix cannot be reached or the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures, then lets a trial request through."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.state != 'half-open':
+                return self.state == 'closed'
+            # Only one trial request while half-open, the others keep failing fast
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+_session = None
+_breaker = None
+
+def _get_session():
+    # Shared keep-alive connection pool with bounded retries and exponential backoff
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                retries = Retry(
+                    total=_setting('NUTRITIONIX_RETRIES', DEFAULT_RETRIES),
+                    backoff_factor=_setting('NUTRITIONIX_BACKOFF_FACTOR', DEFAULT_BACKOFF_FACTOR),
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    # The instant search endpoint is a read, so retrying the POST is safe
+                    allowed_methods=frozenset(['POST']),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_maxsize=_setting('NUTRITIONIX_POOL_SIZE', DEFAULT_POOL_SIZE),
+                    max_retries=retries
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+def _get_breaker():
+    global _breaker
+    if _breaker is None:
+        with _lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=_setting('NUTRITIONIX_BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD),
+                    reset_timeout=_setting('NUTRITIONIX_BREAKER_RESET', DEFAULT_BREAKER_RESET)
+                )
+    return _breaker
+
+def reset_client():
+    # Drop the pooled session and breaker so they are rebuilt from the current settings
+    global _session, _breaker
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _breaker = None
+
+def fetch_calories(food_name):
     api_key = os.getenv('NUTRITIONIX_API_KEY')
-    api_endpoint = 'https://trackapi.nutritionix.com/v2/search/instant'
+    api_endpoint = _setting('NUTRITIONIX_API_URL', DEFAULT_API_URL)
 
     # Set the request headers
     headers = {
@@ -20,20 +152,113 @@ def get_calories(food_name):
         'detailed': True
     }
 
+    breaker = _get_breaker()
+    if not breaker.allow():
+        metrics.nutritionix_requests.inc('circuit_open')
+        raise NutritionixUnavailable('Nutritionix circuit breaker is open')
+
     # Send the POST request to the API
-    response = requests.post(api_endpoint, headers=headers, json=payload)
+    timeout = (
+        _setting('NUTRITIONIX_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+        _setting('NUTRITIONIX_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)
+    )
+    started = time.perf_counter()
+    try:
+        response = _get_session().post(api_endpoint, headers=headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        # Parse the response JSON and extract the calorie data
+        data = response.json()
+    except (requests.RequestException, ValueError) as error:
+        breaker.record_failure()
+        _observe('error', started)
+        raise NutritionixUnavailable(str(error)) from error
+    breaker.record_success()
 
-    # Parse the response JSON and extract the calorie data
-    data = response.json()
     if 'common' in data and len(data['common']) > 0:
         item = data['branded'][0]
         food_name = item['food_name']
         calories = item['nf_calories']
+        _observe('found', started)
         return food_name, calories
     else:
+        _observe('not_found', started)
         return None, None
-    
+
+def _observe(outcome, started):
+    metrics.nutritionix_requests.inc(outcome)
+    metrics.nutritionix_duration.observe(time.perf_counter() - started, outcome)
+
+def _load_persistent(query):
+    row = db.session.execute(
+        db.select(FoodCache.food_name, FoodCache.calories, FoodCache.expires_at)
+        .where(FoodCache.query_text == query, FoodCache.expires_at > datetime.utcnow())
+    ).first()
+    if row is None:
+        return None
+    return (row.food_name, row.calories), row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+def _store_persistent(query, result, ttl):
+    values = {
+        'food_name': result[0],
+        'calories': result[1],
+        'expires_at': datetime.utcnow() + timedelta(seconds=ttl)
+    }
+    # Written on its own connection so the caller's transaction is left untouched
+    try:
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                db.update(FoodCache).where(FoodCache.query_text == query).values(**values)
+            ).rowcount
+            if not updated:
+                connection.execute(db.insert(FoodCache).values(query_text=query, **values))
+    except Exception:
+        # The cache is best effort, a failed write only costs a future lookup
+        pass
+
+def get_calories(food_name):
+    # Look the food up in the in-process LRU, then the food_cache table, then Nutritionix
+    query = normalize_query(food_name)
+    memory_cache = _get_memory_cache()
+    result = memory_cache.get(query)
+    if result is not None:
+        return result
+
+    if has_app_context():
+        cached = _load_persistent(query)
+        if cached is not None:
+            _count('persistent_hits')
+            result, expires_at = cached
+            memory_cache.set(query, result, expires_at=expires_at)
+            return result
+    _count('persistent_misses')
+
+    result = fetch_calories(food_name)
+    # Foods that were not found are cached for a shorter time
+    if result[1] is not None:
+        ttl = _setting('NUTRITIONIX_CACHE_TTL', DEFAULT_CACHE_TTL)
+    else:
+        ttl = _setting('NUTRITIONIX_NEGATIVE_CACHE_TTL', DEFAULT_NEGATIVE_CACHE_TTL)
+    memory_cache.set(query, result, ttl)
+    if has_app_context():
+        _store_persistent(query, result, ttl)
+    return result
+
+def cache_stats():
+    memory_cache = _get_memory_cache()
+    with _lock:
+        return {
+            'memory_hits': memory_cache.hits,
+            'memory_misses': memory_cache.misses,
+            'memory_size': len(memory_cache),
+            'persistent_hits': _stats['persistent_hits'],
+            'persistent_misses': _stats['persistent_misses']
+        }
+
+def clear_cache():
+    # Empties the in-process tier, the food_cache table is left as is
+    _get_memory_cache().clear()
+
 if __name__ == '__main__':
 	str = input('Enter food name: ')
 	food_name, calories = get_calories(str)
-	print(food_name, calories)
\ No newline at end of file
+	print(food_name, calories)
@@ -0,0 +1,26 @@
+from sqlalchemy import event
+
+"""
+# SQLITE TUNING #
+
+SQLite keeps most of its tuning in per-connection PRAGMAs, so the settings in
+SQLITE_PRAGMAS are applied to every connection the engine opens. In
+production the database runs in WAL mode, where readers no longer block on a
+writer. Writers wait up to busy_timeout milliseconds for the write lock
+instead of failing with "database is locked" right away.
+
+"""
+
+def configure_sqlite(engine, pragmas):
+	# Run 'PRAGMA name = value' on each new connection, returns False for other databases
+	if engine.dialect.name != 'sqlite' or not pragmas:
+		return False
+
+	@event.listens_for(engine, 'connect')
+	def set_pragmas(dbapi_connection, connection_record):
+		cursor = dbapi_connection.cursor()
+		for name, value in pragmas.items():
+			cursor.execute(f'PRAGMA {name} = {value}')
+		cursor.close()
+
+	return True
@@ -0,0 +1,133 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+from datetime import datetime
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+# REQUEST PROFILING #
+
+With PROFILING_ENABLED, a request is profiled when an authenticated admin
+sends the header 'X-Profile: 1', or when its endpoint is listed in
+PROFILE_ENDPOINTS (for the users in PROFILE_USER_IDS, or everyone when that is
+empty), one request in 1 / PROFILE_SAMPLE_RATE. The view runs under cProfile
+while every SQL statement it sends is recorded with its parameters and
+duration. The report (request, SQL statements, then the PROFILE_TOP functions
+by cumulative time) is written to PROFILE_DIR as <id>.txt, next to <id>.prof
+for pstats or snakeviz, and the response links to it in the X-Profile-Report
+header. Reports are served to admins by GET /profiles/<id>. Streamed bodies
+are produced after the profile ends and are not included. Request fields
+named like 'password' are masked, and the SQL parameters of the endpoints in
+CREDENTIAL_ENDPOINTS (which carry passwords and password hashes) are left out.
+
+When PROFILING_ENABLED is off at startup no hook is registered at all.
+
+"""
+
+HEADER = 'X-Profile'
+PARAMETERS_LENGTH = 200
+CREDENTIAL_ENDPOINTS = ('login', 'signup')
+REDACTED = '[redacted]'
+
+def _requested():
+	if request.headers.get(HEADER) == '1':
+		return current_user.is_authenticated and current_user.role == 'admin'
+	if request.endpoint not in current_app.config.get('PROFILE_ENDPOINTS', ()):
+		return False
+	user_ids = current_app.config.get('PROFILE_USER_IDS', ())
+	if user_ids and not (current_user.is_authenticated and current_user.id in user_ids):
+		return False
+	return random.random() < current_app.config.get('PROFILE_SAMPLE_RATE', 1.0)
+
+def _start_request():
+	if not _requested():
+		return
+	g.profile_statements = []
+	g.profile_started = time.perf_counter()
+	g.profiler = cProfile.Profile()
+	try:
+		g.profiler.enable()
+	except ValueError:
+		# Another profiler is already active on this thread
+		g.pop('profiler')
+
+def _end_request(response):
+	profiler = g.pop('profiler', None)
+	if profiler is None:
+		return response
+	profiler.disable()
+	elapsed = time.perf_counter() - g.pop('profile_started')
+	statements = g.pop('profile_statements')
+	name = f'{datetime.utcnow():%Y%m%d-%H%M%S}-{request.endpoint or "unmatched"}-{uuid.uuid4().hex[:8]}'
+	directory = current_app.config.get('PROFILE_DIR')
+	os.makedirs(directory, exist_ok=True)
+	profiler.dump_stats(os.path.join(directory, name + '.prof'))
+	with open(os.path.join(directory, name + '.txt'), 'w') as file:
+		file.write(report(profiler, elapsed, statements, response))
+	response.headers['X-Profile-Report'] = f'/profiles/{name}'
+	return response
+
+def _request_body():
+	# The request body with the value of every password field masked
+	data = request.get_json(silent=True)
+	if isinstance(data, dict):
+		return json.dumps({ key: REDACTED if 'password' in key.lower() else value for key, value in data.items() })
+	if data is None and request.endpoint in CREDENTIAL_ENDPOINTS:
+		return REDACTED
+	return request.get_data(as_text=True)
+
+def report(profiler, elapsed, statements, response):
+	user = f'{current_user.id} ({current_user.username})' if current_user.is_authenticated else 'anonymous'
+	sql_time = sum(duration for _, _, duration in statements)
+	lines = [
+		f'{request.method} {request.full_path.rstrip("?")} -> {response.status_code}',
+		f'endpoint: {request.endpoint}, user: {user}',
+		f'body: {_request_body()[:PARAMETERS_LENGTH]}',
+		f'total: {elapsed * 1000:.2f} ms, SQL: {len(statements)} statements in {sql_time * 1000:.2f} ms',
+		'',
+		'# SQL statements',
+		''
+	]
+	redact_parameters = request.endpoint in CREDENTIAL_ENDPOINTS
+	for number, (statement, parameters, duration) in enumerate(statements, 1):
+		lines.append(f'{number}. {duration * 1000:.3f} ms')
+		lines.append(statement.strip())
+		lines.append(f'parameters: {REDACTED if redact_parameters else repr(parameters)[:PARAMETERS_LENGTH]}')
+		lines.append('')
+	output = io.StringIO()
+	stats = pstats.Stats(profiler, stream=output)
+	stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(current_app.config.get('PROFILE_TOP', 50))
+	lines.extend(['# Profile', output.getvalue()])
+	return '\n'.join(lines)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	if has_request_context() and 'profile_statements' in g:
+		conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	if has_request_context() and 'profile_statements' in g and conn.info.get('profile_started'):
+		g.profile_statements.append((statement, parameters, time.perf_counter() - conn.info['profile_started'].pop()))
+
+def _handle_error(context):
+	# A failed statement never reaches after_cursor_execute
+	started = context.connection.info.get('profile_started') if context.connection is not None else None
+	if started and has_request_context() and 'profile_statements' in g:
+		started.pop()
+
+def init_app(app):
+	if not app.config.get('PROFILING_ENABLED'):
+		return
+	app.before_request(_start_request)
+	app.after_request(_end_request)
+	if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+		event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+		event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+		event.listen(Engine, 'handle_error', _handle_error)
@@ -0,0 +1,79 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+# QUERY BUDGETS #
+
+QueryCounter records every SQL statement sent to any engine while it is
+active, and on SQLite the number of rows each SELECT returns (counted by
+running the same statement wrapped in SELECT count(*) on a separate cursor,
+so the application's own cursor and events are untouched). query_budget()
+fails with QueryBudgetExceeded, listing the statements, when a block runs more
+statements or reads more rows than allowed:
+
+	with query_budget(statements=4, rows=12):
+		client.get('/records', json={ 'limit': 10 })
+
+Meant for tests: counting rows runs every SELECT twice.
+
+"""
+
+class QueryBudgetExceeded(AssertionError):
+	pass
+
+class QueryCounter:
+	"""Statements run, and rows returned by SELECTs, inside a with block."""
+
+	def __init__(self, count_rows=True):
+		self.count_rows = count_rows
+		# (statement, rows returned or None) in execution order
+		self.statements = []
+
+	def __enter__(self):
+		event.listen(Engine, 'after_cursor_execute', self._record)
+		return self
+
+	def __exit__(self, *exc_info):
+		event.remove(Engine, 'after_cursor_execute', self._record)
+
+	@property
+	def count(self):
+		return len(self.statements)
+
+	@property
+	def rows(self):
+		return sum(rows for _, rows in self.statements if rows)
+
+	def _record(self, conn, cursor, statement, parameters, context, executemany):
+		rows = None
+		if self.count_rows and not executemany and conn.dialect.name == 'sqlite' and statement.split(None, 1)[0].upper() in ('SELECT', 'WITH'):
+			counter = conn.connection.cursor()
+			try:
+				rows = counter.execute(f'SELECT count(*) FROM ({statement})', parameters).fetchone()[0]
+			except conn.dialect.dbapi.Error:
+				pass
+			finally:
+				counter.close()
+		self.statements.append((statement, rows))
+
+	def report(self):
+		lines = [f'{self.count} statements, {self.rows} rows:']
+		for number, (statement, rows) in enumerate(self.statements, 1):
+			lines.append(f'{number}. [{"?" if rows is None else rows} rows] {" ".join(statement.split())}')
+		return '\n'.join(lines)
+
+	def check(self, statements=None, rows=None):
+		problems = []
+		if statements is not None and self.count > statements:
+			problems.append(f'{self.count} statements (budget {statements})')
+		if rows is not None and self.rows > rows:
+			problems.append(f'{self.rows} rows (budget {rows})')
+		if problems:
+			raise QueryBudgetExceeded(f'Query budget exceeded: {", ".join(problems)}\n{self.report()}')
+
+@contextmanager
+def query_budget(statements=None, rows=None):
+	with QueryCounter(count_rows=rows is not None) as counter:
+		yield counter
+	counter.check(statements, rows)
@@ -0,0 +1,98 @@
+from sqlalchemy.orm import aliased
+from models import db, User, Entry, ArchivedEntry
+import archive
+
+"""
+# IS_BELOW_EXPECTED RECOMPUTATION #
+
+An entry's is_below_expected flag records whether the user's running total for
+that day, up to and including the entry (ordered by time, then id), is below
+the user's expected_calories. Edits, deletions and target changes make flags
+stale, so they are recomputed here with set-based UPDATE statements instead of
+loading entries through the ORM. Whole days and whole users are recomputed
+from a SUM() OVER window in one pass; arbitrary id ranges, which can split a
+day, use a correlated running total per row. A day can have entries in both
+entry and entry_archive (see archive.py), so running totals cover both tiers.
+
+"""
+
+def _flag_expression():
+	# Running total of the day's entries, in either tier, up to the row being updated
+	running_total = 0
+	for tier in (aliased(Entry), ArchivedEntry):
+		running_total += db.select(db.func.coalesce(db.func.sum(tier.calories), 0)) \
+			.where(
+				tier.user_id == Entry.user_id,
+				tier.date == Entry.date,
+				db.or_(tier.time < Entry.time, db.and_(tier.time == Entry.time, tier.id <= Entry.id))
+			).scalar_subquery()
+	expected_calories = db.select(User.expected_calories) \
+		.where(User.id == Entry.user_id) \
+		.scalar_subquery()
+	return running_total < expected_calories
+
+def _update_flags(*criteria):
+	result = db.session.execute(
+		db.update(Entry)
+		.where(*criteria)
+		.values(is_below_expected=_flag_expression())
+		.execution_options(synchronize_session=False)
+	)
+	return result.rowcount
+
+def _update_scope_flags(user_id, date=None, model=Entry):
+	# Flags of model's entries for a user's day, or all of their days; the window holds every entry of a day from both tiers
+	rows = db.union_all(*(
+		db.select(tier.id, tier.user_id, tier.date, tier.time, tier.calories, db.literal(tier.__tablename__).label('tier'))
+		.where(tier.user_id == user_id, *((tier.date == date,) if date is not None else ()))
+		for tier in (Entry, ArchivedEntry)
+	)).subquery()
+	running_total = db.func.sum(rows.c.calories).over(
+		partition_by=(rows.c.user_id, rows.c.date),
+		order_by=(rows.c.time, rows.c.id)
+	)
+	totals = db.select(rows.c.id, rows.c.tier, running_total.label('running_total')).subquery()
+	expected_calories = db.select(User.expected_calories) \
+		.where(User.id == model.user_id) \
+		.scalar_subquery()
+	result = db.session.execute(
+		db.update(model)
+		.where(model.id == totals.c.id, totals.c.tier == model.__tablename__)
+		.values(is_below_expected=totals.c.running_total < expected_calories)
+		.execution_options(synchronize_session=False)
+	)
+	return result.rowcount
+
+def recompute_day(user_id, date):
+	# Recompute flags for a single (user, date) scope
+	return _update_scope_flags(user_id, date)
+
+def recompute_days(scopes):
+	# Recompute flags for each distinct (user, date) scope, one UPDATE per scope
+	updated = 0
+	for user_id, date in set(scopes):
+		updated += recompute_day(user_id, date)
+	return updated
+
+def recompute_user(user_id, archived=True):
+	# Recompute flags for every entry of a user, e.g. after expected_calories changes
+	updated = _update_scope_flags(user_id)
+	if archived:
+		# Archived entries and the days over budget of their monthly rollups depend on the target too
+		updated += _update_scope_flags(user_id, model=ArchivedEntry)
+		archive.rebuild_monthly_totals([user_id])
+	return updated
+
+def rebuild_all_flags(chunk_size=10000, progress=None):
+	# Recompute every flag in id ranges of chunk_size rows, committing after each chunk
+	low, high = db.session.execute(db.select(db.func.min(Entry.id), db.func.max(Entry.id))).one()
+	if low is None:
+		return 0
+
+	updated = 0
+	for start in range(low, high + 1, chunk_size):
+		updated += _update_flags(Entry.id >= start, Entry.id < start + chunk_size)
+		db.session.commit()
+		if progress:
+			progress(updated)
+	return updated
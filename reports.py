@@ -0,0 +1,324 @@
+import threading
+from datetime import date, datetime, timedelta
+from flask import current_app
+from cache import TTLCache
+from models import db, User, Entry, DailyTotal, ArchivedEntry, MonthlyTotal
+import versions
+
+"""
+# REPORTING #
+
+Reports are aggregated in the database from the daily_total rollup, grouped
+by day, week (starting on Monday) or month, plus a GROUP BY over entry for the
+most logged foods. Archived entries (see archive.py) are added in the same
+statement: whole months of a monthly report from the monthly_total rollup,
+unless some of their days are still in daily_total, anything else by summing
+entry_archive per day and merging it with daily_total day by day. Periods that
+ended before today only change when a user's records or target are edited, so
+their results are cached per process, keyed by the user's data version (see
+versions.py): every write bumps it in its own transaction, whichever process
+handles it, and the next report reads it with one primary key lookup.
+
+"""
+
+GRANULARITIES = ('day', 'week', 'month')
+
+_cache = None
+_lock = threading.Lock()
+
+def _get_cache():
+	global _cache
+	with _lock:
+		if _cache is None:
+			_cache = TTLCache(
+				maxsize=current_app.config.get('REPORT_CACHE_SIZE', 10000),
+				ttl=current_app.config.get('REPORT_CACHE_TTL', 24 * 60 * 60)
+			)
+	return _cache
+
+def _data_version(user_id):
+	return versions.current(versions.EPOCH, versions.user_scope(user_id))
+
+def period_start(day, granularity):
+	if granularity == 'week':
+		return day - timedelta(days=day.weekday())
+	if granularity == 'month':
+		return day.replace(day=1)
+	return day
+
+def period_end(start, granularity):
+	if granularity == 'week':
+		return start + timedelta(days=6)
+	if granularity == 'month':
+		return (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+	return start
+
+def period_start_expression(column, granularity):
+	# SQL expression mapping a date column to the first day of its period
+	if db.engine.dialect.name == 'sqlite':
+		if granularity == 'week':
+			return db.func.date(column, '-6 days', 'weekday 1')
+		if granularity == 'month':
+			return db.func.strftime('%Y-%m-01', column)
+		return column
+	if granularity == 'day':
+		return column
+	return db.cast(db.func.date_trunc(granularity, column), db.Date)
+
+def _as_date(value):
+	if isinstance(value, str):
+		return date.fromisoformat(value)
+	if isinstance(value, datetime):
+		return value.date()
+	return value
+
+def _whole_months(date_from, date_to):
+	# First and last month lying entirely within [date_from, date_to], or None
+	first = period_start(date_from, 'month')
+	if first < date_from:
+		first = period_end(first, 'month') + timedelta(days=1)
+	last = period_start(date_to, 'month')
+	if period_end(last, 'month') > date_to:
+		last = period_start(last - timedelta(days=1), 'month')
+	return (first, last) if first <= last else None
+
+def _archived_days(*criteria):
+	# Per-day totals of archived entries, the daily_total of the archive tier
+	return db.select(
+		ArchivedEntry.user_id,
+		ArchivedEntry.date,
+		db.func.sum(ArchivedEntry.calories).label('total_calories'),
+		db.func.count(ArchivedEntry.id).label('entry_count')
+	).where(*criteria).group_by(ArchivedEntry.user_id, ArchivedEntry.date).subquery()
+
+def _hot_months(user_filter, months):
+	# (user, month) of the whole months that also have days in daily_total, their monthly_total is incomplete
+	month = period_start_expression(DailyTotal.date, 'month')
+	return db.select(DailyTotal.user_id, month).where(
+		user_filter(DailyTotal.user_id),
+		DailyTotal.entry_count > 0,
+		DailyTotal.date.between(months[0], period_end(months[1], 'month'))
+	).distinct()
+
+def _rolled_up_months(user_filter, months):
+	# monthly_total rows standing in for every day of a whole month in range
+	return db.select(MonthlyTotal).where(
+		user_filter(MonthlyTotal.user_id),
+		MonthlyTotal.month.between(*months),
+		db.tuple_(MonthlyTotal.user_id, MonthlyTotal.month).not_in(_hot_months(user_filter, months))
+	).subquery()
+
+def _tiered_days(user_filter, date_from, date_to, months=None):
+	# Per-(user, day) totals of both tiers, a day can have entries in each; days in the months served
+	# by _rolled_up_months are left out
+	archived = [user_filter(ArchivedEntry.user_id), ArchivedEntry.date >= date_from, ArchivedEntry.date <= date_to]
+	if months:
+		archived.append(db.or_(
+			db.not_(ArchivedEntry.date.between(months[0], period_end(months[1], 'month'))),
+			db.tuple_(ArchivedEntry.user_id, period_start_expression(ArchivedEntry.date, 'month')).in_(_hot_months(user_filter, months))
+		))
+	archived_days = _archived_days(*archived)
+	combined = db.union_all(
+		db.select(DailyTotal.user_id, DailyTotal.date, DailyTotal.total_calories, DailyTotal.entry_count).where(
+			user_filter(DailyTotal.user_id),
+			DailyTotal.entry_count > 0,
+			DailyTotal.date >= date_from,
+			DailyTotal.date <= date_to
+		),
+		db.select(archived_days.c.user_id, archived_days.c.date, archived_days.c.total_calories, archived_days.c.entry_count)
+	).subquery()
+	return db.select(
+		combined.c.user_id,
+		combined.c.date,
+		db.func.sum(combined.c.total_calories).label('total_calories'),
+		db.func.sum(combined.c.entry_count).label('entry_count')
+	).group_by(combined.c.user_id, combined.c.date).subquery()
+
+def _summarize_periods(user, date_from, date_to, granularity):
+	# One GROUP BY over the days of both tiers and the monthly rollups for the whole range, keyed by period start
+	user_filter = lambda column: column == user.id
+	months = _whole_months(date_from, date_to) if granularity == 'month' else None
+	days = _tiered_days(user_filter, date_from, date_to, months)
+	start = period_start_expression(days.c.date, granularity).label('period')
+	sources = [
+		db.select(
+			start,
+			db.func.count().label('days_logged'),
+			db.func.sum(days.c.entry_count).label('entry_count'),
+			db.func.sum(days.c.total_calories).label('total_calories'),
+			db.func.sum(db.case((days.c.total_calories >= user.expected_calories, 1), else_=0)).label('days_over_budget')
+		).group_by(start)
+	]
+	if months:
+		rolled_up = _rolled_up_months(user_filter, months)
+		sources.append(db.select(rolled_up.c.month, rolled_up.c.days_logged, rolled_up.c.entry_count, rolled_up.c.total_calories, rolled_up.c.days_over_budget))
+	combined = db.union_all(*sources).subquery()
+	rows = db.session.execute(
+		db.select(
+			combined.c.period,
+			db.func.sum(combined.c.days_logged),
+			db.func.sum(combined.c.entry_count),
+			db.func.sum(combined.c.total_calories),
+			db.func.sum(combined.c.days_over_budget)
+		).group_by(combined.c.period)
+	).all()
+	return {
+		_as_date(period): {
+			'days_logged': days_logged,
+			'entry_count': entry_count,
+			'total_calories': total_calories,
+			'days_over_budget': days_over_budget
+		} for period, days_logged, entry_count, total_calories, days_over_budget in rows
+	}
+
+def top_foods(user_ids, date_from, date_to, limit=5):
+	rows = db.union_all(*(
+		db.select(model.text, model.calories)
+		.where(model.user_id.in_(user_ids), model.date >= date_from, model.date <= date_to)
+		for model in (Entry, ArchivedEntry)
+	)).subquery()
+	foods = db.session.execute(
+		db.select(db.func.lower(rows.c.text).label('food'), db.func.count(), db.func.sum(rows.c.calories))
+		.group_by('food')
+		.order_by(db.func.count().desc(), 'food')
+		.limit(limit)
+	).all()
+	return [{ 'text': food, 'count': count, 'total_calories': total_calories } for food, count, total_calories in foods]
+
+def daily_totals(user, date_from=None, date_to=None):
+	# (date, total_calories, entry_count) of every logged day in range, from both tiers
+	hot = [DailyTotal.user_id == user.id, DailyTotal.entry_count > 0]
+	archived = [ArchivedEntry.user_id == user.id]
+	if date_from:
+		hot.append(DailyTotal.date >= date_from)
+		archived.append(ArchivedEntry.date >= date_from)
+	if date_to:
+		hot.append(DailyTotal.date <= date_to)
+		archived.append(ArchivedEntry.date <= date_to)
+	days = _archived_days(*archived)
+	combined = db.union_all(
+		db.select(DailyTotal.date, DailyTotal.total_calories, DailyTotal.entry_count).where(*hot),
+		db.select(days.c.date, days.c.total_calories, days.c.entry_count)
+	).subquery()
+	return db.session.execute(
+		db.select(combined.c.date, db.func.sum(combined.c.total_calories), db.func.sum(combined.c.entry_count))
+		.group_by(combined.c.date)
+		.order_by(combined.c.date)
+	).all()
+
+def summarize_user(user, date_from, date_to, granularity='day', top=5):
+	cache = _get_cache()
+	# Entries cached under an older version are never read again and age out of the cache
+	version = _data_version(user.id)
+	today = date.today()
+
+	# Split the range into periods, clipped to [date_from, date_to]
+	periods = []
+	day = period_start(date_from, granularity)
+	while day <= date_to:
+		periods.append((max(day, date_from), min(period_end(day, granularity), date_to)))
+		day = period_end(day, granularity) + timedelta(days=1)
+
+	results = {}
+	missing = []
+	for first, last in periods:
+		cached = cache.get((user.id, version, granularity, first, last)) if last < today else None
+		if cached is None:
+			missing.append((first, last))
+		else:
+			results[first] = cached
+	if missing:
+		computed = _summarize_periods(user, missing[0][0], missing[-1][1], granularity)
+		for first, last in missing:
+			summary = computed.get(period_start(first, granularity), { 'days_logged': 0, 'entry_count': 0, 'total_calories': 0, 'days_over_budget': 0 })
+			results[first] = summary
+			# Periods that are over can be reused until the user's data changes
+			if last < today:
+				cache.set((user.id, version, granularity, first, last), summary)
+
+	top_key = (user.id, version, 'top', date_from, date_to, top)
+	foods = cache.get(top_key) if date_to < today else None
+	if foods is None:
+		foods = top_foods([user.id], date_from, date_to, top)
+		if date_to < today:
+			cache.set(top_key, foods)
+
+	report = []
+	for first, last in periods:
+		summary = results[first]
+		if not summary['days_logged']:
+			continue
+		report.append(dict(summary,
+			period=str(first),
+			average_calories=summary['total_calories'] / summary['days_logged']
+		))
+
+	totals = { key: sum(period[key] for period in report) for key in ('days_logged', 'entry_count', 'total_calories', 'days_over_budget') }
+	totals['average_calories'] = totals['total_calories'] / totals['days_logged'] if totals['days_logged'] else 0
+	return { 'periods': report, 'totals': totals, 'top_foods': foods }
+
+def summarize_users(date_from, date_to, page=None, limit=None):
+	# Per-user totals for one page of non-manager users, one GROUP BY over daily_total and the archive
+	users = db.select(User.id).where(User.role != 'manager').order_by(User.id)
+	if page != None and limit != None:
+		users = users.offset((page - 1) * limit)
+	users = users.limit(limit).subquery()
+
+	user_filter = lambda column: column.in_(db.select(users.c.id))
+	months = _whole_months(date_from, date_to)
+	days = _tiered_days(user_filter, date_from, date_to, months)
+	sources = [
+		db.select(
+			days.c.user_id,
+			db.func.count().label('days_logged'),
+			db.func.sum(days.c.entry_count).label('entry_count'),
+			db.func.sum(days.c.total_calories).label('total_calories'),
+			db.func.sum(db.case((days.c.total_calories >= User.expected_calories, 1), else_=0)).label('days_over_budget')
+		)
+		.join(User, User.id == days.c.user_id)
+		.group_by(days.c.user_id)
+	]
+	if months:
+		rolled_up = _rolled_up_months(user_filter, months)
+		sources.append(
+			db.select(
+				rolled_up.c.user_id,
+				db.func.sum(rolled_up.c.days_logged),
+				db.func.sum(rolled_up.c.entry_count),
+				db.func.sum(rolled_up.c.total_calories),
+				db.func.sum(rolled_up.c.days_over_budget)
+			)
+			.group_by(rolled_up.c.user_id)
+		)
+	combined = db.union_all(*sources).subquery()
+	totals = db.select(
+		combined.c.user_id,
+		db.func.sum(combined.c.days_logged).label('days_logged'),
+		db.func.sum(combined.c.entry_count).label('entry_count'),
+		db.func.sum(combined.c.total_calories).label('total_calories'),
+		db.func.sum(combined.c.days_over_budget).label('days_over_budget')
+	).group_by(combined.c.user_id).subquery()
+
+	query = db.select(
+			User.id,
+			User.username,
+			User.expected_calories,
+			db.func.coalesce(totals.c.days_logged, 0),
+			db.func.coalesce(totals.c.entry_count, 0),
+			db.func.coalesce(totals.c.total_calories, 0),
+			db.func.coalesce(totals.c.days_over_budget, 0)
+		) \
+		.select_from(users) \
+		.join(User, User.id == users.c.id) \
+		.outerjoin(totals, totals.c.user_id == User.id) \
+		.order_by(User.id)
+	return [{
+		'user_id': user_id,
+		'username': username,
+		'expected_calories': expected_calories,
+		'days_logged': logged,
+		'entry_count': entry_count,
+		'total_calories': total,
+		'average_calories': total / logged if logged else 0,
+		'days_over_budget': over_budget
+	} for user_id, username, expected_calories, logged, entry_count, total, over_budget in db.session.execute(query)]
@@ -0,0 +1,131 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from models import db, Entry, DailyTotal
+from nutritionix import get_calories, normalize_query, NutritionixUnavailable
+from recompute import recompute_days
+import versions
+
+"""
+# BACKGROUND CALORIE RESOLUTION #
+
+POST /records can store an entry before its calories are known. Such entries
+are saved with calories = 0 and calorie_status = 'pending', and a background
+thread resolves them in batches: distinct food names are looked up
+concurrently, each entry is updated, the daily rollup is adjusted and the
+affected days' flags are recomputed. Foods unknown to Nutritionix leave the
+entry 'failed'. While Nutritionix is unavailable entries stay 'pending' and are
+picked up again by the next drain or by the 'resolve-pending' command.
+
+"""
+
+_lock = threading.Lock()
+_lookup_pool = None
+_draining = False
+_rerun = False
+
+def _get_lookup_pool(app):
+	global _lookup_pool
+	with _lock:
+		if _lookup_pool is None:
+			_lookup_pool = ThreadPoolExecutor(
+				max_workers=app.config.get('CALORIE_RESOLVER_WORKERS', 4),
+				thread_name_prefix='calorie-lookup'
+			)
+	return _lookup_pool
+
+def lookup_calories(app, texts):
+	# Look up each distinct food once, concurrently.
+	# Returns {normalized text: (food_name, calories) or NutritionixUnavailable}.
+	def lookup(text):
+		with app.app_context():
+			try:
+				return get_calories(text)
+			except NutritionixUnavailable as error:
+				return error
+
+	queries = {}
+	for text in texts:
+		queries.setdefault(normalize_query(text), text)
+	results = _get_lookup_pool(app).map(lookup, queries.values())
+	return dict(zip(queries.keys(), results))
+
+def resolve_pending(app, batch_size=100):
+	# Resolve one batch of pending entries and return how many were settled
+	pending = db.session.execute(
+		db.select(Entry.id, Entry.user_id, Entry.date, Entry.text)
+		.where(Entry.calorie_status == 'pending')
+		.order_by(Entry.id)
+		.limit(batch_size)
+	).all()
+	if not pending:
+		return 0
+
+	results = lookup_calories(app, [entry.text for entry in pending])
+	settled = 0
+	scopes = set()
+	for entry in pending:
+		result = results[normalize_query(entry.text)]
+		if isinstance(result, NutritionixUnavailable):
+			continue
+		food_name, calories = result
+		if calories is None:
+			values = { 'calorie_status': 'failed' }
+		else:
+			values = { 'calorie_status': 'resolved', 'calories': calories, 'text': food_name }
+		# Only the worker that flips the status applies the rollup delta
+		claimed = db.session.execute(
+			db.update(Entry)
+			.where(Entry.id == entry.id, Entry.calorie_status == 'pending')
+			.values(**values)
+			.execution_options(synchronize_session=False)
+		).rowcount
+		if not claimed:
+			continue
+		settled += 1
+		if calories is not None:
+			DailyTotal.apply(entry.user_id, entry.date, calories, 0)
+			scopes.add((entry.user_id, entry.date))
+	recompute_days(scopes)
+	if scopes:
+		versions.entries_changed(*{ user_id for user_id, date in scopes })
+	db.session.commit()
+	return settled
+
+def resolve_all_pending(app, batch_size=100, progress=None):
+	# Drain pending entries until none are left or Nutritionix stops answering
+	total = 0
+	while True:
+		settled = resolve_pending(app, batch_size)
+		if not settled:
+			return total
+		total += settled
+		if progress:
+			progress(total)
+
+def _drain(app):
+	global _draining, _rerun
+	while True:
+		with app.app_context():
+			try:
+				resolve_all_pending(app, app.config.get('CALORIE_RESOLVER_BATCH_SIZE', 100))
+			except Exception:
+				app.logger.exception('Background calorie resolution failed')
+			finally:
+				db.session.remove()
+		with _lock:
+			if not _rerun:
+				_draining = False
+				return
+			_rerun = False
+
+def submit(app):
+	# Wake the background resolver, at most one drain thread runs per process
+	global _draining, _rerun
+	if not app.config.get('CALORIE_RESOLVER_ENABLED', True):
+		return
+	with _lock:
+		if _draining:
+			_rerun = True
+			return
+		_draining = True
+	threading.Thread(target=_drain, args=(app,), name='calorie-resolver', daemon=True).start()
@@ -0,0 +1,102 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, g
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from models import db, ReplicaHeartbeat
+from pragmas import configure_sqlite
+
+"""
+# READ REPLICA ROUTING #
+
+When DATABASE_REPLICA_URL is set, views decorated with read_only() run their
+queries on the replica, while every other view (and anything flushed) uses the
+primary. Whether the replica may be used is checked at most once every
+REPLICA_CHECK_INTERVAL seconds: the check writes the current time to the
+replica_heartbeat row on the primary, and the replica counts as caught up when
+the beat it has replicated is at most REPLICA_MAX_LAG seconds older than the
+beat written by the previous check. A lagging or unreachable replica sends
+reads to the primary until a later check succeeds, and a read view whose
+replica query fails is run again on the primary.
+
+"""
+
+_lock = threading.Lock()
+_engines = {}
+_state = { 'checked_at': None, 'available': False }
+
+def replica_engine():
+	# Engine of the configured replica, or None when reads go to the primary
+	url = current_app.config.get('DATABASE_REPLICA_URL')
+	if not url:
+		return None
+	with _lock:
+		if url not in _engines:
+			engine = create_engine(url, **current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+			configure_sqlite(engine, current_app.config.get('SQLITE_PRAGMAS'))
+			_engines[url] = engine
+		return _engines[url]
+
+def check_replica(engine):
+	# Beat on the primary and return whether the replica has seen the previous beat in time
+	now = datetime.utcnow()
+	max_lag = timedelta(seconds=current_app.config.get('REPLICA_MAX_LAG', 10))
+	try:
+		with db.engine.begin() as connection:
+			previous = connection.execute(db.select(ReplicaHeartbeat.beat).where(ReplicaHeartbeat.id == 1)).scalar()
+			if previous is None:
+				connection.execute(db.insert(ReplicaHeartbeat).values(id=1, beat=now))
+			else:
+				connection.execute(db.update(ReplicaHeartbeat).where(ReplicaHeartbeat.id == 1).values(beat=now))
+		with engine.connect() as connection:
+			replicated = connection.execute(db.select(ReplicaHeartbeat.beat).where(ReplicaHeartbeat.id == 1)).scalar()
+	except DBAPIError:
+		current_app.logger.warning('Replica check failed, reading from the primary', exc_info=True)
+		return False
+	return previous is not None and replicated is not None and replicated >= previous - max_lag
+
+def replica_available():
+	engine = replica_engine()
+	if engine is None:
+		return False
+	with _lock:
+		checked_at = _state['checked_at']
+		available = _state['available']
+	if checked_at is None or time.monotonic() - checked_at >= current_app.config.get('REPLICA_CHECK_INTERVAL', 5):
+		available = check_replica(engine)
+		with _lock:
+			_state.update(checked_at=time.monotonic(), available=available)
+	return available
+
+def mark_unavailable():
+	# Read from the primary until the next check
+	with _lock:
+		_state.update(checked_at=time.monotonic(), available=False)
+
+def read_only(view):
+	# Run a view that only reads on the replica when it is caught up
+	@wraps(view)
+	def wrapper(*args, **kwargs):
+		if not replica_available():
+			return view(*args, **kwargs)
+		g.read_engine = replica_engine()
+		try:
+			return view(*args, **kwargs)
+		except DBAPIError:
+			current_app.logger.warning('Replica query failed, retrying on the primary', exc_info=True)
+			mark_unavailable()
+			db.session.rollback()
+		finally:
+			g.pop('read_engine', None)
+		return view(*args, **kwargs)
+	return wrapper
+
+def reset():
+	with _lock:
+		engines = list(_engines.values())
+		_engines.clear()
+		_state.update(checked_at=None, available=False)
+	for engine in engines:
+		engine.dispose()
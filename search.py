@@ -0,0 +1,94 @@
+import re
+from flask import current_app
+from sqlalchemy import event, table, column
+from models import db, Entry
+
+"""
+# FULL-TEXT SEARCH #
+
+On SQLite builds with FTS5, entry.text is indexed by the external-content
+table entry_fts, which triggers keep in sync with every insert, update and
+delete on entry (including bulk inserts that bypass the ORM). The records
+'text' filter then matches every word of the query as a token prefix and can
+rank results with bm25. Other databases, or SQLite builds without FTS5, keep
+using the ILIKE filter.
+
+"""
+
+entry_fts = table('entry_fts', column('rowid'), column('text'), column('rank'))
+
+DDL = [
+	"CREATE VIRTUAL TABLE IF NOT EXISTS entry_fts USING fts5(text, content='entry', content_rowid='id')",
+	"""CREATE TRIGGER IF NOT EXISTS entry_fts_insert AFTER INSERT ON entry BEGIN
+		INSERT INTO entry_fts(rowid, text) VALUES (new.id, new.text);
+	END""",
+	"""CREATE TRIGGER IF NOT EXISTS entry_fts_delete AFTER DELETE ON entry BEGIN
+		INSERT INTO entry_fts(entry_fts, rowid, text) VALUES ('delete', old.id, old.text);
+	END""",
+	"""CREATE TRIGGER IF NOT EXISTS entry_fts_update AFTER UPDATE OF text ON entry BEGIN
+		INSERT INTO entry_fts(entry_fts, rowid, text) VALUES ('delete', old.id, old.text);
+		INSERT INTO entry_fts(rowid, text) VALUES (new.id, new.text);
+	END""",
+]
+
+_available = {}
+
+def fts_supported(connection):
+	if connection.dialect.name != 'sqlite':
+		return False
+	return bool(connection.exec_driver_sql("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+def create_search_index(connection):
+	# Create the index and its triggers, returns False when FTS5 is unavailable
+	if not fts_supported(connection):
+		return False
+	for statement in DDL:
+		connection.exec_driver_sql(statement)
+	return True
+
+def rebuild_search_index(connection):
+	# Re-read every entry into the index, for databases indexed before a bulk change
+	if not create_search_index(connection):
+		return False
+	connection.exec_driver_sql("INSERT INTO entry_fts(entry_fts) VALUES ('rebuild')")
+	return True
+
+@event.listens_for(Entry.__table__, 'after_create')
+def _create_with_entry(target, connection, **kw):
+	create_search_index(connection)
+
+@event.listens_for(Entry.__table__, 'before_drop')
+def _drop_with_entry(target, connection, **kw):
+	if connection.dialect.name == 'sqlite':
+		connection.exec_driver_sql('DROP TABLE IF EXISTS entry_fts')
+
+def search_enabled():
+	if not current_app.config.get('SEARCH_FTS_ENABLED', True):
+		return False
+	engine = db.engine
+	if engine not in _available:
+		with engine.connect() as connection:
+			_available[engine] = fts_supported(connection) and connection.exec_driver_sql(
+				"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entry_fts'"
+			).scalar() is not None
+	return _available[engine]
+
+def match_expression(text):
+	# "Banana spl" becomes '"banana"* "spl"*': every word must match a token prefix
+	tokens = re.findall(r'\w+', text.lower())
+	return ' '.join(f'"{token}"*' for token in tokens)
+
+def filter_text(base_query, text):
+	# Restrict a query over Entry to records matching text
+	expression = match_expression(text) if search_enabled() else ''
+	if not expression:
+		return base_query.filter(Entry.text.ilike(f"%{text}%"))
+	return base_query \
+		.join(entry_fts, entry_fts.c.rowid == Entry.id) \
+		.filter(db.text('entry_fts MATCH :fts_query').bindparams(fts_query=expression))
+
+def rank_order(text):
+	# Best matches first (bm25), only meaningful after filter_text joined the index
+	if not text or not search_enabled() or not match_expression(text):
+		return ()
+	return (entry_fts.c.rank,)
@@ -0,0 +1,77 @@
+from flask import current_app, jsonify
+from models import Entry
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+"""
+# RECORD SERIALIZATION #
+
+Record listings select plain column tuples (RECORD_COLUMNS) instead of Entry
+objects and build the response dicts with a RecordFormatter, which formats
+each distinct date and time of a response once. json_response() returns the
+same bytes as jsonify(): when orjson is installed it encodes with it, unless
+the payload holds something orjson writes differently (floats, which it writes
+without Python's exponent format, and non-ASCII or DEL characters, which
+jsonify escapes), in which case it falls back to jsonify.
+
+"""
+
+RECORD_COLUMNS = (Entry.id, Entry.text, Entry.date, Entry.time, Entry.calories, Entry.is_below_expected)
+
+class _Strings(dict):
+	# str() of each distinct value, computed on first use
+	def __missing__(self, value):
+		text = self[value] = str(value)
+		return text
+
+class RecordFormatter:
+	"""Builds the record dicts of one response from RECORD_COLUMNS rows."""
+
+	def __init__(self):
+		self.strings = _Strings()
+		self.floats = False
+
+	def records(self, rows):
+		strings = self.strings
+		records = [{
+			'id': id,
+			'text': text,
+			'date': strings[date],
+			'time': strings[time],
+			'calories': calories,
+			'is_below_expected': is_below_expected
+		} for id, text, date, time, calories, is_below_expected in rows]
+		self.floats = self.floats or any(type(record['calories']) is float for record in records)
+		return records
+
+	def record(self, row):
+		# Any row with the RECORD_COLUMNS fields as attributes
+		self.floats = self.floats or type(row.calories) is float
+		return {
+			'id': row.id,
+			'text': row.text,
+			'date': self.strings[row.date],
+			'time': self.strings[row.time],
+			'calories': row.calories,
+			'is_below_expected': row.is_below_expected
+		}
+
+	def response(self, payload):
+		return json_response(payload, floats=self.floats)
+
+def json_response(payload, floats=True):
+	# Same response as jsonify(payload), floats=False promises the payload holds no float
+	provider = current_app.json
+	compact = provider.compact if provider.compact is not None else not current_app.debug
+	if orjson is not None and not floats and compact and provider.sort_keys:
+		try:
+			body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+		except TypeError:
+			# e.g. integers beyond 64 bits
+			body = None
+		if body is not None and body.isascii() and b'\x7f' not in body:
+			return current_app.response_class(body, mimetype=provider.mimetype)
+	return jsonify(payload)
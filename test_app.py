@@ -1,9 +1,24 @@
+import csv
+import io
+import json
 import unittest
+from unittest import mock
 from app import app, db
-from models import User
+import resolver
+import identity
+import hashing
+import metrics
+import archive
+import versions
+from models import User, Entry, DailyTotal, ArchivedEntry, MonthlyTotal
 from config import Config
+from werkzeug.security import generate_password_hash
+from sqlalchemy import event
+from datetime import date
 
 import os
+import tempfile
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -158,5 +173,595 @@ class AppTestCase(unittest.TestCase):
 		response = self.app.post('/records', json={ 'text': 'banana' })
 		self.assertTrue(response.get_json()['success'])
 
+	# Testing GET /records/daily (rollup maintained by POST, PUT and DELETE /records)
+	def test_daily_totals(self):
+		self.app.post('/signup', json={ 'username': 'daily_user', 'password': 'daily_user', 'expected_calories': 1000 })
+		response = self.app.post('/login', json={ 'username': 'daily_user', 'password': 'daily_user' })
+		self.assertTrue(response.get_json()['success'])
+		self.app.post('/records', json={ 'text': 'apple', 'calories': 300 })
+		self.app.post('/records', json={ 'text': 'pasta', 'calories': 600 })
+		response = self.app.get('/records/daily', json={})
+		days = response.get_json()['days']
+		self.assertEqual(len(days), 1)
+		self.assertEqual(days[0]['total_calories'], 900)
+		self.assertEqual(days[0]['entry_count'], 2)
+		self.assertTrue(days[0]['is_below_expected'])
+
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.app.put('/records', json={ 'id': records[1]['id'], 'calories': 800 })
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual(days[0]['total_calories'], 1100)
+		self.assertFalse(days[0]['is_below_expected'])
+
+		# Calories that are not a number are rejected and leave the totals alone
+		for calories in ('800', None, True):
+			self.assertEqual(self.app.put('/records', json={ 'id': records[1]['id'], 'calories': calories }).status_code, 400)
+			self.assertEqual(self.app.post('/records', json={ 'text': 'pear', 'calories': calories }).status_code, 400)
+		self.assertEqual(self.app.get('/records/daily', json={}).get_json()['days'][0]['total_calories'], 1100)
+
+		for record in records:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual(days, [])
+		response = self.app.delete('/users', json={ 'username': 'daily_user' })
+		self.assertTrue(response.get_json()['success'])
+
+	# Testing GET /records for an admin without user_id (all users, one page each)
+	def test_admin_records_of_all_users(self):
+		for username in ('all_records_a', 'all_records_b'):
+			self.app.post('/signup', json={ 'username': username, 'password': username, 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		users = self.app.get('/users', json={ 'role': 'user' }).get_json()['users']['users']
+		user_ids = { user['username']: user['user_id'] for user in users }
+		for calories in (100, 200, 300):
+			self.app.post('/records', json={ 'text': 'apple', 'calories': calories, 'user_id': user_ids['all_records_a'] })
+
+		response = self.app.get('/records', json={ 'page': 2, 'limit': 2 })
+		records = response.get_json()['records']
+		self.assertEqual([record['calories'] for record in records['all_records_a']], [300])
+		self.assertEqual(records['all_records_a'][0]['total_count'], 3)
+		self.assertEqual(records['all_records_b'], [])
+
+		response = self.app.get('/records', json={ 'calories_min': 150 })
+		records = response.get_json()['records']
+		self.assertEqual([record['calories'] for record in records['all_records_a']], [200, 300])
+		self.assertEqual(records['all_records_a'][0]['total_count'], 2)
+
+		for record in self.app.get('/records', json={ 'user_id': user_ids['all_records_a'] }).get_json()['records']:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		for username in ('all_records_a', 'all_records_b'):
+			self.assertTrue(self.app.delete('/users', json={ 'username': username }).get_json()['success'])
+
+	# Testing GET /records and GET /users with keyset (cursor) pagination
+	def test_cursor_pagination(self):
+		self.app.post('/signup', json={ 'username': 'cursor_user', 'password': 'cursor_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'cursor_user', 'password': 'cursor_user' })
+		for calories in range(100, 600, 100):
+			self.app.post('/records', json={ 'text': 'apple', 'calories': calories })
+
+		seen = []
+		response = self.app.get('/records', json={ 'cursor': None, 'limit': 2 }).get_json()
+		self.assertNotIn('total_count', response)
+		while True:
+			seen += [record['calories'] for record in response['records']]
+			if not response['next_cursor']:
+				break
+			response = self.app.get('/records', json={ 'cursor': response['next_cursor'], 'limit': 2 }).get_json()
+		self.assertEqual(seen, [100, 200, 300, 400, 500])
+
+		response = self.app.get('/records', json={ 'cursor': None, 'limit': 2, 'with_total': True }).get_json()
+		self.assertEqual(response['total_count'], 5)
+		response = self.app.get('/records', json={ 'cursor': 'not-a-cursor', 'limit': 2 })
+		self.assertEqual(response.status_code, 400)
+		# page/limit requests keep returning total_count
+		response = self.app.get('/records', json={ 'page': 3, 'limit': 2 }).get_json()
+		self.assertEqual([record['calories'] for record in response['records']], [500])
+		self.assertEqual(response['total_count'], 5)
+
+		for record in self.app.get('/records', json={}).get_json()['records']:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'cursor_user' }).get_json()['success'])
+
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		response = self.app.get('/users', json={ 'cursor': None, 'limit': 1 }).get_json()
+		self.assertEqual(response['users']['admins'][0]['username'], 'admin')
+		total = self.app.get('/users', json={}).get_json()['total_count']
+		user_ids = []
+		while True:
+			user_ids += [user['user_id'] for group in response['users'].values() for user in group]
+			if not response['next_cursor']:
+				break
+			response = self.app.get('/users', json={ 'cursor': response['next_cursor'], 'limit': 1 }).get_json()
+		self.assertEqual(len(user_ids), total)
+		self.assertEqual(user_ids, sorted(user_ids))
+
+	# Testing POST /records with background calorie resolution
+	def test_async_calorie_resolution(self):
+		self.app.post('/signup', json={ 'username': 'async_user', 'password': 'async_user', 'expected_calories': 500 })
+		self.app.post('/login', json={ 'username': 'async_user', 'password': 'async_user' })
+		response = self.app.post('/records', json={ 'text': 'Banana', 'async': True })
+		self.assertEqual(response.status_code, 202)
+		pending_id = response.get_json()['id']
+		unknown_id = self.app.post('/records', json={ 'text': 'no such food', 'async': True }).get_json()['id']
+		status = self.app.get('/records/status', json={ 'ids': [pending_id] }).get_json()['records']
+		self.assertEqual(status[0]['calorie_status'], 'pending')
+
+		results = { 'banana': ('banana', 600), 'no such food': (None, None) }
+		with mock.patch('resolver.get_calories', side_effect=lambda text: results[text.lower()]):
+			resolver.resolve_all_pending(app)
+
+		status = { record['id']: record for record in self.app.get('/records/status', json={ 'ids': [pending_id, unknown_id] }).get_json()['records'] }
+		self.assertEqual(status[pending_id]['calorie_status'], 'resolved')
+		self.assertEqual(status[pending_id]['calories'], 600)
+		self.assertEqual(status[unknown_id]['calorie_status'], 'failed')
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual(days[0]['total_calories'], 600)
+		self.assertEqual(days[0]['entry_count'], 2)
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.assertFalse(records[0]['is_below_expected'])
+
+		for record in records:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'async_user' }).get_json()['success'])
+
+	# Testing PUT /records on a record whose calories are still pending
+	def test_edit_pending_record(self):
+		self.app.post('/signup', json={ 'username': 'pending_user', 'password': 'pending_user', 'expected_calories': 500 })
+		self.app.post('/login', json={ 'username': 'pending_user', 'password': 'pending_user' })
+		pending_id = self.app.post('/records', json={ 'text': 'Banana', 'async': True }).get_json()['id']
+		self.app.put('/records', json={ 'id': pending_id, 'calories': 300 })
+
+		with mock.patch('resolver.get_calories', return_value=('banana', 105)):
+			resolver.resolve_all_pending(app)
+
+		record = self.app.get('/records/status', json={ 'ids': [pending_id] }).get_json()['records'][0]
+		self.assertEqual((record['calorie_status'], record['calories']), ('resolved', 300))
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual((days[0]['total_calories'], days[0]['entry_count']), (300, 1))
+
+		self.app.delete('/records', json={ 'id': pending_id })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'pending_user' }).get_json()['success'])
+
+	# Testing POST /records/batch (single transaction, deduplicated lookups)
+	def test_batch_records(self):
+		self.app.post('/signup', json={ 'username': 'batch_user', 'password': 'batch_user', 'expected_calories': 1000 })
+		self.app.post('/login', json={ 'username': 'batch_user', 'password': 'batch_user' })
+		batch = [
+			{ 'text': 'pasta', 'calories': 700, 'date': '2023-06-18', 'time': '19:00:00' },
+			{ 'text': 'Banana', 'date': '2023-06-18', 'time': '08:00:00' },
+			{ 'text': 'banana ', 'date': '2023-06-19', 'time': '08:00:00' }
+		]
+		with mock.patch('resolver.get_calories', return_value=('banana', 400)) as get_calories:
+			response = self.app.post('/records/batch', json={ 'records': batch })
+		self.assertTrue(response.get_json()['success'])
+		self.assertEqual(response.get_json()['count'], 3)
+		self.assertEqual(get_calories.call_count, 1)
+
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.assertEqual([(record['date'], record['calories'], record['is_below_expected']) for record in records], [
+			('2023-06-18', 400, True),
+			('2023-06-18', 700, False),
+			('2023-06-19', 400, True)
+		])
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual([(day['total_calories'], day['entry_count']) for day in days], [(1100, 2), (400, 1)])
+
+		# Unknown foods reject the whole batch
+		with mock.patch('resolver.get_calories', return_value=(None, None)):
+			response = self.app.post('/records/batch', json={ 'records': [{ 'text': 'apple', 'calories': 50 }, { 'text': 'no such food' }] })
+		self.assertFalse(response.get_json()['success'])
+		self.assertEqual(response.get_json()['records'], [1])
+		self.assertEqual(len(self.app.get('/records', json={}).get_json()['records']), 3)
+
+		# So do calories that are not a number
+		for calories in ('50', None, False):
+			response = self.app.post('/records/batch', json={ 'records': [{ 'text': 'apple', 'calories': 50 }, { 'text': 'pear', 'calories': calories }] })
+			self.assertEqual(response.status_code, 400)
+		# And text that is missing, empty or not a string
+		for text in (None, '  ', 5):
+			response = self.app.post('/records/batch', json={ 'records': [{ 'text': 'apple', 'calories': 50 }, { 'text': text, 'calories': 5 }] })
+			self.assertEqual(response.status_code, 400)
+		self.assertEqual(len(self.app.get('/records', json={}).get_json()['records']), 3)
+
+		for record in records:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'batch_user' }).get_json()['success'])
+
+	# Testing the GET /records text filter (full-text index kept in sync with writes)
+	def test_text_search(self):
+		self.app.post('/signup', json={ 'username': 'search_user', 'password': 'search_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'search_user', 'password': 'search_user' })
+		for text in ('Banana split', 'apple pie', 'banana'):
+			self.app.post('/records', json={ 'text': text, 'calories': 100 })
+
+		def search(text):
+			return sorted(record['text'] for record in self.app.get('/records', json={ 'text': text }).get_json()['records'])
+		self.assertEqual(search('ban'), ['Banana split', 'banana'])
+		self.assertEqual(search('split BAN'), ['Banana split'])
+		self.assertEqual(search('pie'), ['apple pie'])
+
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.app.put('/records', json={ 'id': records[1]['id'], 'text': 'cherry pie' })
+		self.assertEqual(search('apple'), [])
+		self.assertEqual(search('pie'), ['cherry pie'])
+		self.app.delete('/records', json={ 'id': records[1]['id'] })
+		self.assertEqual(search('pie'), [])
+
+		for record in self.app.get('/records', json={}).get_json()['records']:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'search_user' }).get_json()['success'])
+
+	# Testing GET /reports (SQL-side aggregation, cached closed periods)
+	def test_reports(self):
+		self.app.post('/signup', json={ 'username': 'report_user', 'password': 'report_user', 'expected_calories': 1000 })
+		self.app.post('/login', json={ 'username': 'report_user', 'password': 'report_user' })
+		self.app.post('/records/batch', json={ 'records': [
+			{ 'text': 'Pasta', 'calories': 800, 'date': '2023-06-05', 'time': '12:00:00' },
+			{ 'text': 'pasta', 'calories': 700, 'date': '2023-06-05', 'time': '19:00:00' },
+			{ 'text': 'apple', 'calories': 100, 'date': '2023-06-07', 'time': '10:00:00' },
+			{ 'text': 'pasta', 'calories': 500, 'date': '2023-06-12', 'time': '12:00:00' }
+		] })
+
+		report = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30', 'granularity': 'week' }).get_json()
+		self.assertEqual([(period['period'], period['total_calories'], period['days_logged'], period['days_over_budget']) for period in report['periods']], [
+			('2023-06-05', 1600, 2, 1),
+			('2023-06-12', 500, 1, 0)
+		])
+		self.assertEqual(report['periods'][0]['average_calories'], 800)
+		self.assertEqual(report['totals']['total_calories'], 2100)
+		self.assertEqual(report['top_foods'][0], { 'text': 'pasta', 'count': 3, 'total_calories': 2000 })
+
+		report = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30', 'granularity': 'month' }).get_json()
+		self.assertEqual([(period['period'], period['days_over_budget']) for period in report['periods']], [('2023-06-01', 1)])
+
+		# Editing a past record invalidates the cached periods
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.app.put('/records', json={ 'id': records[3]['id'], 'calories': 1500 })
+		report = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30', 'granularity': 'week' }).get_json()
+		self.assertEqual(report['periods'][1]['days_over_budget'], 1)
+		self.assertEqual(report['totals']['total_calories'], 3100)
+
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		users = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30' }).get_json()['users']
+		summary = next(user for user in users if user['username'] == 'report_user')
+		self.assertEqual((summary['days_logged'], summary['total_calories'], summary['days_over_budget']), (3, 3100, 2))
+
+		for record in records:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'report_user' }).get_json()['success'])
+
+	# Testing GET /records/export (streamed NDJSON and CSV)
+	def test_export_records(self):
+		self.app.post('/signup', json={ 'username': 'export_user', 'password': 'export_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'export_user', 'password': 'export_user' })
+		self.app.post('/records/batch', json={ 'records': [
+			{ 'text': 'oatmeal', 'calories': 300, 'date': '2023-06-05', 'time': '08:00:00' },
+			{ 'text': 'pasta', 'calories': 700, 'date': '2023-06-05', 'time': '19:00:00' },
+			{ 'text': 'apple', 'calories': 100, 'date': '2023-06-06', 'time': '10:00:00' }
+		] })
+
+		response = self.app.get('/records/export', json={ 'calories_min': 200 })
+		self.assertTrue(response.is_streamed)
+		lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+		self.assertEqual([(line['date'], line['text'], line['username']) for line in lines], [
+			('2023-06-05', 'oatmeal', 'export_user'),
+			('2023-06-05', 'pasta', 'export_user')
+		])
+
+		response = self.app.get('/records/export', json={ 'format': 'csv', 'date': '2023-06-06' })
+		rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+		self.assertEqual([(row['text'], row['calories'], row['time']) for row in rows], [('apple', '100', '10:00:00')])
+		self.assertEqual(self.app.get('/records/export', json={ 'format': 'xml' }).status_code, 400)
+
+		for record in self.app.get('/records', json={}).get_json()['records']:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'export_user' }).get_json()['success'])
+
+	# Testing POST /records/import (chunked bulk import, rollups rebuilt afterwards)
+	def test_import_records(self):
+		self.app.post('/signup', json={ 'username': 'import_user', 'password': 'import_user', 'expected_calories': 1000 })
+		self.app.post('/login', json={ 'username': 'import_user', 'password': 'import_user' })
+		content = 'date,time,text,calories\n' \
+			'2023-06-05,19:00:00,pasta,700\n' \
+			'2023-06-05,08:00:00,oatmeal,400\n' \
+			'not-a-date,08:00:00,apple,100\n' \
+			'2023-06-06,12:00,apple,100\n'
+		response = self.app.post('/records/import', data={ 'file': (io.BytesIO(content.encode()), 'history.csv') }, content_type='multipart/form-data')
+		summary = response.get_json()
+		self.assertEqual((summary['imported'], summary['rejected']), (3, 1))
+		self.assertTrue(summary['errors'][0].startswith('line 4'))
+
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.assertEqual([(record['text'], record['is_below_expected']) for record in records], [('oatmeal', True), ('pasta', False), ('apple', True)])
+		days = self.app.get('/records/daily', json={}).get_json()['days']
+		self.assertEqual([(day['total_calories'], day['entry_count']) for day in days], [(1100, 2), (100, 1)])
+
+		lines = '{"date": "2023-06-07", "time": "09:00:00", "text": "banana", "calories": 105}\n{broken\n'
+		response = self.app.post('/records/import', data=lines, content_type='application/x-ndjson')
+		self.assertEqual((response.get_json()['imported'], response.get_json()['rejected']), (1, 1))
+
+		for record in self.app.get('/records', json={}).get_json()['records']:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'import_user' }).get_json()['success'])
+
+	# Testing the authenticated user cache behind load_user
+	def test_user_cache_invalidation(self):
+		self.app.post('/signup', json={ 'username': 'cached_user', 'password': 'cached_user', 'expected_calories': 2000 })
+		user = User.query.filter_by(username='cached_user').first()
+		user_id = user.id
+		self.assertEqual(identity.load(user_id).role, 'user')
+
+		# Changes that bypass the API are only seen once the entry expires
+		user.role = 'manager'
+		db.session.commit()
+		self.assertEqual(identity.load(user_id).role, 'user')
+
+		# Writes in another process bump the 'users' version without touching this process's cache
+		versions.users_changed()
+		db.session.commit()
+		self.assertEqual(identity.load(user_id).role, 'manager')
+		user.role = 'user'
+		versions.users_changed()
+		db.session.commit()
+		self.assertEqual(identity.load(user_id).role, 'user')
+
+		# Changes through PUT /users and DELETE /users take effect on the next request
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		self.app.put('/users', json={ 'username': 'cached_user', 'role': 'manager' })
+		self.assertEqual(identity.load(user_id).role, 'manager')
+		self.app.post('/login', json={ 'username': 'cached_user', 'password': 'cached_user' })
+		self.app.put('/users', json={ 'expected_calories': 1500 })
+		self.assertEqual(identity.load(user_id).expected_calories, 1500)
+
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'cached_user' }).get_json()['success'])
+		self.assertIsNone(identity.load(user_id))
+
+	# Testing password hashes with outdated parameters are replaced on login
+	def test_password_rehash_on_login(self):
+		self.app.post('/signup', json={ 'username': 'rehash_user', 'password': 'rehash_user', 'expected_calories': 2000 })
+		user = User.query.filter_by(username='rehash_user').first()
+		self.assertTrue(user.password_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'))
+		user.password_hash = generate_password_hash('rehash_user', 'pbkdf2:sha256:2000')
+		db.session.commit()
+
+		self.assertTrue(self.app.post('/login', json={ 'username': 'rehash_user', 'password': 'rehash_user' }).get_json()['success'])
+		db.session.refresh(user)
+		self.assertTrue(user.password_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'))
+		self.assertTrue(self.app.post('/login', json={ 'username': 'rehash_user', 'password': 'rehash_user' }).get_json()['success'])
+
+		with mock.patch('hashing.verify_password', side_effect=hashing.HashingBusy):
+			self.assertEqual(self.app.post('/login', json={ 'username': 'rehash_user', 'password': 'rehash_user' }).status_code, 503)
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'rehash_user' }).get_json()['success'])
+
+	# Testing ETag / If-None-Match on GET /records and GET /users
+	def test_conditional_get(self):
+		self.app.post('/signup', json={ 'username': 'etag_user', 'password': 'etag_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'etag_user', 'password': 'etag_user' })
+		self.app.post('/records', json={ 'text': 'apple', 'calories': 100 })
+
+		response = self.app.get('/records', json={ 'limit': 10 })
+		etag = response.headers['ETag']
+		self.assertTrue(response.cache_control.no_cache)
+
+		# A current copy is confirmed without reading any record
+		statements = []
+		def capture(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', capture)
+		try:
+			response = self.app.get('/records', json={ 'limit': 10 }, headers={ 'If-None-Match': etag })
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', capture)
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.headers['ETag'], etag)
+		self.assertEqual(response.data, b'')
+		self.assertFalse([statement for statement in statements if 'entry' in statement])
+
+		# Other parameters and every write give a new tag
+		self.assertNotEqual(self.app.get('/records', json={ 'limit': 5 }).headers['ETag'], etag)
+		record_id = self.app.get('/records', json={}).get_json()['records'][0]['id']
+		self.app.put('/records', json={ 'id': record_id, 'calories': 150 })
+		response = self.app.get('/records', json={ 'limit': 10 }, headers={ 'If-None-Match': etag })
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()['records'][0]['calories'], 150)
+
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		# The records of all users are versioned by the sum of the per-user versions
+		etag = self.app.get('/records', json={ 'limit': 10, 'page': 1 }).headers['ETag']
+		self.assertEqual(self.app.get('/records', json={ 'limit': 10, 'page': 1 }, headers={ 'If-None-Match': etag }).status_code, 304)
+		self.app.put('/records', json={ 'id': record_id, 'calories': 200 })
+		self.assertEqual(self.app.get('/records', json={ 'limit': 10, 'page': 1 }, headers={ 'If-None-Match': etag }).status_code, 200)
+
+		# Any spelling of a user's ID is tagged with that user's version
+		user_id = User.query.filter_by(username='etag_user').first().id
+		etags = { spelling: self.app.get('/records', json={ 'user_id': spelling }).headers['ETag'] for spelling in (user_id, '0' + str(user_id), float(user_id)) }
+		self.app.put('/records', json={ 'id': record_id, 'calories': 250 })
+		for spelling, etag in etags.items():
+			self.assertEqual(self.app.get('/records', json={ 'user_id': spelling }, headers={ 'If-None-Match': etag }).status_code, 200)
+		self.assertEqual(self.app.get('/records', json={ 'user_id': 'abc' }).status_code, 400)
+
+		etag = self.app.get('/users', json={}).headers['ETag']
+		self.assertEqual(self.app.get('/users', json={}, headers={ 'If-None-Match': etag }).status_code, 304)
+		self.app.put('/users', json={ 'username': 'etag_user', 'role': 'manager' })
+		self.assertEqual(self.app.get('/users', json={}, headers={ 'If-None-Match': etag }).status_code, 200)
+
+		self.app.delete('/records', json={ 'id': record_id })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'etag_user' }).get_json()['success'])
+
+	def test_metrics(self):
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		requests = metrics.http_requests.value('get_users', 'GET', 200)
+		statements = metrics.http_statements.count('get_users')
+		selects = metrics.sql_statements.value('SELECT')
+		self.app.get('/users', json={})
+		self.assertEqual(metrics.http_requests.value('get_users', 'GET', 200), requests + 1)
+		self.assertEqual(metrics.http_statements.count('get_users'), statements + 1)
+		self.assertGreater(metrics.sql_statements.value('SELECT'), selects)
+
+		response = self.app.get('/metrics')
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(response.content_type.startswith('text/plain'))
+		self.assertIn('http_requests_total{endpoint="get_users",method="GET",status="200"}', response.get_data(as_text=True))
+		self.assertIn('# TYPE sql_statement_duration_seconds histogram', response.get_data(as_text=True))
+
+		with mock.patch.dict(app.config, { 'METRICS_TOKEN': 'secret' }):
+			self.assertEqual(self.app.get('/metrics').status_code, 401)
+			self.assertEqual(self.app.get('/metrics', headers={ 'Authorization': 'Bearer wrong' }).status_code, 401)
+			self.assertEqual(self.app.get('/metrics', headers={ 'Authorization': 'Bearer secret' }).status_code, 200)
+
+	def test_request_profiling(self):
+		self.app.post('/signup', json={ 'username': 'profile_user', 'password': 'profile_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'profile_user', 'password': 'profile_user' })
+		self.app.post('/records', json={ 'text': 'apple', 'calories': 100 })
+		with tempfile.TemporaryDirectory() as directory, mock.patch.dict(app.config, { 'PROFILE_DIR': directory }):
+			# Only admins can ask for a profile
+			response = self.app.get('/records', json={ 'limit': 10 }, headers={ 'X-Profile': '1' })
+			self.assertNotIn('X-Profile-Report', response.headers)
+			self.assertFalse(os.listdir(directory))
+
+			# A configured endpoint is profiled for the listed users
+			user_id = User.query.filter_by(username='profile_user').first().id
+			with mock.patch.dict(app.config, { 'PROFILE_ENDPOINTS': ('get_records',), 'PROFILE_USER_IDS': (user_id,) }):
+				response = self.app.get('/records', json={ 'limit': 10 })
+			self.assertEqual(response.status_code, 200)
+			self.assertTrue(response.headers['X-Profile-Report'].startswith('/profiles/'))
+
+			self.app.post('/logout')
+			self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+			response = self.app.get('/records', json={ 'user_id': user_id, 'limit': 10 }, headers={ 'X-Profile': '1' })
+			record = response.get_json()['records'][0]
+			self.assertEqual(record['text'], 'apple')
+			report = self.app.get(response.headers['X-Profile-Report'])
+			self.assertEqual(report.status_code, 200)
+			text = report.get_data(as_text=True)
+			self.assertIn('GET /records -> 200', text)
+			self.assertIn('FROM entry', text)
+			self.assertIn('get_records', text)
+			self.assertEqual(len(os.listdir(directory)), 4)
+			self.assertEqual(self.app.get('/profiles/missing').status_code, 404)
+
+			# Passwords and their hashes stay out of the report
+			response = self.app.post('/signup', json={ 'username': 'profile_signup', 'password': 'secret-password', 'expected_calories': 2000 }, headers={ 'X-Profile': '1' })
+			text = self.app.get(response.headers['X-Profile-Report']).get_data(as_text=True)
+			self.assertIn('"username": "profile_signup"', text)
+			self.assertIn('INSERT INTO user', text)
+			self.assertNotIn('secret-password', text)
+			self.assertNotIn(app.config['PASSWORD_HASH_METHOD'], text)
+		self.app.delete('/records', json={ 'id': record['id'] })
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'profile_user' }).get_json()['success'])
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'profile_signup' }).get_json()['success'])
+
+	# Testing flask archive-entries (reads across entry and entry_archive)
+	def test_archive_tiers(self):
+		self.app.post('/signup', json={ 'username': 'archive_user', 'password': 'archive_user', 'expected_calories': 1000 })
+		self.app.post('/login', json={ 'username': 'archive_user', 'password': 'archive_user' })
+		self.app.post('/records/batch', json={ 'records': [
+			{ 'text': 'pasta', 'calories': 800, 'date': '2023-06-05', 'time': '12:00:00' },
+			{ 'text': 'pasta', 'calories': 700, 'date': '2023-06-05', 'time': '19:00:00' },
+			{ 'text': 'apple', 'calories': 100, 'date': '2023-06-07', 'time': '10:00:00' },
+			{ 'text': 'pasta', 'calories': 500, 'date': '2023-07-03', 'time': '12:00:00' }
+		] })
+		self.app.post('/records', json={ 'text': 'coffee', 'calories': 5 })
+
+		def snapshot():
+			return (
+				self.app.get('/reports', json={ 'date_from': '2023-05-01', 'date_to': '2023-07-31', 'granularity': 'month' }).get_json(),
+				self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-07-15', 'granularity': 'week' }).get_json(),
+				self.app.get('/records/daily', json={ 'date_from': '2023-06-01', 'date_to': '2023-07-31' }).get_json()['days'],
+				self.app.get('/records/export', json={}).get_data(as_text=True)
+			)
+		before = snapshot()
+
+		# June is archived, July and today's record stay in entry
+		self.assertEqual(archive.archive_entries(30, chunk_size=2, today=date(2023, 8, 1)), 3)
+		user_id = User.query.filter_by(username='archive_user').first().id
+		self.assertEqual(ArchivedEntry.query.filter_by(user_id=user_id).count(), 3)
+		month = MonthlyTotal.query.filter_by(user_id=user_id).one()
+		self.assertEqual((str(month.month), month.days_logged, month.entry_count, month.total_calories, month.days_over_budget), ('2023-06-01', 2, 3, 1600, 1))
+		# Archiving bumps the user's data version, so cached periods are computed again from the two tiers
+		self.assertEqual(snapshot(), before)
+
+		# Unfiltered listings page through entry, a date filter reaches into the archive
+		records = self.app.get('/records', json={}).get_json()['records']
+		self.assertEqual([record['text'] for record in records], ['pasta', 'coffee'])
+		response = self.app.get('/records', json={ 'date': '2023-06-05', 'text': 'pasta', 'limit': 1, 'page': 2 }).get_json()
+		self.assertEqual([(record['time'], record['calories']) for record in response['records']], [('19:00:00', 700)])
+		self.assertEqual(response['total_count'], 2)
+		response = self.app.get('/records', json={ 'date': '2023-06-05', 'limit': 1, 'cursor': None }).get_json()
+		response = self.app.get('/records', json={ 'date': '2023-06-05', 'limit': 1, 'cursor': response['next_cursor'] }).get_json()
+		self.assertEqual([record['calories'] for record in response['records']], [700])
+
+		# A new target is applied to the archived days too
+		self.app.put('/users', json={ 'expected_calories': 2000 })
+		self.assertEqual(self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30', 'granularity': 'month' }).get_json()['periods'][0]['days_over_budget'], 0)
+
+		# Ids of archived records are not reused, even once every newer record is deleted
+		for record in records:
+			self.app.delete('/records', json={ 'id': record['id'] })
+		self.app.post('/records', json={ 'text': 'tea', 'calories': 2 })
+		record = self.app.get('/records', json={}).get_json()['records'][0]
+		self.assertGreater(record['id'], max(archived.id for archived in ArchivedEntry.query.filter_by(user_id=user_id)))
+		ids = [json.loads(line)['id'] for line in self.app.get('/records/export', json={}).get_data(as_text=True).splitlines()]
+		self.assertEqual(len(ids), 4)
+		self.assertEqual(len(set(ids)), 4)
+		self.app.delete('/records', json={ 'id': record['id'] })
+		db.session.execute(db.delete(ArchivedEntry).where(ArchivedEntry.user_id == user_id))
+		db.session.commit()
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'archive_user' }).get_json()['success'])
+
+	# Testing DELETE /users for users with records (chunked, and as a background job)
+	def test_delete_user_with_records(self):
+		for username in ('purge_user', 'purge_background_user'):
+			self.app.post('/signup', json={ 'username': username, 'password': username, 'expected_calories': 2000 })
+			self.app.post('/login', json={ 'username': username, 'password': username })
+			self.app.post('/records/batch', json={ 'records': [
+				{ 'text': 'apple', 'calories': 100 + number, 'date': f'2023-06-0{number + 1}', 'time': '10:00:00' } for number in range(5)
+			] })
+		self.assertEqual(self.app.get('/users/deletions/missing').status_code, 403)
+		user_ids = [User.query.filter_by(username=username).first().id for username in ('purge_user', 'purge_background_user')]
+		archive.archive_entries(30, today=date(2023, 8, 1))
+		self.assertEqual(ArchivedEntry.query.filter(ArchivedEntry.user_id.in_(user_ids)).count(), 10)
+
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		with mock.patch.dict(app.config, { 'USER_DELETE_CHUNK_SIZE': 2 }):
+			response = self.app.delete('/users', json={ 'username': 'purge_user' })
+			self.assertTrue(response.get_json()['success'])
+
+			response = self.app.delete('/users', json={ 'username': 'purge_background_user', 'background': True })
+			self.assertEqual(response.status_code, 202)
+			status_url = f"/users/deletions/{response.get_json()['job_id']}"
+			for attempt in range(100):
+				job = self.app.get(status_url).get_json()
+				if job['status'] in ('done', 'failed'):
+					break
+				time.sleep(0.05)
+		self.assertEqual((job['status'], job['username'], job['deleted_entries']), ('done', 'purge_background_user', 5))
+		self.assertEqual(self.app.get('/users/deletions/missing').status_code, 404)
+
+		db.session.expire_all()
+		self.assertEqual(User.query.filter(User.id.in_(user_ids)).count(), 0)
+		for model in (Entry, DailyTotal, ArchivedEntry, MonthlyTotal):
+			self.assertEqual(model.query.filter(model.user_id.in_(user_ids)).count(), 0)
+
+	# Testing a day with records in both tiers (added after the day was archived)
+	def test_archived_day_with_new_records(self):
+		self.app.post('/signup', json={ 'username': 'mixed_user', 'password': 'mixed_user', 'expected_calories': 1000 })
+		self.app.post('/login', json={ 'username': 'mixed_user', 'password': 'mixed_user' })
+		self.app.post('/records/batch', json={ 'records': [{ 'text': 'pasta', 'calories': 600, 'date': '2023-06-05', 'time': '12:00:00' }] })
+		archive.archive_entries(30, today=date(2023, 8, 1))
+		self.app.post('/records/batch', json={ 'records': [{ 'text': 'pasta', 'calories': 600, 'date': '2023-06-05', 'time': '19:00:00' }] })
+
+		record = self.app.get('/records', json={}).get_json()['records'][0]
+		self.assertFalse(record['is_below_expected'])
+		for granularity in ('day', 'month'):
+			report = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30', 'granularity': granularity }).get_json()
+			self.assertEqual([(period['days_logged'], period['entry_count'], period['total_calories'], period['days_over_budget']) for period in report['periods']], [(1, 2, 1200, 1)])
+		self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+		users = self.app.get('/reports', json={ 'date_from': '2023-06-01', 'date_to': '2023-06-30' }).get_json()['users']
+		summary = next(user for user in users if user['username'] == 'mixed_user')
+		self.assertEqual((summary['days_logged'], summary['total_calories'], summary['days_over_budget']), (1, 1200, 1))
+
+		self.assertTrue(self.app.delete('/users', json={ 'username': 'mixed_user' }).get_json()['success'])
+
 if __name__ == '__main__':
 	unittest.main(verbosity=2)
\ No newline at end of file
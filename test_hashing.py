@@ -0,0 +1,38 @@
+import unittest
+from app import app
+import hashing
+
+class PasswordHashingTestCase(unittest.TestCase):
+	def setUp(self):
+		self.app_context = app.app_context()
+		self.app_context.push()
+		self.settings = { key: app.config.get(key) for key in ('PASSWORD_HASH_WORKERS', 'PASSWORD_HASH_QUEUE_LIMIT') }
+		app.config.update(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE_LIMIT=1)
+		hashing.shutdown()
+
+	def tearDown(self):
+		hashing.shutdown()
+		app.config.update(self.settings)
+		self.app_context.pop()
+
+	def test_hash_on_worker_process(self):
+		password_hash = hashing.hash_password('secret')
+		self.assertTrue(password_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'))
+		self.assertTrue(hashing.verify_password(password_hash, 'secret'))
+		self.assertFalse(hashing.verify_password(password_hash, 'wrong'))
+		self.assertFalse(hashing.needs_rehash(password_hash))
+		self.assertTrue(hashing.needs_rehash(password_hash.replace(':1000$', ':2000$')))
+
+	def test_queue_limit(self):
+		pool, slots = hashing._get_pool()
+		# Hold the only slot, as a hash in flight would
+		slots.acquire()
+		try:
+			with self.assertRaises(hashing.HashingBusy):
+				hashing.hash_password('secret')
+		finally:
+			slots.release()
+		self.assertTrue(hashing.verify_password(hashing.hash_password('secret'), 'secret'))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from unittest import mock
+import metrics
+from metrics import Counter, Histogram
+
+class TestMetrics(unittest.TestCase):
+	def setUp(self):
+		self.registry = mock.patch.object(metrics, '_registry', [])
+		self.registry.start()
+
+	def tearDown(self):
+		self.registry.stop()
+
+	def test_counter(self):
+		counter = Counter('requests_total', 'Requests.', ('endpoint', 'status'))
+		counter.inc('records', 200)
+		counter.inc('records', 200, amount=2)
+		counter.inc('say "hi"\\\n', 404)
+		self.assertEqual(counter.value('records', 200), 3)
+		self.assertEqual(metrics.render().splitlines(), [
+			'# HELP requests_total Requests.',
+			'# TYPE requests_total counter',
+			'requests_total{endpoint="records",status="200"} 3',
+			'requests_total{endpoint="say \\"hi\\"\\\\\\n",status="404"} 1',
+		])
+
+	def test_histogram(self):
+		histogram = Histogram('latency_seconds', 'Latency.', ('endpoint',), (0.1, 1))
+		for value in (0.05, 0.1, 0.5, 3):
+			histogram.observe(value, 'records')
+		self.assertEqual(histogram.count('records'), 4)
+		self.assertEqual(metrics.render().splitlines()[2:], [
+			'latency_seconds_bucket{endpoint="records",le="0.1"} 2',
+			'latency_seconds_bucket{endpoint="records",le="1.0"} 3',
+			'latency_seconds_bucket{endpoint="records",le="+Inf"} 4',
+			'latency_seconds_sum{endpoint="records"} 3.65',
+			'latency_seconds_count{endpoint="records"} 4',
+		])
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
@@ -1,7 +1,13 @@
+import os
 import unittest
 from datetime import datetime, date, time
-from models import User, Entry
+from models import User, Entry, DailyTotal
 from app import app, db
+from recompute import recompute_day, recompute_user, rebuild_all_flags
+from migrations import upgrade, current_version, MIGRATIONS
+from pragmas import configure_sqlite
+from config import ProductionConfig
+from sqlalchemy import create_engine, inspect
 
 class UserModelTestCase(unittest.TestCase):
 	def test_password_hashing(self):
@@ -89,5 +95,149 @@ class TestCalculateIsBelowExpected(unittest.TestCase):
 		for entry in entries:
 			self.assertEqual(entry.is_below_expected, entry.calories < user.expected_calories)
 
+class TestDailyTotal(unittest.TestCase):
+	def setUp(self):
+		self.app = app.test_client()
+		self.app_context = app.app_context()
+		self.app_context.push()
+		db.create_all()
+
+	def tearDown(self):
+		db.session.rollback()
+		self.app_context.pop()
+
+	def test_apply_and_rebuild(self):
+		user = User(username='daily_total_user', role='user', expected_calories=2000)
+		user.set_password('sample_password')
+		db.session.add(user)
+		db.session.flush()
+
+		# Keep the rollup current while adding entries, as the API does
+		for calories in (800, 900, 400):
+			entry = Entry(user_id=user.id, date=date(2023, 6, 18), time=time(12, 0), text='Entry', calories=calories)
+			db.session.add(entry)
+			DailyTotal.apply(user.id, entry.date, entry.calories, 1)
+			# The flag is computed from the rollup including the current entry
+			self.assertEqual(entry.is_below_expected, db.session.get(DailyTotal, (user.id, entry.date)).total_calories < 2000)
+
+		total = db.session.get(DailyTotal, (user.id, date(2023, 6, 18)))
+		self.assertEqual(total.total_calories, 2100)
+		self.assertEqual(total.entry_count, 3)
+
+		# Rebuilding from the entry table yields the same rollup
+		DailyTotal.apply(user.id, date(2023, 6, 18), 5000, 7)
+		DailyTotal.rebuild(user.id)
+		db.session.expire_all()
+		total = db.session.get(DailyTotal, (user.id, date(2023, 6, 18)))
+		self.assertEqual(total.total_calories, 2100)
+		self.assertEqual(total.entry_count, 3)
+
+class TestRecompute(unittest.TestCase):
+	def setUp(self):
+		self.app = app.test_client()
+		self.app_context = app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.user = User(username='recompute_user', role='user', expected_calories=1000)
+		self.user.set_password('sample_password')
+		db.session.add(self.user)
+		db.session.flush()
+		self.entries = []
+		for hour, calories in ((8, 400), (12, 400), (18, 400)):
+			entry = Entry(user_id=self.user.id, date=date(2023, 6, 18), time=time(hour, 0), text='Entry', calories=calories)
+			db.session.add(entry)
+			DailyTotal.apply(self.user.id, entry.date, entry.calories, 1)
+			self.entries.append(entry)
+		db.session.flush()
+
+	def tearDown(self):
+		db.session.rollback()
+		self.app_context.pop()
+
+	def flags(self):
+		db.session.expire_all()
+		return [entry.is_below_expected for entry in self.entries]
+
+	def test_recompute_day_after_edit(self):
+		self.assertEqual(self.flags(), [True, True, False])
+		self.entries[0].calories = 100
+		recompute_day(self.user.id, date(2023, 6, 18))
+		self.assertEqual(self.flags(), [True, True, True])
+
+	def test_recompute_user_after_target_change(self):
+		self.user.expected_calories = 500
+		recompute_user(self.user.id)
+		self.assertEqual(self.flags(), [True, False, False])
+
+	def test_rebuild_all_flags_in_chunks(self):
+		Entry.query.filter_by(user_id=self.user.id).update({ 'is_below_expected': None })
+		progress = []
+		rebuild_all_flags(chunk_size=1, progress=progress.append)
+		self.assertTrue(len(progress) >= 3)
+		self.assertEqual(self.flags(), [True, True, False])
+		# rebuild_all_flags commits, so remove the fixtures explicitly
+		Entry.query.filter_by(user_id=self.user.id).delete()
+		DailyTotal.query.filter_by(user_id=self.user.id).delete()
+		User.query.filter_by(id=self.user.id).delete()
+		db.session.commit()
+
+class TestMigrations(unittest.TestCase):
+	def setUp(self):
+		self.engine = create_engine('sqlite:///migration_test.db')
+		# Recreate the schema of the first release, before any migration
+		with self.engine.begin() as connection:
+			connection.exec_driver_sql(
+				'CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(64) NOT NULL, password_hash VARCHAR(128) NOT NULL, '
+				'role VARCHAR(64) NOT NULL, expected_calories INTEGER NOT NULL, PRIMARY KEY (id), UNIQUE (username))'
+			)
+			connection.exec_driver_sql(
+				'CREATE TABLE entry (id INTEGER NOT NULL, user_id INTEGER NOT NULL, date DATE NOT NULL, time TIME NOT NULL, '
+				'text VARCHAR(256) NOT NULL, calories INTEGER NOT NULL, is_below_expected BOOLEAN, PRIMARY KEY (id), '
+				'FOREIGN KEY(user_id) REFERENCES user (id))'
+			)
+			connection.exec_driver_sql("INSERT INTO user VALUES (1, 'old_user', '-', 'user', 2000)")
+			connection.exec_driver_sql("INSERT INTO entry VALUES (1, 1, '2023-06-18', '12:00:00.000000', 'Old entry', 500, 1)")
+
+	def tearDown(self):
+		self.engine.dispose()
+		os.remove('migration_test.db')
+
+	def test_upgrade_keeps_data(self):
+		self.assertEqual(current_version(self.engine), 0)
+		self.assertEqual(upgrade(self.engine), MIGRATIONS[-1][0])
+		# Running the upgrade again is a no-op
+		self.assertEqual(upgrade(self.engine), MIGRATIONS[-1][0])
+
+		index_names = { index['name'] for index in inspect(self.engine).get_indexes('entry') }
+		self.assertIn('ix_entry_user_date_time', index_names)
+		self.assertIn('ix_entry_user_calories', index_names)
+		with self.engine.connect() as connection:
+			self.assertEqual(connection.execute(db.select(db.func.count(Entry.id))).scalar(), 1)
+			total = connection.execute(db.select(DailyTotal.total_calories, DailyTotal.entry_count)).one()
+			self.assertEqual(tuple(total), (500, 1))
+			self.assertEqual(connection.execute(db.select(Entry.calorie_status)).scalar(), 'resolved')
+
+		# Entry ids are AUTOINCREMENT: the id of a deleted entry is not handed out again
+		with self.engine.begin() as connection:
+			connection.execute(db.delete(Entry))
+			connection.execute(db.insert(Entry.__table__).values(user_id=1, date=date(2023, 6, 19), time=time(12, 0), text='New entry', calories=100))
+			self.assertEqual(connection.execute(db.select(Entry.id)).scalar(), 2)
+
+class TestSqlitePragmas(unittest.TestCase):
+	def tearDown(self):
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists('pragmas_test.db' + suffix):
+				os.remove('pragmas_test.db' + suffix)
+
+	def test_production_pragmas_on_every_connection(self):
+		engine = create_engine('sqlite:///pragmas_test.db')
+		self.assertTrue(configure_sqlite(engine, ProductionConfig.SQLITE_PRAGMAS))
+		for _ in range(2):
+			with engine.connect() as connection:
+				self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+				self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+			engine.dispose()
+		self.assertFalse(configure_sqlite(engine, {}))
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from app import app, db
+from models import FoodCache
+import nutritionix
+
+class CalorieCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		self.app_context = app.app_context()
+		self.app_context.push()
+		db.create_all()
+		FoodCache.query.delete()
+		db.session.commit()
+		nutritionix.clear_cache()
+
+	def tearDown(self):
+		FoodCache.query.delete()
+		db.session.commit()
+		nutritionix.clear_cache()
+		self.app_context.pop()
+
+	def test_normalize_query(self):
+		self.assertEqual(nutritionix.normalize_query('  Banana  Split '), 'banana split')
+
+	@mock.patch('nutritionix.fetch_calories', return_value=('banana', 105))
+	def test_memory_and_persistent_tiers(self, fetch_calories):
+		stats = nutritionix.cache_stats()
+		self.assertEqual(nutritionix.get_calories('Banana'), ('banana', 105))
+		self.assertEqual(nutritionix.get_calories(' banana '), ('banana', 105))
+		self.assertEqual(fetch_calories.call_count, 1)
+		self.assertEqual(nutritionix.cache_stats()['memory_hits'], stats['memory_hits'] + 1)
+
+		# A new process only has the persistent tier
+		nutritionix.clear_cache()
+		self.assertEqual(nutritionix.get_calories('BANANA'), ('banana', 105))
+		self.assertEqual(fetch_calories.call_count, 1)
+		self.assertEqual(nutritionix.cache_stats()['persistent_hits'], stats['persistent_hits'] + 1)
+
+	@mock.patch('nutritionix.fetch_calories', return_value=(None, None))
+	def test_negative_results_use_shorter_ttl(self, fetch_calories):
+		self.assertEqual(nutritionix.get_calories('no such food'), (None, None))
+		self.assertEqual(nutritionix.get_calories('no such food'), (None, None))
+		self.assertEqual(fetch_calories.call_count, 1)
+		row = db.session.get(FoodCache, 'no such food')
+		positive_ttl = app.config['NUTRITIONIX_CACHE_TTL']
+		self.assertIsNone(row.calories)
+		self.assertLess(row.expires_at, nutritionix.datetime.utcnow() + nutritionix.timedelta(seconds=positive_ttl / 2))
+
+	@mock.patch('nutritionix.fetch_calories', return_value=('coffee', 2))
+	def test_expired_entries_are_refetched(self, fetch_calories):
+		nutritionix.get_calories('coffee')
+		FoodCache.query.update({ 'expires_at': nutritionix.datetime.utcnow() - nutritionix.timedelta(seconds=1) })
+		db.session.commit()
+		nutritionix.clear_cache()
+		nutritionix.get_calories('coffee')
+		self.assertEqual(fetch_calories.call_count, 2)
+
+class StubNutritionixHandler(BaseHTTPRequestHandler):
+	# Responses are popped from the server's queue, the last one is repeated
+	def do_POST(self):
+		self.rfile.read(int(self.headers['Content-Length']))
+		self.server.requests += 1
+		status, body, delay = self.server.responses[0] if len(self.server.responses) == 1 else self.server.responses.pop(0)
+		time.sleep(delay)
+		payload = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def log_message(self, format, *args):
+		pass
+
+FOUND = { 'common': [{ 'food_name': 'banana' }], 'branded': [{ 'food_name': 'Banana', 'nf_calories': 105 }] }
+
+class NutritionixClientTestCase(unittest.TestCase):
+	def setUp(self):
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubNutritionixHandler)
+		self.server.requests = 0
+		self.server.responses = [(200, FOUND, 0)]
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		self.app_context = app.app_context()
+		self.app_context.push()
+		self.settings = { key: app.config.get(key) for key in (
+			'NUTRITIONIX_API_URL', 'NUTRITIONIX_READ_TIMEOUT', 'NUTRITIONIX_RETRIES',
+			'NUTRITIONIX_BACKOFF_FACTOR', 'NUTRITIONIX_BREAKER_THRESHOLD', 'NUTRITIONIX_BREAKER_RESET'
+		)}
+		app.config.update(
+			NUTRITIONIX_API_URL=f'http://127.0.0.1:{self.server.server_port}/v2/search/instant',
+			NUTRITIONIX_READ_TIMEOUT=0.5,
+			NUTRITIONIX_RETRIES=2,
+			NUTRITIONIX_BACKOFF_FACTOR=0,
+			NUTRITIONIX_BREAKER_THRESHOLD=2,
+			NUTRITIONIX_BREAKER_RESET=0.5
+		)
+		nutritionix.reset_client()
+
+	def tearDown(self):
+		app.config.update(self.settings)
+		nutritionix.reset_client()
+		self.app_context.pop()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_found_and_not_found(self):
+		self.assertEqual(nutritionix.fetch_calories('banana'), ('Banana', 105))
+		self.server.responses = [(200, { 'common': [], 'branded': [] }, 0)]
+		self.assertEqual(nutritionix.fetch_calories('nothing'), (None, None))
+
+	def test_retries_server_errors(self):
+		self.server.responses = [(503, {}, 0), (503, {}, 0), (200, FOUND, 0)]
+		self.assertEqual(nutritionix.fetch_calories('banana'), ('Banana', 105))
+		self.assertEqual(self.server.requests, 3)
+
+	def test_timeout_raises_unavailable(self):
+		self.server.responses = [(200, FOUND, 1)]
+		app.config['NUTRITIONIX_RETRIES'] = 0
+		nutritionix.reset_client()
+		started = time.monotonic()
+		with self.assertRaises(nutritionix.NutritionixUnavailable):
+			nutritionix.fetch_calories('banana')
+		self.assertLess(time.monotonic() - started, 1)
+
+	def test_circuit_breaker(self):
+		self.server.responses = [(500, {}, 0)]
+		for _ in range(2):
+			with self.assertRaises(nutritionix.NutritionixUnavailable):
+				nutritionix.fetch_calories('banana')
+		requests_made = self.server.requests
+		# The breaker is open, so no request reaches the upstream
+		with self.assertRaises(nutritionix.NutritionixUnavailable):
+			nutritionix.fetch_calories('banana')
+		self.assertEqual(self.server.requests, requests_made)
+
+		# After the reset timeout a trial request closes the breaker again
+		time.sleep(0.6)
+		self.server.responses = [(200, FOUND, 0)]
+		self.assertEqual(nutritionix.fetch_calories('banana'), ('Banana', 105))
+		self.assertEqual(nutritionix._get_breaker().state, 'closed')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,179 @@
+import os
+import tempfile
+import time as clock
+import unittest
+from datetime import date, time, timedelta
+from app import app, db
+from models import User, Entry, DailyTotal
+from query_budget import QueryCounter, QueryBudgetExceeded, query_budget
+from werkzeug.security import generate_password_hash
+import identity
+import user_deletion
+
+# Users and records per user scale with the size, budgets must not
+SIZES = (1, 5, 20)
+RECORDS_PER_USER = 3
+
+def records_of(size):
+	return size * RECORDS_PER_USER
+
+# Route: (client role, method, path, request arguments, statement budget, row budget)
+# The row budget is a function of the size for routes that return all of a user's data
+ROUTES = {
+	'GET /': ('anonymous', 'GET', '/', lambda data: {}, 0, 0),
+	'POST /login': ('anonymous', 'POST', '/login', lambda data: { 'json': { 'username': data['username'], 'password': 'budget' } }, 1, 1),
+	'POST /signup': ('anonymous', 'POST', '/signup', lambda data: { 'json': { 'username': f'budget_signup{data["size"]}', 'password': 'budget', 'expected_calories': 2000 } }, 3, 0),
+	'POST /session': ('user', 'POST', '/session', lambda data: {}, 0, 0),
+	'GET /records': ('user', 'GET', '/records', lambda data: { 'json': { 'limit': 10, 'page': 1 } }, 3, 12),
+	'GET /records cursor': ('user', 'GET', '/records', lambda data: { 'json': { 'limit': 10, 'cursor': None } }, 2, 12),
+	'GET /records text': ('user', 'GET', '/records', lambda data: { 'json': { 'text': 'banana', 'limit': 10, 'page': 1 } }, 3, 12),
+	'GET /records/export': ('user', 'GET', '/records/export', lambda data: { 'json': {} }, 1, records_of),
+	'GET /records/daily': ('user', 'GET', '/records/daily', lambda data: { 'json': {} }, 2, lambda size: size + 1),
+	'GET /records/status': ('user', 'GET', '/records/status', lambda data: { 'json': { 'ids': data['record_ids'][:10] } }, 1, 10),
+	'GET /reports': ('user', 'GET', '/reports', lambda data: { 'json': {} }, 4, lambda size: min(size, 30) + 5),
+	'POST /records': ('user', 'POST', '/records', lambda data: { 'json': { 'text': 'banana', 'calories': 100 } }, 5, 1),
+	'POST /records/batch': ('user', 'POST', '/records/batch', lambda data: { 'json': { 'records': [
+		{ 'text': 'banana', 'calories': 100, 'date': str(date(2023, 1, 1) + timedelta(days=number)) } for number in range(10)
+	] } }, 34, 1),
+	'POST /records/import': ('user', 'POST', '/records/import', lambda data: {
+		'data': 'date,time,text,calories\n' + ''.join(f'2023-02-0{number + 1},12:00:00,banana,100\n' for number in range(5)),
+		'content_type': 'text/csv'
+	}, 7, 1),
+	'PUT /records': ('user', 'PUT', '/records', lambda data: { 'json': { 'id': data['record_ids'][0], 'calories': 150 } }, 8, 3),
+	'DELETE /records': ('user', 'DELETE', '/records', lambda data: { 'json': { 'id': data['record_ids'][-1] } }, 7, 2),
+	'PUT /users': ('user', 'PUT', '/users', lambda data: { 'json': { 'expected_calories': 2100 } }, 11, 3),
+	'GET /users': ('admin', 'GET', '/users', lambda data: { 'json': { 'limit': 10, 'page': 1 } }, 3, 12),
+	'GET /records all users': ('admin', 'GET', '/records', lambda data: { 'json': { 'limit': 10, 'page': 1 } }, 2, lambda size: 10 * (size + 1) + 4),
+	'GET /records user_id': ('admin', 'GET', '/records', lambda data: { 'json': { 'user_id': data['user_id'], 'limit': 10, 'page': 1 } }, 3, 12),
+	'GET /reports all users': ('admin', 'GET', '/reports', lambda data: { 'json': { 'limit': 10, 'page': 1 } }, 1, 12),
+	'PUT /users role': ('admin', 'PUT', '/users', lambda data: { 'json': { 'username': data['username'], 'role': 'user' } }, 3, 2),
+	'DELETE /users': ('admin', 'DELETE', '/users', lambda data: { 'json': { 'username': f'budget_signup{data["size"]}' } }, 11, 2),
+	'GET /users/deletions/<job_id>': ('admin', 'GET', lambda data: f'/users/deletions/{data["deletion_job_id"]}', lambda data: {}, 1, 1),
+	'GET /nutritionix/stats': ('admin', 'GET', '/nutritionix/stats', lambda data: {}, 1, 1),
+	'GET /profiles/<name>': ('admin', 'GET', '/profiles/budget', lambda data: {}, 1, 1),
+	'GET /metrics': ('anonymous', 'GET', '/metrics', lambda data: {}, 0, 0),
+	# Last, it ends the session of the role it runs as
+	'POST /logout': ('user', 'POST', '/logout', lambda data: {}, 1, 1),
+}
+
+class QueryBudgetTestCase(unittest.TestCase):
+	def setUp(self):
+		self.app = app.test_client()
+		self.app_context = app.app_context()
+		self.app_context.push()
+		db.create_all()
+		if not User.query.filter_by(username='admin').first():
+			new_user = User(username='admin', expected_calories=2000, role='admin')
+			new_user.set_password('admin')
+			db.session.add(new_user)
+			db.session.commit()
+		# A profile report for GET /profiles/<name>
+		self.profile_dir = tempfile.TemporaryDirectory()
+		self.settings = { 'PROFILE_DIR': app.config['PROFILE_DIR'] }
+		app.config['PROFILE_DIR'] = self.profile_dir.name
+		with open(os.path.join(self.profile_dir.name, 'budget.txt'), 'w') as report:
+			report.write('budget')
+
+	def tearDown(self):
+		self.remove_users()
+		app.config.update(self.settings)
+		self.profile_dir.cleanup()
+		self.app_context.pop()
+
+	def remove_users(self):
+		user_ids = db.session.scalars(db.select(User.id).where(User.username.like('budget%'))).all()
+		db.session.execute(db.delete(Entry).where(Entry.user_id.in_(user_ids)))
+		db.session.execute(db.delete(DailyTotal).where(DailyTotal.user_id.in_(user_ids)))
+		db.session.execute(db.delete(User).where(User.id.in_(user_ids)))
+		db.session.commit()
+		for user_id in user_ids:
+			identity.invalidate(user_id)
+
+	def populate(self, size):
+		# size users with records_of(size) records each, spread over as many days
+		self.remove_users()
+		password_hash = generate_password_hash('budget', method=app.config['PASSWORD_HASH_METHOD'])
+		db.session.execute(db.insert(User), [{
+			'username': f'budget{size}_{number}', 'password_hash': password_hash, 'role': 'user', 'expected_calories': 2000
+		} for number in range(size)])
+		user_ids = db.session.scalars(db.select(User.id).where(User.username.like(f'budget{size}_%'))).all()
+		today = date.today()
+		db.session.execute(db.insert(Entry.__table__), [{
+			'user_id': user_id,
+			'date': today - timedelta(days=number % size),
+			'time': time(8 + number % 12, 0),
+			'text': 'banana' if number % 2 else 'coffee',
+			'calories': 100 + number,
+			'is_below_expected': True,
+			'calorie_status': 'resolved'
+		} for user_id in user_ids for number in range(records_of(size))])
+		for user_id in user_ids:
+			DailyTotal.rebuild(user_id)
+		db.session.commit()
+		user_id = user_ids[0]
+		return {
+			'size': size,
+			'user_id': user_id,
+			'username': f'budget{size}_0',
+			'record_ids': db.session.scalars(db.select(Entry.id).where(Entry.user_id == user_id).order_by(Entry.id)).all(),
+			'deletion_job_id': self.finished_deletion(f'budget{size}_deleted', password_hash)
+		}
+
+	def finished_deletion(self, username, password_hash):
+		# ID of a background deletion job that is over, so it runs no statement while routes are measured
+		db.session.execute(db.insert(User), [{ 'username': username, 'password_hash': password_hash, 'role': 'user', 'expected_calories': 2000 }])
+		db.session.commit()
+		user_id = db.session.scalar(db.select(User.id).where(User.username == username))
+		job = user_deletion.submit(app, identity.load(user_id))
+		for attempt in range(100):
+			if job['status'] in ('done', 'failed'):
+				break
+			clock.sleep(0.05)
+		self.assertEqual(job['status'], 'done')
+		return job['id']
+
+	def measure(self, name, data):
+		role, method, path, arguments, statements, rows = ROUTES[name]
+		if callable(path):
+			path = path(data)
+		with QueryCounter() as counter:
+			response = self.app.open(path, method=method, **arguments(data))
+			response.get_data()
+		self.assertLess(response.status_code, 400, f'{name}: {response.get_data(as_text=True)}')
+		return counter
+
+	def run_routes(self, size):
+		# Every route at this size, returning the counter of each
+		data = self.populate(size)
+		counters = {}
+		for role in ('anonymous', 'user', 'admin'):
+			if role == 'user':
+				self.app.post('/login', json={ 'username': data['username'], 'password': 'budget' })
+			elif role == 'admin':
+				self.app.post('/login', json={ 'username': 'admin', 'password': 'admin' })
+			for name, route in ROUTES.items():
+				if route[0] == role:
+					counters[name] = self.measure(name, data)
+			if role != 'anonymous':
+				self.app.post('/logout')
+		return counters
+
+	def test_query_budgets(self):
+		# The first run creates the data_version rows and fills the per-process caches
+		self.run_routes(SIZES[0])
+		for size in SIZES:
+			for name, counter in self.run_routes(size).items():
+				statements, rows = ROUTES[name][4:]
+				with self.subTest(route=name, size=size):
+					counter.check(statements, rows(size) if callable(rows) else rows)
+
+	def test_detects_n_plus_one(self):
+		data = self.populate(5)
+		with self.assertRaises(QueryBudgetExceeded) as raised:
+			with query_budget(statements=2, rows=20):
+				for record_id in data['record_ids']:
+					db.session.get(Entry, record_id)
+		self.assertIn('15 statements (budget 2)', str(raised.exception))
+
+if __name__ == '__main__':
+	unittest.main(verbosity=2)
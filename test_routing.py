@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+from app import app, db
+from models import User, Entry, DailyTotal, ReplicaHeartbeat
+import routing
+
+REPLICA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replica_test.db')
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+	def setUp(self):
+		self.app = app.test_client()
+		self.app_context = app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.settings = { key: app.config.get(key) for key in ('DATABASE_REPLICA_URL', 'REPLICA_CHECK_INTERVAL', 'REPLICA_MAX_LAG') }
+		app.config.update(DATABASE_REPLICA_URL='sqlite:///' + REPLICA, REPLICA_CHECK_INTERVAL=0, REPLICA_MAX_LAG=60)
+		routing.reset()
+
+		self.app.post('/signup', json={ 'username': 'replica_user', 'password': 'replica_user', 'expected_calories': 2000 })
+		self.app.post('/login', json={ 'username': 'replica_user', 'password': 'replica_user' })
+
+	def tearDown(self):
+		app.config.update(DATABASE_REPLICA_URL=None)
+		routing.reset()
+		user = User.query.filter_by(username='replica_user').first()
+		Entry.query.filter_by(user_id=user.id).delete()
+		DailyTotal.query.filter_by(user_id=user.id).delete()
+		db.session.delete(user)
+		db.session.commit()
+		app.config.update(self.settings)
+		self.app_context.pop()
+		if os.path.exists(REPLICA):
+			os.remove(REPLICA)
+
+	def replicate(self):
+		# Copy the primary into the replica file, as replication would
+		routing.reset()
+		db.session.commit()
+		primary = db.engine.raw_connection()
+		replica = sqlite3.connect(REPLICA)
+		primary.driver_connection.backup(replica)
+		replica.close()
+		primary.close()
+
+	def records(self):
+		return [record['text'] for record in self.app.get('/records', json={}).get_json()['records']]
+
+	def test_reads_use_caught_up_replica(self):
+		self.app.post('/records', json={ 'text': 'apple', 'calories': 100 })
+		routing.check_replica(routing.replica_engine())
+		self.replicate()
+
+		# Writes go to the primary, reads see the replica
+		self.app.post('/records', json={ 'text': 'pasta', 'calories': 700 })
+		self.assertEqual(self.records(), ['apple'])
+		self.assertEqual(Entry.query.filter_by(user_id=User.query.filter_by(username='replica_user').first().id).count(), 2)
+
+		# Once the replica's heartbeat falls behind, reads go to the primary
+		with routing.replica_engine().begin() as connection:
+			connection.execute(db.update(ReplicaHeartbeat).values(beat=datetime.utcnow() - timedelta(hours=1)))
+		self.assertEqual(self.records(), ['apple', 'pasta'])
+
+	def test_unreachable_replica_falls_back_to_primary(self):
+		self.app.post('/records', json={ 'text': 'apple', 'calories': 100 })
+		app.config['DATABASE_REPLICA_URL'] = 'sqlite:///' + os.path.join(REPLICA, 'missing.db')
+		routing.reset()
+		self.assertEqual(self.records(), ['apple'])
+		self.assertFalse(routing.replica_available())
+
+if __name__ == '__main__':
+	unittest.main()
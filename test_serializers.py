@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+from collections import namedtuple
+from datetime import date, time
+from flask import jsonify
+from app import app
+import serializers
+from serializers import RecordFormatter, json_response
+
+Row = namedtuple('Row', ['id', 'text', 'date', 'time', 'calories', 'is_below_expected'])
+
+ROWS = [
+	Row(1, 'banana', date(2023, 6, 5), time(8, 30), 105, True),
+	Row(2, 'banana', date(2023, 6, 5), time(8, 30, 0, 250), 105, None),
+	Row(3, 'crème brûlée', date(2023, 6, 6), time(20, 0), 300, False),
+	Row(4, 'tab\tquote"back\\slash\x1f\x7f', date(2023, 6, 7), time(12, 0), 250, True),
+	Row(5, 'soup', date(2023, 6, 7), time(13, 0), 120.5, True),
+	Row(6, 'huge', date(2023, 6, 7), time(14, 0), 1e16, True),
+]
+
+def expected(rows, **response):
+	# The record dicts get_records built before the formatter existed
+	return jsonify(dict(response, records=[{
+		'id': row.id,
+		'text': row.text,
+		'date': str(row.date),
+		'time': str(row.time),
+		'calories': row.calories,
+		'is_below_expected': row.is_below_expected
+	} for row in rows])).get_data()
+
+class RecordSerializationTestCase(unittest.TestCase):
+	def setUp(self):
+		self.app_context = app.app_context()
+		self.app_context.push()
+
+	def tearDown(self):
+		self.app_context.pop()
+
+	def test_byte_compatible_with_jsonify(self):
+		# Each row alone, so every fallback and the orjson path are exercised
+		for rows in [ROWS[:2]] + [[row] for row in ROWS]:
+			formatter = RecordFormatter()
+			response = formatter.response({ 'success': True, 'records': formatter.records(rows), 'limit': None })
+			self.assertEqual(response.get_data(), expected(rows, success=True, limit=None))
+			self.assertEqual(response.mimetype, 'application/json')
+
+	def test_plain_records_skip_jsonify(self):
+		formatter = RecordFormatter()
+		records = formatter.records(ROWS[:2])
+		with mock.patch.object(serializers, 'jsonify', side_effect=AssertionError):
+			response = formatter.response({ 'success': True, 'records': records })
+		self.assertEqual(response.get_data(), expected(ROWS[:2], success=True))
+
+	def test_single_record(self):
+		formatter = RecordFormatter()
+		response = formatter.response({ 'success': True, 'records': formatter.record(ROWS[4]) })
+		self.assertTrue(formatter.floats)
+		self.assertEqual(response.get_json()['records']['calories'], 120.5)
+
+	def test_without_orjson(self):
+		with mock.patch.object(serializers, 'orjson', None):
+			self.assertEqual(json_response({ 'b': 1, 'a': [True] }, floats=False).get_data(), b'{"a":[true],"b":1}\n')
+
+if __name__ == '__main__':
+	unittest.main()
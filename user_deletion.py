@@ -0,0 +1,114 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from models import db, User, Entry, DailyTotal, ArchivedEntry, MonthlyTotal
+from cache import TTLCache
+import identity
+import versions
+
+"""
+# USER DELETION #
+
+Deleting a user removes their entries and archived entries with bulk DELETE
+statements of at most USER_DELETE_CHUNK_SIZE rows, each committed on its own,
+so no entry is loaded into the session and the SQLite write lock is held for
+one chunk at a time. The last transaction deletes the remaining entries (less
+than a chunk, including any added in the meantime), the daily and monthly
+rollups and the user row. Until then the user still exists, and an interrupted
+deletion is finished by deleting them again.
+
+DELETE /users with "background": true hands the deletion to a single worker
+thread (deletions run one after the other) and returns a job ID. GET
+/users/deletions/<job_id> reports its progress. Jobs are tracked in the process
+that runs them for USER_DELETION_JOB_TTL seconds.
+
+"""
+
+_lock = threading.Lock()
+_executor = None
+_jobs = None
+# user ID -> ID of the job deleting them
+_running = {}
+
+def _delete_chunk(model, user_id, chunk_size):
+	# Delete up to chunk_size rows of model belonging to the user, returns how many were deleted
+	chunk = db.select(model.id).where(model.user_id == user_id).limit(chunk_size).scalar_subquery()
+	return db.session.execute(
+		db.delete(model).where(model.id.in_(chunk)).execution_options(synchronize_session=False)
+	).rowcount
+
+def delete_user(user_id, chunk_size=5000, progress=None):
+	# Delete a user and everything they own in short transactions, returns the number of entries deleted
+	deleted = 0
+	for model in (Entry, ArchivedEntry):
+		while True:
+			count = _delete_chunk(model, user_id, chunk_size)
+			deleted += count
+			if count < chunk_size:
+				break
+			versions.entries_changed(user_id)
+			db.session.commit()
+			if progress:
+				progress(deleted)
+
+	# The last, partial chunks are committed with the rollups and the user row
+	db.session.execute(db.delete(DailyTotal).where(DailyTotal.user_id == user_id))
+	db.session.execute(db.delete(MonthlyTotal).where(MonthlyTotal.user_id == user_id))
+	db.session.execute(db.delete(User).where(User.id == user_id).execution_options(synchronize_session=False))
+	versions.users_changed()
+	versions.entries_changed(user_id)
+	db.session.commit()
+	identity.invalidate(user_id)
+	if progress:
+		progress(deleted)
+	return deleted
+
+def _get_executor():
+	global _executor
+	with _lock:
+		if _executor is None:
+			# One worker: deletions compete for the same write lock anyway
+			_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='user-deletion')
+	return _executor
+
+def _get_jobs(app):
+	global _jobs
+	with _lock:
+		if _jobs is None:
+			_jobs = TTLCache(maxsize=10000, ttl=app.config.get('USER_DELETION_JOB_TTL', 24 * 60 * 60))
+	return _jobs
+
+def _run(app, job):
+	def progress(deleted):
+		job['deleted_entries'] = deleted
+
+	with app.app_context():
+		job['status'] = 'running'
+		try:
+			delete_user(job['user_id'], app.config.get('USER_DELETE_CHUNK_SIZE', 5000), progress)
+			job['status'] = 'done'
+		except Exception:
+			app.logger.exception('Deleting user %s failed', job['user_id'])
+			db.session.rollback()
+			job['status'] = 'failed'
+		finally:
+			db.session.remove()
+			with _lock:
+				_running.pop(job['user_id'], None)
+
+def submit(app, user):
+	# Queue the deletion of a user, returns the job (the running one if they are already being deleted)
+	jobs = _get_jobs(app)
+	with _lock:
+		job_id = _running.get(user.id)
+		job = jobs.get(job_id) if job_id else None
+		if job is not None:
+			return job
+		job = { 'id': uuid.uuid4().hex, 'user_id': user.id, 'username': user.username, 'status': 'queued', 'deleted_entries': 0 }
+		_running[user.id] = job['id']
+	jobs.set(job['id'], job)
+	_get_executor().submit(_run, app, job)
+	return job
+
+def get_job(app, job_id):
+	return _get_jobs(app).get(job_id)
@@ -0,0 +1,85 @@
+import hashlib
+from flask import current_app, g, request
+from flask_login import current_user
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from models import db, DataVersion
+
+"""
+# DATA VERSIONS AND ETAGS #
+
+Every write bumps a counter in data_version in the same transaction as the
+change: 'user:<id>' when a user's records (or their flags) change and 'users'
+for any change to the user table. No row is shared by every record write,
+which would serialize concurrent writers on its row lock: the version of all
+records ('entries') is the sum of the 'user:<id>' counters, which only grow.
+Maintenance commands that rewrite derived data bump 'epoch', which every ETag
+includes. A listing's ETag hashes the versions of the scopes it reads, the
+current user and the request body, so a matching If-None-Match is answered
+with 304 after a single primary key lookup, without running the listing.
+Cached reports are keyed by the same versions, so a write committed by any
+process is seen by all of them.
+
+"""
+
+EPOCH = 'epoch'
+ENTRIES = 'entries'
+USERS = 'users'
+
+USER_PREFIX = 'user:'
+
+def user_scope(user_id):
+	return f'{USER_PREFIX}{user_id}'
+
+def _increment(scope):
+	# INSERT ... ON CONFLICT DO UPDATE: concurrent first writes to a new scope both succeed
+	dialect = db.session.get_bind().dialect.name
+	if dialect == 'mysql':
+		return mysql.insert(DataVersion).values(scope=scope, version=1) \
+			.on_duplicate_key_update(version=DataVersion.version + 1)
+	insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+	return insert(DataVersion).values(scope=scope, version=1) \
+		.on_conflict_do_update(index_elements=[DataVersion.scope], set_={ 'version': DataVersion.version + 1 })
+
+def bump(*scopes):
+	# Increment the version of each scope, committed with the caller's transaction
+	for scope in sorted(set(scopes)):
+		db.session.execute(_increment(scope))
+
+def entries_changed(*user_ids):
+	bump(*(user_scope(user_id) for user_id in user_ids))
+
+def users_changed():
+	bump(USERS)
+
+def current(*scopes):
+	# Versions of scopes in one statement, 0 for a scope never bumped
+	query = db.select(DataVersion.scope, DataVersion.version).where(DataVersion.scope.in_(scopes))
+	if ENTRIES in scopes:
+		query = db.union_all(query, db.select(
+			db.literal(ENTRIES),
+			db.func.coalesce(db.func.sum(DataVersion.version), 0)
+		).where(DataVersion.scope.startswith(USER_PREFIX)))
+	versions = dict(db.session.execute(query).all())
+	return tuple(versions.get(scope, 0) for scope in scopes)
+
+def etag(*scopes):
+	key = hashlib.sha1()
+	key.update(repr((list(current(EPOCH, *scopes)), current_user.id, current_user.role)).encode())
+	key.update(request.get_data())
+	return key.hexdigest()
+
+def conditional(*scopes):
+	# Tag the response with the version of scopes, returns a 304 response when the client's copy is current
+	g.etag = etag(*scopes)
+	if g.etag in request.if_none_match:
+		return current_app.response_class(status=304)
+	return None
+
+def tag_response(response):
+	# after_request: send the ETag computed by conditional() and ask clients to revalidate
+	tag = g.pop('etag', None)
+	if tag and response.status_code in (200, 304):
+		response.set_etag(tag)
+		response.cache_control.private = True
+		response.cache_control.no_cache = True
+	return response